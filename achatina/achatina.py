@@ -12,14 +12,40 @@ ACHATINA_URL = 'https://github.com/MegaMosquito/achatina'
 
 import json
 import os
+import queue
+import random
 import socket
+import struct
 import subprocess
 import threading
 import time
+import uuid
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import base64
 import requests
+import requests.adapters
 import urllib.parse
+import zlib
+
+# The faster orjson encoder/decoder is optional (json is used without it)
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# The in-process MQTT client is optional (mosquitto_pub is used without it)
+try:
+  import paho.mqtt.client as mqtt
+except ImportError:
+  mqtt = None
+
+# The in-process Kafka producer is optional (kafkacat is used without it)
+try:
+  import kafka
+  import kafka.codec
+except ImportError:
+  kafka = None
 
 # Configuration from the environment
 def get_from_env(v, d):
@@ -31,15 +57,44 @@ ACHATINA_PLUGIN = get_from_env('ACHATINA_PLUGIN', 'cpu-only')
 MQTT_BROKER_URL = get_from_env('MQTT_BROKER_URL', 'mqtt')
 MQTT_BROKER_PORT = get_from_env('MQTT_BROKER_PORT', '1883')
 MQTT_PUB_TOPIC = get_from_env('MQTT_PUB_TOPIC', '/detect')
+MQTT_QOS = int(get_from_env('MQTT_QOS', '0'))
+MQTT_MAX_INFLIGHT = int(get_from_env('MQTT_MAX_INFLIGHT', '20'))
+MQTT_MAX_QUEUED = int(get_from_env('MQTT_MAX_QUEUED', '100'))
+MQTT_KEEPALIVE = int(get_from_env('MQTT_KEEPALIVE', '60'))
 KAFKA_BROKER_URLS = get_from_env('KAFKA_BROKER_URLS', '')
 KAFKA_API_KEY = get_from_env('KAFKA_API_KEY', '')
 KAFKA_PUB_TOPIC = get_from_env('KAFKA_PUB_TOPIC', '')
+KAFKA_TRANSPORT = get_from_env('KAFKA_TRANSPORT', 'kafka-python')
+KAFKA_LINGER_MS = int(get_from_env('KAFKA_LINGER_MS', '100'))
+KAFKA_BATCH_SIZE = int(get_from_env('KAFKA_BATCH_SIZE', '1048576'))
+KAFKA_COMPRESSION = get_from_env('KAFKA_COMPRESSION', 'none')
+PUBLISH_MODE = get_from_env('PUBLISH_MODE', 'inline')
+MQTT_IMAGE_TOPIC = get_from_env('MQTT_IMAGE_TOPIC', MQTT_PUB_TOPIC + '/image')
+KAFKA_IMAGE_TOPIC = get_from_env('KAFKA_IMAGE_TOPIC', KAFKA_PUB_TOPIC + '-image')
+IMAGE_EVERY_N = int(get_from_env('IMAGE_EVERY_N', '1'))
+IMAGE_ON_CHANGE = 'true' == get_from_env('IMAGE_ON_CHANGE', 'false').lower()
+SPOOL_DIR = get_from_env('SPOOL_DIR', '')
+SPOOL_MAX_BYTES = int(get_from_env('SPOOL_MAX_BYTES', '104857600'))
+SPOOL_MAX_AGE = float(get_from_env('SPOOL_MAX_AGE', '86400'))
+SPOOL_SEGMENT_BYTES = int(get_from_env('SPOOL_SEGMENT_BYTES', '4194304'))
+SPOOL_REPLAY_BATCH = int(get_from_env('SPOOL_REPLAY_BATCH', '50'))
+SPOOL_REPLAY_RATE = float(get_from_env('SPOOL_REPLAY_RATE', '20'))
+PLUGIN_CONNECT_TIMEOUT = float(get_from_env('PLUGIN_CONNECT_TIMEOUT', '5'))
+PLUGIN_READ_TIMEOUT = float(get_from_env('PLUGIN_READ_TIMEOUT', '60'))
+PLUGIN_BACKOFF_MIN = float(get_from_env('PLUGIN_BACKOFF_MIN', '0.5'))
+PLUGIN_BACKOFF_MAX = float(get_from_env('PLUGIN_BACKOFF_MAX', '30'))
+PLUGIN_BREAKER_THRESHOLD = int(get_from_env('PLUGIN_BREAKER_THRESHOLD', '5'))
+PLUGIN_BREAKER_COOLDOWN = float(get_from_env('PLUGIN_BREAKER_COOLDOWN', '30'))
+STATUS_PORT = int(get_from_env('STATUS_PORT', '8080'))
 INPUT_URL = get_from_env('INPUT_URL', '')
+INPUT_URLS = get_from_env('INPUT_URLS', INPUT_URL)
+CAMERA_RATES = get_from_env('CAMERA_RATES', '0')
+PLUGIN_URLS = get_from_env('PLUGIN_URLS', '')
 NODE = get_from_env('NODE', '')
 HOST_IP = get_from_env('HOST_IP', '')
 
 # Exit if any required configuration is not present
-if '' == INPUT_URL:
+if '' == INPUT_URLS:
   print('******* ERROR: configuration variable "INPUT_URL" is not set! ******')
   os._exit(1)
 
@@ -48,35 +103,133 @@ print('achatina: ACHATINA_PLUGIN="%s"' % ACHATINA_PLUGIN)
 print('achatina: MQTT_BROKER_URL="%s"' % MQTT_BROKER_URL)
 print('achatina: MQTT_BROKER_PORT="%s"' % MQTT_BROKER_PORT)
 print('achatina: MQTT_PUB_TOPIC="%s"' % MQTT_PUB_TOPIC)
+print('achatina: MQTT_QOS="%d"' % MQTT_QOS)
+print('achatina: MQTT_MAX_INFLIGHT="%d"' % MQTT_MAX_INFLIGHT)
+print('achatina: MQTT_MAX_QUEUED="%d"' % MQTT_MAX_QUEUED)
+print('achatina: MQTT_KEEPALIVE="%d"' % MQTT_KEEPALIVE)
 print('achatina: KAFKA_BROKER_URLS="%s"' % KAFKA_BROKER_URLS)
 if '' == KAFKA_API_KEY:
   print('achatina: KAFKA_API_KEY="%s"" (is not set)')
 else:
   print('achatina: KAFKA_API_KEY="*******" (is set)')
 print('achatina: KAFKA_PUB_TOPIC="%s"' % KAFKA_PUB_TOPIC)
-print('achatina: INPUT_URL="%s"' % INPUT_URL)
+print('achatina: KAFKA_TRANSPORT="%s"' % KAFKA_TRANSPORT)
+print('achatina: KAFKA_LINGER_MS="%d"' % KAFKA_LINGER_MS)
+print('achatina: KAFKA_BATCH_SIZE="%d"' % KAFKA_BATCH_SIZE)
+print('achatina: KAFKA_COMPRESSION="%s"' % KAFKA_COMPRESSION)
+print('achatina: PUBLISH_MODE="%s"' % PUBLISH_MODE)
+print('achatina: MQTT_IMAGE_TOPIC="%s"' % MQTT_IMAGE_TOPIC)
+print('achatina: KAFKA_IMAGE_TOPIC="%s"' % KAFKA_IMAGE_TOPIC)
+print('achatina: IMAGE_EVERY_N="%d"' % IMAGE_EVERY_N)
+print('achatina: IMAGE_ON_CHANGE="%s"' % IMAGE_ON_CHANGE)
+print('achatina: SPOOL_DIR="%s"' % SPOOL_DIR)
+print('achatina: SPOOL_MAX_BYTES="%d"' % SPOOL_MAX_BYTES)
+print('achatina: SPOOL_MAX_AGE="%f"' % SPOOL_MAX_AGE)
+print('achatina: SPOOL_SEGMENT_BYTES="%d"' % SPOOL_SEGMENT_BYTES)
+print('achatina: SPOOL_REPLAY_BATCH="%d"' % SPOOL_REPLAY_BATCH)
+print('achatina: SPOOL_REPLAY_RATE="%f"' % SPOOL_REPLAY_RATE)
+print('achatina: PLUGIN_CONNECT_TIMEOUT="%f"' % PLUGIN_CONNECT_TIMEOUT)
+print('achatina: PLUGIN_READ_TIMEOUT="%f"' % PLUGIN_READ_TIMEOUT)
+print('achatina: PLUGIN_BACKOFF_MIN="%f"' % PLUGIN_BACKOFF_MIN)
+print('achatina: PLUGIN_BACKOFF_MAX="%f"' % PLUGIN_BACKOFF_MAX)
+print('achatina: PLUGIN_BREAKER_THRESHOLD="%d"' % PLUGIN_BREAKER_THRESHOLD)
+print('achatina: PLUGIN_BREAKER_COOLDOWN="%f"' % PLUGIN_BREAKER_COOLDOWN)
+print('achatina: STATUS_PORT="%d"' % STATUS_PORT)
+print('achatina: INPUT_URLS="%s"' % INPUT_URLS)
+print('achatina: CAMERA_RATES="%s"' % CAMERA_RATES)
 print('achatina: NODE="%s"' % NODE)
 
 # Configuration constants
-# PLUGIN_URL is tricky because openvino unfortunately requires --net=host
-if 'ACHATINA_PLUGIN' in os.environ and 'openvino' == os.environ['ACHATINA_PLUGIN']:
-  PLUGIN_URL = ('http://%s:80/detect?url=%s' % (HOST_IP, urllib.parse.quote(INPUT_URL)))
+# The default plugin URL is tricky because openvino unfortunately requires
+# --net=host (PLUGIN_URLS, if set, is a comma-separated list of plugin URLs)
+if '' != PLUGIN_URLS:
+  PLUGIN_BASE_URLS = [u.strip().rstrip('/') for u in PLUGIN_URLS.split(',') if '' != u.strip()]
+elif 'ACHATINA_PLUGIN' in os.environ and 'openvino' == os.environ['ACHATINA_PLUGIN']:
+  PLUGIN_BASE_URLS = ['http://%s:80' % HOST_IP]
 else:
-  PLUGIN_URL = ('http://%s:80/detect?url=%s' % (ACHATINA_PLUGIN, urllib.parse.quote(INPUT_URL)))
-TEMP_FILE = '/tmp/achatina.json'
-MQTT_PUB_COMMAND = ('mosquitto_pub -h %s -p %s -t %s -f ' % (MQTT_BROKER_URL, MQTT_BROKER_PORT, MQTT_PUB_TOPIC))
+  PLUGIN_BASE_URLS = ['http://%s:80' % ACHATINA_PLUGIN]
+# INPUT_URLS is a comma-separated list of cameras, and CAMERA_RATES is either
+# one target rate (in frames/sec, 0 meaning "as fast as possible") for all of
+# them, or a comma-separated list of rates, one per camera
+CAMERA_URLS = [u.strip() for u in INPUT_URLS.split(',') if '' != u.strip()]
+CAMERA_TARGET_RATES = [float(r) for r in CAMERA_RATES.split(',')]
+if 1 == len(CAMERA_TARGET_RATES):
+  CAMERA_TARGET_RATES = CAMERA_TARGET_RATES * len(CAMERA_URLS)
+if len(CAMERA_TARGET_RATES) != len(CAMERA_URLS):
+  print('******* ERROR: "CAMERA_RATES" must have one rate, or one per camera! ******')
+  os._exit(1)
+# (the topic, and for kafka the key and input file, are appended to these)
+MQTT_PUB_COMMAND = ('mosquitto_pub -h %s -p %s -s -t ' % (MQTT_BROKER_URL, MQTT_BROKER_PORT))
 if '' != KAFKA_BROKER_URLS and '' != KAFKA_API_KEY and '' != KAFKA_PUB_TOPIC:
-  KAFKA_PUB_COMMAND = 'kafkacat -P -b ' + KAFKA_BROKER_URLS + ' -X api.version.request=true -X security.protocol=sasl_ssl -X sasl.mechanisms=PLAIN -X sasl.username=token -X sasl.password="' + KAFKA_API_KEY + '" -t ' + KAFKA_PUB_TOPIC + ' '
+  KAFKA_PUB_COMMAND = 'kafkacat -P -b ' + KAFKA_BROKER_URLS + ' -X api.version.request=true -X security.protocol=sasl_ssl -X sasl.mechanisms=PLAIN -X sasl.username=token -X sasl.password="' + KAFKA_API_KEY + '" -t '
 else:
   KAFKA_PUB_COMMAND = ''
-SLEEP_BETWEEN_CALLS = 0.1
+
+# Pacing: the adaptive rate controller aims for TARGET_FPS frames/sec in total
+# (0 means "as fast as possible") but slows down whenever the host CPU is
+# busier than CPU_BUDGET (a fraction, 0..1) or the plugin-reported latency
+# (cam-time + inf-time) exceeds LATENCY_BUDGET seconds (0 disables this)
+TARGET_FPS = float(get_from_env('TARGET_FPS', '0'))
+CPU_BUDGET = float(get_from_env('CPU_BUDGET', '0.9'))
+LATENCY_BUDGET = float(get_from_env('LATENCY_BUDGET', '0'))
+
+# Pipelining: PLUGIN_INFLIGHT is the number of plugin requests kept in flight
+# concurrently (0 selects the original strictly serial loop), and
+# PIPELINE_QUEUE_SIZE bounds the queues between the fetch/publish/log stages
+PLUGIN_INFLIGHT = int(get_from_env('PLUGIN_INFLIGHT', '0'))
+PIPELINE_QUEUE_SIZE = int(get_from_env('PIPELINE_QUEUE_SIZE', '4'))
+
+# Change gating: if GATE_THRESHOLD (in percent, 0 disables gating) is set,
+# the plugin compares a tiny grayscale thumbnail of each new frame with that
+# of the last frame it ran inference on, for the same camera, and skips
+# inference unless at least this percentage of the thumbnail has changed.
+# GATE_MODE "reuse" returns the previous result again (marked "gated"), and
+# "suppress" returns nothing for the frame. Inference is always re-run once
+# the previous result is older than GATE_MAX_AGE seconds.
+GATE_THRESHOLD = float(get_from_env('GATE_THRESHOLD', '0'))
+GATE_MODE = get_from_env('GATE_MODE', 'reuse')
+GATE_MAX_AGE = float(get_from_env('GATE_MAX_AGE', '60'))
+
+# Push mode: if PUSH_FRAMES is "true", achatina pulls each frame from the
+# camera itself and pushes it to the plugin (in the body of a POST /detect)
+# instead of asking the plugin to pull it. Achatina must then be able to
+# reach the cameras.
+PUSH_FRAMES = 'true' == get_from_env('PUSH_FRAMES', 'false').lower()
+
+# Event mode: if EVENT_MODE is "true", a message is only published when the
+# detections change (see the Tracker class below), plus a keyframe carrying
+# the full detection set every EVENT_KEYFRAME_INTERVAL seconds per camera
+EVENT_MODE = 'true' == get_from_env('EVENT_MODE', 'false').lower()
+EVENT_MATCH_IOU = float(get_from_env('EVENT_MATCH_IOU', '0.3'))
+EVENT_CHANGE_IOU = float(get_from_env('EVENT_CHANGE_IOU', '0.7'))
+EVENT_MISS_FRAMES = int(get_from_env('EVENT_MISS_FRAMES', '2'))
+EVENT_KEYFRAME_INTERVAL = float(get_from_env('EVENT_KEYFRAME_INTERVAL', '60'))
 
 # Log more useful information
-print('achatina: TEMP_FILE="%s"' % TEMP_FILE)
-print('achatina: PLUGIN_URL="%s"' % PLUGIN_URL)
-print('achatina: MQTT_PUB_COMMAND="%s"' % MQTT_PUB_COMMAND)
-print('achatina: KAFKA_PUB_COMMAND="%s"' % KAFKA_PUB_COMMAND)
-print('achatina: SLEEP_BETWEEN_CALLS="%f"' % SLEEP_BETWEEN_CALLS)
+print('achatina: JSON_ENCODER="%s"' % ('orjson' if None != orjson else 'json'))
+print('achatina: PLUGIN_URLS="%s"' % ','.join(PLUGIN_BASE_URLS))
+if None != mqtt:
+  print('achatina: MQTT_PUB_COMMAND="(in-process paho-mqtt client)"')
+else:
+  print('achatina: MQTT_PUB_COMMAND="%s"' % MQTT_PUB_COMMAND)
+if None != kafka or 'kafka-python' != KAFKA_TRANSPORT:
+  print('achatina: KAFKA_PUB_COMMAND="(in-process %s producer)"' % KAFKA_TRANSPORT)
+else:
+  print('achatina: KAFKA_PUB_COMMAND="%s"' % KAFKA_PUB_COMMAND)
+print('achatina: TARGET_FPS="%f"' % TARGET_FPS)
+print('achatina: CPU_BUDGET="%f"' % CPU_BUDGET)
+print('achatina: LATENCY_BUDGET="%f"' % LATENCY_BUDGET)
+print('achatina: PLUGIN_INFLIGHT="%d"' % PLUGIN_INFLIGHT)
+print('achatina: PIPELINE_QUEUE_SIZE="%d"' % PIPELINE_QUEUE_SIZE)
+print('achatina: GATE_THRESHOLD="%f"' % GATE_THRESHOLD)
+print('achatina: GATE_MODE="%s"' % GATE_MODE)
+print('achatina: GATE_MAX_AGE="%f"' % GATE_MAX_AGE)
+print('achatina: PUSH_FRAMES="%s"' % PUSH_FRAMES)
+print('achatina: EVENT_MODE="%s"' % EVENT_MODE)
+print('achatina: EVENT_MATCH_IOU="%f"' % EVENT_MATCH_IOU)
+print('achatina: EVENT_CHANGE_IOU="%f"' % EVENT_CHANGE_IOU)
+print('achatina: EVENT_MISS_FRAMES="%d"' % EVENT_MISS_FRAMES)
+print('achatina: EVENT_KEYFRAME_INTERVAL="%f"' % EVENT_KEYFRAME_INTERVAL)
 
 # To log or not to log, that is the question
 LOG_DETAIL = False
@@ -84,59 +237,1271 @@ LOG_STATS = True
 LOG_EXCEPT = True
 LOG_SLEEP = False
 
-if __name__ == '__main__':
-  while True:
+#
+# Each result is serialized exactly once, into memory, and every sink shares
+# those bytes. Fields that only some sinks need (e.g., "kafka-sub") are
+# spliced onto the end of the serialized object rather than re-encoding the
+# whole thing (which would mean re-encoding the large base64 image again).
+#
+def encode_json(j):
+  if None != orjson:
+    return orjson.dumps(j)
+  return json.dumps(j).encode('utf-8')
+
+def decode_json(payload):
+  if None != orjson:
+    return orjson.loads(payload)
+  return json.loads(payload)
+
+# Append fields to a serialized, non-empty JSON object (without re-encoding)
+def add_json_fields(payload, fields):
+  extra = b''.join([b',' + encode_json(k) + b':' + encode_json(v) for (k, v) in fields.items()])
+  return payload[:payload.rindex(b'}')] + extra + b'}'
+
+#
+# A persistent, in-process MQTT publisher. It holds one long-lived connection
+# to the broker (reconnecting in the background with a growing delay if the
+# broker goes away) instead of forking mosquitto_pub for every message. At
+# most MQTT_MAX_INFLIGHT QoS 1/2 messages are unacknowledged at any moment,
+# and at most MQTT_MAX_QUEUED (including those in flight) are held by the
+# client, which sends them as the window opens (or once it has reconnected).
+# Any more than that are refused (publish() returns False), as are QoS 0
+# messages while the client is not connected.
+#
+class MqttPublisher:
+
+  def __init__(self, host, port, qos=0, max_inflight=20, max_queued=100, keepalive=60):
+    self.host = host
+    self.port = int(port)
+    self.qos = qos
+    self.connected = False
+    self.published = 0
+    self.refused = 0
+    self.client = mqtt.Client(client_id='achatina-%s-%d' % (socket.gethostname(), os.getpid()), clean_session=True)
+    self.client.max_inflight_messages_set(max_inflight)
+    self.client.max_queued_messages_set(max_queued)
+    self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+    self.client.on_connect = self._on_connect
+    self.client.on_disconnect = self._on_disconnect
+    self.client.on_publish = self._on_publish
+    self.client.connect_async(self.host, self.port, keepalive=keepalive)
+    self.client.loop_start()
+
+  def _on_connect(self, client, userdata, flags, rc):
+    self.connected = (0 == rc)
+    if 0 == rc:
+      print('achatina: MQTT connected to %s:%d' % (self.host, self.port))
+    else:
+      print('ERROR: MQTT connection to %s:%d refused: %s' % (self.host, self.port, mqtt.connack_string(rc)))
+
+  def _on_disconnect(self, client, userdata, rc):
+    self.connected = False
+    if 0 != rc:
+      print('ERROR: MQTT connection to %s:%d lost (will reconnect)' % (self.host, self.port))
+
+  def _on_publish(self, client, userdata, mid):
+    self.published += 1
+
+  # Queue one message for publication (returns False if it was refused)
+  def publish(self, topic, payload):
+    info = self.client.publish(topic, payload, qos=self.qos)
+    # (a QoS 1/2 message that could not be sent yet is kept, and sent later)
+    if mqtt.MQTT_ERR_SUCCESS != info.rc and not (self.qos > 0 and mqtt.MQTT_ERR_NO_CONN == info.rc):
+      self.refused += 1
+      if LOG_DETAIL: print('--> MQTT: publish refused: ' + mqtt.error_string(info.rc))
+      return False
+    return True
+
+  def close(self):
+    self.client.disconnect()
+    self.client.loop_stop()
+
+# The shared MQTT publisher (created at startup if paho-mqtt is available)
+mqtt_publisher = None
+
+#
+# Kafka transports. A transport delivers messages to a Kafka cluster. It must
+# provide send(topic, value, key, callback), where callback(error) is called
+# once per message (error is None on success), plus flush() and close(). The
+# default transport is kafka-python. Any other transport (e.g., a local fake
+# broker for testing) can be used by setting KAFKA_TRANSPORT="module:name"
+# where "name" is a callable taking the same arguments as the class below.
+#
+class KafkaPythonTransport:
+
+  def __init__(self, brokers, api_key, linger_ms, batch_size, compression):
+    if 'none' == compression:
+      compression = None
+    elif not {'gzip': kafka.codec.has_gzip, 'lz4': kafka.codec.has_lz4, 'zstd': kafka.codec.has_zstd, 'snappy': kafka.codec.has_snappy}[compression]():
+      print('ERROR: Kafka compression "%s" is not available, sending uncompressed' % compression)
+      compression = None
+    self.producer = kafka.KafkaProducer(
+      bootstrap_servers=brokers.split(','),
+      security_protocol='SASL_SSL',
+      sasl_mechanism='PLAIN',
+      sasl_plain_username='token',
+      sasl_plain_password=api_key,
+      linger_ms=linger_ms,
+      batch_size=batch_size,
+      compression_type=compression)
+
+  def send(self, topic, value, key, callback):
+    future = self.producer.send(topic, value=value, key=key)
+    future.add_callback(lambda metadata: callback(None))
+    future.add_errback(lambda error: callback(error))
+
+  def flush(self):
+    self.producer.flush()
+
+  def close(self):
+    self.producer.close()
+
+def make_kafka_transport(brokers, api_key, linger_ms, batch_size, compression):
+  if 'kafka-python' == KAFKA_TRANSPORT:
+    return KafkaPythonTransport(brokers, api_key, linger_ms, batch_size, compression)
+  module_name, factory_name = KAFKA_TRANSPORT.split(':')
+  module = __import__(module_name, fromlist=[factory_name])
+  return getattr(module, factory_name)(brokers, api_key, linger_ms, batch_size, compression)
+
+#
+# A persistent, batching, in-process Kafka publisher. Messages are handed to
+# the transport, which batches them (up to KAFKA_BATCH_SIZE bytes, waiting at
+# most KAFKA_LINGER_MS for a batch to fill) and optionally compresses each
+# batch. Delivery results are counted as they are reported back.
+#
+# After a delivery failure the publisher is considered unhealthy (so new
+# messages are spooled instead, if a spool is configured) until RETRY_AFTER
+# seconds have passed, then spooled messages are replayed as a probe.
+#
+class KafkaPublisher:
+
+  RETRY_AFTER = 30.0
+
+  def __init__(self, transport, on_failure=None):
+    self.transport = transport
+    self.on_failure = on_failure
+    self.lock = threading.Lock()
+    self.sent = 0
+    self.delivered = 0
+    self.failed = 0
+    self.failed_at = 0.0
+
+  def _on_delivery(self, topic, value, key, error):
+    with self.lock:
+      if None == error:
+        self.delivered += 1
+        self.failed_at = 0.0
+      else:
+        self.failed += 1
+        self.failed_at = time.time()
+    if None != error:
+      if LOG_EXCEPT: print('ERROR: Kafka delivery failed: ' + str(error))
+      if None != self.on_failure:
+        self.on_failure('kafka', topic, key, value)
+
+  def healthy(self):
+    with self.lock:
+      return time.time() - self.failed_at > KafkaPublisher.RETRY_AFTER
+
+  # Hand one message to the transport (returns False if it was refused)
+  def publish(self, topic, value, key=None):
+    with self.lock:
+      self.sent += 1
     try:
-      # Request one run from the plugin REST service...
-      if LOG_DETAIL:
-        print('\nInitiating a request...')
-        print('--> URL: ' + PLUGIN_URL)
-      r = requests.get(PLUGIN_URL)
-      if (r.status_code > 299):
-          print('ERROR: Plugin request failed: ' + str(r.status_code))
-          time.sleep(10)
+      self.transport.send(topic, value, key, lambda error: self._on_delivery(topic, value, key, error))
+    except Exception as e:
+      if LOG_EXCEPT: print('ERROR: Kafka send failed: ' + str(e))
+      with self.lock:
+        self.failed += 1
+        self.failed_at = time.time()
+      return False
+    return True
+
+  def close(self):
+    self.transport.flush()
+    self.transport.close()
+
+# The shared Kafka publisher (created at startup if a transport is available)
+kafka_publisher = None
+
+#
+# A local store-and-forward spool, used when a sink cannot take a message
+# (e.g., the broker is unreachable). Messages are appended to numbered
+# segment files in SPOOL_DIR. Each record is a header (body length, CRC-32 of
+# the body and a timestamp) followed by the body (the sink, topic, key and
+# payload). A small index file holds the replay position; it is replaced
+# atomically (write, fsync, rename), so after a crash or restart replay
+# resumes where it left off, and only the last segment is scanned (to cut
+# off any record that was torn by the crash). The oldest segments are evicted
+# whenever the spool exceeds SPOOL_MAX_BYTES, and records older than
+# SPOOL_MAX_AGE seconds are discarded (either way, each record that is lost
+# is counted once, as "evicted"). When a sink is reachable again, its
+# spooled messages are replayed in batches of SPOOL_REPLAY_BATCH, at no more
+# than SPOOL_REPLAY_RATE messages per second.
+#
+class Spool:
+
+  HEADER = struct.Struct('>IId')
+  FIELDS = struct.Struct('>HHH')
+  INDEX_FILE = 'index'
+
+  def __init__(self, directory, max_bytes, max_age, segment_bytes):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self.segment_bytes = segment_bytes
+    self.lock = threading.Lock()
+    self.spooled = 0
+    self.replayed = 0
+    self.evicted = 0
+    self.total_bytes = 0
+    os.makedirs(directory, exist_ok=True)
+    self.segments = sorted([int(name[:-4]) for name in os.listdir(directory) if name.endswith('.seg')])
+    (self.read_segment, self.read_offset) = self._read_index()
+    for segment in [s for s in self.segments if s < self.read_segment]:
+      self._remove(segment)
+    if 0 == len(self.segments):
+      self.segments.append(self.read_segment)
+    if self.read_segment not in self.segments:
+      (self.read_segment, self.read_offset) = (self.segments[0], 0)
+    self.write_offset = self._recover(self.segments[-1])
+    self.writer = open(self._path(self.segments[-1]), 'ab')
+    self.total_bytes = sum([os.path.getsize(self._path(s)) for s in self.segments])
+
+  def _path(self, segment):
+    return os.path.join(self.directory, '%016d.seg' % segment)
+
+  def _read_index(self):
+    try:
+      with open(os.path.join(self.directory, Spool.INDEX_FILE)) as f:
+        index = json.load(f)
+      return (index['segment'], index['offset'])
+    except (IOError, ValueError, KeyError):
+      return (self.segments[0] if len(self.segments) > 0 else 0, 0)
+
+  def _write_index(self):
+    path = os.path.join(self.directory, Spool.INDEX_FILE)
+    with open(path + '.tmp', 'w') as f:
+      json.dump({'segment': self.read_segment, 'offset': self.read_offset}, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+  # Read the record at offset in an open segment (None at the end, or if torn)
+  def _read_record(self, f, offset):
+    f.seek(offset)
+    header = f.read(Spool.HEADER.size)
+    if len(header) < Spool.HEADER.size:
+      return None
+    (length, crc, timestamp) = Spool.HEADER.unpack(header)
+    body = f.read(length)
+    if len(body) < length or crc != zlib.crc32(body):
+      return None
+    return (offset + Spool.HEADER.size + length, timestamp, body)
+
+  # Find the end of the valid records in a segment, truncating any torn tail
+  def _recover(self, segment):
+    path = self._path(segment)
+    offset = 0
+    if os.path.exists(path):
+      with open(path, 'r+b') as f:
+        while True:
+          record = self._read_record(f, offset)
+          if None == record:
+            break
+          offset = record[0]
+        f.truncate(offset)
+    return offset
+
+  # The number of records in a segment from offset on
+  def _count_records(self, segment, offset):
+    count = 0
+    with open(self._path(segment), 'rb') as f:
+      while True:
+        record = self._read_record(f, offset)
+        if None == record:
+          return count
+        offset = record[0]
+        count += 1
+
+  def _remove(self, segment):
+    path = self._path(segment)
+    if os.path.exists(path):
+      self.total_bytes -= os.path.getsize(path)
+      os.remove(path)
+    if segment in self.segments:
+      self.segments.remove(segment)
+
+  def _roll(self):
+    self.writer.flush()
+    os.fsync(self.writer.fileno())
+    self.writer.close()
+    self.segments.append(self.segments[-1] + 1)
+    self.writer = open(self._path(self.segments[-1]), 'ab')
+    self.write_offset = 0
+
+  # Evict the oldest segments (never the one being written) while over size
+  def _evict(self):
+    while self.total_bytes > self.max_bytes and len(self.segments) > 1:
+      oldest = self.segments[0]
+      print('achatina: spool is full, evicting segment %d' % oldest)
+      self.evicted += self._count_records(oldest, self.read_offset if oldest == self.read_segment else 0)
+      self._remove(oldest)
+      if oldest == self.read_segment:
+        (self.read_segment, self.read_offset) = (self.segments[0], 0)
+        self._write_index()
+
+  def append(self, sink, topic, key, payload):
+    sink = sink.encode('utf-8')
+    topic = topic.encode('utf-8')
+    key = key if None != key else b''
+    body = Spool.FIELDS.pack(len(sink), len(topic), len(key)) + sink + topic + key + payload
+    record = Spool.HEADER.pack(len(body), zlib.crc32(body), time.time()) + body
+    with self.lock:
+      if self.write_offset > 0 and self.write_offset + len(record) > self.segment_bytes:
+        self._roll()
+      self.writer.write(record)
+      self.writer.flush()
+      self.write_offset += len(record)
+      self.total_bytes += len(record)
+      self.spooled += 1
+      self._evict()
+
+  def _decode(self, body):
+    (sink_len, topic_len, key_len) = Spool.FIELDS.unpack(body[:Spool.FIELDS.size])
+    i = Spool.FIELDS.size
+    sink = body[i : i + sink_len].decode('utf-8')
+    i += sink_len
+    topic = body[i : i + topic_len].decode('utf-8')
+    i += topic_len
+    key = body[i : i + key_len] if key_len > 0 else None
+    return (sink, topic, key, body[i + key_len:])
+
+  # Returns up to n records as a list of ((segment, offset after), message).
+  # Expired records ahead of the batch are discarded, and the read position
+  # is moved past them, so they are not read (or counted) again. The batch
+  # stops at an expired record after it, which goes with the next batch.
+  def _read_batch(self, n):
+    batch = []
+    expired = None
+    (segment, offset) = (self.read_segment, self.read_offset)
+    with open(self._path(segment), 'rb') as f:
+      while len(batch) < n:
+        record = self._read_record(f, offset)
+        if None == record:
+          break
+        (offset, timestamp, body) = record
+        if time.time() - timestamp <= self.max_age:
+          batch.append(((segment, offset), self._decode(body)))
+        elif 0 == len(batch):
+          self.evicted += 1
+          expired = (segment, offset)
+        else:
+          break
+    if None != expired:
+      self._commit(expired)
+    if 0 == len(batch) and segment != self.segments[-1]:
+      # Move on past this fully consumed (and no longer written) segment
+      self._commit((self.segments[self.segments.index(segment) + 1], 0))
+      return self._read_batch(n)
+    return batch
+
+  def _commit(self, position):
+    (segment, offset) = position
+    if segment not in self.segments:
+      return
+    for old in [s for s in self.segments if s < segment]:
+      self._remove(old)
+    (self.read_segment, self.read_offset) = (segment, offset)
+    self._write_index()
+
+  def empty(self):
+    with self.lock:
+      return self.read_segment == self.segments[-1] and self.read_offset >= self.write_offset
+
+  # Replay spooled messages forever, via deliver(sink, topic, key, payload)
+  def replay(self, ready, deliver):
+    while True:
+      if self.empty():
+        time.sleep(1)
+        continue
+      with self.lock:
+        self.writer.flush()
+        batch = self._read_batch(SPOOL_REPLAY_BATCH)
+      position = None
+      for (after, (sink, topic, key, payload)) in batch:
+        if not (ready(sink) and deliver(sink, topic, key, payload)):
+          break
+        position = after
+        self.replayed += 1
+        metrics.inc('achatina_retries_total', stage='spool')
+        time.sleep(1.0 / SPOOL_REPLAY_RATE)
+      if None != position:
+        with self.lock:
+          self._commit(position)
+      if None == position or position != batch[-1][0]:
+        time.sleep(KafkaPublisher.RETRY_AFTER / 10.0)
+
+  def status(self):
+    with self.lock:
+      return {'segments': len(self.segments), 'bytes': self.total_bytes, 'spooled': self.spooled, 'replayed': self.replayed, 'evicted': self.evicted}
+
+# The shared spool (created at startup if SPOOL_DIR is set)
+spool = None
+
+#
+# Jittered exponential backoff. Each consecutive failure doubles the delay
+# (from PLUGIN_BACKOFF_MIN up to PLUGIN_BACKOFF_MAX) and the actual sleep is
+# a random point in the upper half of that. A single success resets it, so
+# recovery from a transient error is immediate.
+#
+class Backoff:
+
+  def __init__(self, minimum, maximum):
+    self.minimum = minimum
+    self.maximum = maximum
+    self.lock = threading.Lock()
+    self.delay = 0.0
+
+  def failure(self):
+    with self.lock:
+      self.delay = min(self.maximum, max(self.minimum, self.delay * 2.0))
+      return random.uniform(self.delay / 2.0, self.delay)
+
+  def success(self):
+    with self.lock:
+      self.delay = 0.0
+
+#
+# A circuit breaker for the plugin. After PLUGIN_BREAKER_THRESHOLD consecutive
+# failures it "opens" and no requests are sent for PLUGIN_BREAKER_COOLDOWN
+# seconds. Then it goes "half-open" and lets exactly one trial request
+# through. If that succeeds it "closes" again, otherwise it re-opens.
+#
+class CircuitBreaker:
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half-open'
+
+  def __init__(self, name, threshold, cooldown):
+    self.name = name
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.lock = threading.Lock()
+    self.state = CircuitBreaker.CLOSED
+    self.failures = 0
+    self.opened_at = 0.0
+    self.trial_in_flight = False
+    self.trips = 0
+
+  def _set_state(self, state):
+    if state != self.state:
+      print('achatina: circuit breaker "%s" is now %s' % (self.name, state))
+      self.state = state
+
+  # Returns 0 if a request may be sent now, else the seconds to wait first
+  def wait_time(self):
+    with self.lock:
+      if CircuitBreaker.OPEN == self.state:
+        remaining = self.opened_at + self.cooldown - time.time()
+        if remaining > 0:
+          return remaining
+        self._set_state(CircuitBreaker.HALF_OPEN)
+      if CircuitBreaker.HALF_OPEN == self.state:
+        if self.trial_in_flight:
+          return min(1.0, self.cooldown)
+        self.trial_in_flight = True
+      return 0
+
+  def success(self):
+    with self.lock:
+      self.failures = 0
+      self.trial_in_flight = False
+      self._set_state(CircuitBreaker.CLOSED)
+
+  def failure(self):
+    with self.lock:
+      self.failures += 1
+      self.trial_in_flight = False
+      if CircuitBreaker.HALF_OPEN == self.state or (CircuitBreaker.CLOSED == self.state and self.failures >= self.threshold):
+        self.opened_at = time.time()
+        self.trips += 1
+        self._set_state(CircuitBreaker.OPEN)
+
+  def status(self):
+    with self.lock:
+      return {'state': self.state, 'failures': self.failures, 'trips': self.trips}
+
+#
+# The adaptive rate controller. It paces the dispatch of frames (across all
+# cameras) at a rate that starts at the target and is adjusted about once a
+# second: multiplicatively down when the host CPU utilization (from
+# /proc/stat) is over budget or the smoothed latency the plugins report is
+# over budget, and gently back up toward the target when there is headroom.
+#
+class RateController:
+
+  ADJUST_PERIOD = 1.0
+  MIN_FPS = 0.05
+  MAX_FPS = 1000.0
+  DECREASE = 0.7
+  INCREASE = 1.1
+  LATENCY_SMOOTHING = 0.2
+
+  def __init__(self, target_fps, cpu_budget, latency_budget):
+    self.max_fps = target_fps if target_fps > 0 else RateController.MAX_FPS
+    self.cpu_budget = cpu_budget
+    self.latency_budget = latency_budget
+    self.lock = threading.Lock()
+    self.fps = self.max_fps
+    self.latency = 0.0
+    self.cpu = 0.0
+    self.observed = 0
+    self.adjusted_at = time.time()
+    self.cpu_times = self._read_cpu_times()
+
+  # Returns (total, idle) jiffies for all CPUs, or None if unavailable
+  def _read_cpu_times(self):
+    try:
+      with open('/proc/stat') as f:
+        fields = [int(x) for x in f.readline().split()[1:]]
+      return (sum(fields), fields[3] + fields[4])
+    except (IOError, ValueError, IndexError):
+      return None
+
+  def _adjust(self, now):
+    cpu_times = self._read_cpu_times()
+    if None != cpu_times and None != self.cpu_times and cpu_times[0] > self.cpu_times[0]:
+      total = cpu_times[0] - self.cpu_times[0]
+      idle = cpu_times[1] - self.cpu_times[1]
+      self.cpu = 1.0 - float(idle) / total
+    self.cpu_times = cpu_times
+    over_cpu = self.cpu > self.cpu_budget
+    over_latency = self.latency_budget > 0 and self.latency > self.latency_budget
+    if over_cpu or over_latency:
+      # Back off from the rate actually achieved (which may be far below the
+      # current limit, e.g., if the plugin itself is the bottleneck)
+      achieved = self.observed / (now - self.adjusted_at)
+      self.fps = max(RateController.MIN_FPS, min(self.fps, achieved) * RateController.DECREASE)
+    else:
+      self.fps = min(self.max_fps, self.fps * RateController.INCREASE + RateController.MIN_FPS)
+    self.observed = 0
+    self.adjusted_at = now
+    if LOG_SLEEP: print('Pacing at %0.2f fps (cpu: %0.2f, latency: %0.3f sec)' % (self.fps, self.cpu, self.latency))
+
+  # Feed in the timing reported by the plugin for one frame
+  def observe(self, cam_time, inf_time):
+    with self.lock:
+      latency = cam_time + inf_time
+      if 0 == self.latency:
+        self.latency = latency
+      else:
+        self.latency += RateController.LATENCY_SMOOTHING * (latency - self.latency)
+      self.observed += 1
+      now = time.time()
+      if now - self.adjusted_at >= RateController.ADJUST_PERIOD:
+        self._adjust(now)
+
+  # The current interval (in seconds) between frame dispatches
+  def interval(self):
+    with self.lock:
+      if self.fps >= RateController.MAX_FPS:
+        return 0.0
+      return 1.0 / self.fps
+
+  def status(self):
+    with self.lock:
+      return {'fps': round(self.fps, 3), 'cpu': round(self.cpu, 3), 'latency': round(self.latency, 3)}
+
+rate_controller = RateController(TARGET_FPS, CPU_BUDGET, LATENCY_BUDGET)
+
+#
+# Metrics, in the Prometheus text exposition format (served at GET /metrics
+# on STATUS_PORT). Counters and histograms are updated as things happen, and
+# the gauges are read from the scheduler, pipeline queues and spool whenever
+# the metrics are scraped. Label values are passed as keyword arguments.
+#
+class Histogram:
+
+  BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+  def __init__(self):
+    self.counts = [0] * len(Histogram.BUCKETS)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    for (i, bound) in enumerate(Histogram.BUCKETS):
+      if value <= bound:
+        self.counts[i] += 1
+    self.sum += value
+    self.count += 1
+
+class Metrics:
+
+  HELP = {
+    'achatina_camera_seconds': ('histogram', 'Time the plugin took to get a frame from the camera'),
+    'achatina_inference_seconds': ('histogram', 'Time the plugin took to run inference on a frame'),
+    'achatina_request_seconds': ('histogram', 'Round trip time of requests to the plugin'),
+    'achatina_serialize_seconds': ('histogram', 'Time taken to serialize a result'),
+    'achatina_publish_seconds': ('histogram', 'Time taken to hand a message to a sink'),
+    'achatina_frames_total': ('counter', 'Frames successfully received from the plugins'),
+    'achatina_errors_total': ('counter', 'Failed camera, plugin and publish operations'),
+    'achatina_retries_total': ('counter', 'Plugin requests after a failure, and messages replayed from the spool'),
+    'achatina_dropped_total': ('counter', 'Frames or messages that were not published'),
+    'achatina_inflight_requests': ('gauge', 'Requests currently in flight to each plugin'),
+    'achatina_breaker_state': ('gauge', 'Plugin circuit breaker state (0 closed, 1 half-open, 2 open)'),
+    'achatina_queue_depth': ('gauge', 'Results waiting in each pipeline queue'),
+    'achatina_pacing_fps': ('gauge', 'Current frame rate allowed by the adaptive rate controller'),
+    'achatina_spool_bytes': ('gauge', 'Bytes of messages held in the spool'),
+  }
+
+  BREAKER_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+
+  def inc(self, name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + amount
+
+  def observe(self, name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      if not key in self.histograms:
+        self.histograms[key] = Histogram()
+      self.histograms[key].observe(value)
+
+  # The gauges, as a list of (name, labels, value)
+  def _gauges(self):
+    gauges = []
+    for plugin in scheduler.plugins:
+      labels = (('plugin', plugin.url),)
+      gauges.append(('achatina_inflight_requests', labels, plugin.inflight))
+      gauges.append(('achatina_breaker_state', labels, Metrics.BREAKER_STATES[plugin.breaker.state]))
+    for (name, q) in sorted(pipeline_queues.items()):
+      gauges.append(('achatina_queue_depth', (('queue', name),), q.qsize()))
+    gauges.append(('achatina_pacing_fps', (), rate_controller.fps))
+    if None != spool:
+      gauges.append(('achatina_spool_bytes', (), spool.total_bytes))
+    return gauges
+
+  def render(self):
+    samples = {}
+    with self.lock:
+      for ((name, labels), value) in self.counters.items():
+        samples.setdefault(name, []).append((name, labels, value))
+      for ((name, labels), h) in self.histograms.items():
+        series = samples.setdefault(name, [])
+        for (bound, count) in zip(Histogram.BUCKETS, h.counts):
+          series.append((name + '_bucket', labels + (('le', '%g' % bound),), count))
+        series.append((name + '_bucket', labels + (('le', '+Inf'),), h.count))
+        series.append((name + '_sum', labels, h.sum))
+        series.append((name + '_count', labels, h.count))
+    for (name, labels, value) in self._gauges():
+      samples.setdefault(name, []).append((name, labels, value))
+    lines = []
+    for name in sorted(samples):
+      (kind, text) = Metrics.HELP[name]
+      lines.append('# HELP %s %s' % (name, text))
+      lines.append('# TYPE %s %s' % (name, kind))
+      for (series, labels, value) in samples[name]:
+        if 0 == len(labels):
+          lines.append('%s %s' % (series, repr(float(value))))
+        else:
+          label_text = ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (k, v) in labels])
+          lines.append('%s{%s} %s' % (series, label_text, repr(float(value))))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+metrics = Metrics()
+
+# The pipeline queues, by name (for the queue depth gauges)
+pipeline_queues = {}
+
+#
+# The scheduler hands out (camera, plugin) pairs to the fetchers. Each camera
+# has at most camera_inflight requests in flight (PLUGIN_INFLIGHT, so one
+# camera alone can keep all of the fetchers busy), and among the cameras that
+# are due (per their target rate) and below that limit, the one that has
+# waited longest goes first, so a slow camera cannot starve the others. Each
+# frame goes to the plugin expected to finish soonest (by in-flight count and
+# smoothed latency), skipping plugins that are backing off or whose circuit
+# breaker is open. Camera errors (4xx responses) back off just that camera;
+# plugin errors back off the plugin.
+#
+class Camera:
+
+  def __init__(self, url, rate):
+    self.url = url
+    self.rate = rate
+    self.interval = (1.0 / rate) if rate > 0 else 0.0
+    self.backoff = Backoff(PLUGIN_BACKOFF_MIN, PLUGIN_BACKOFF_MAX)
+    self.next_due = 0.0
+    self.inflight = 0
+    self.frames = 0
+    self.errors = 0
+
+  def status(self):
+    return {'url': self.url, 'rate': self.rate, 'inflight': self.inflight, 'frames': self.frames, 'errors': self.errors}
+
+class Plugin:
+
+  def __init__(self, url):
+    self.url = url
+    self.breaker = CircuitBreaker(url, PLUGIN_BREAKER_THRESHOLD, PLUGIN_BREAKER_COOLDOWN)
+    self.backoff = Backoff(PLUGIN_BACKOFF_MIN, PLUGIN_BACKOFF_MAX)
+    self.retry_at = 0.0
+    self.inflight = 0
+    self.latency = 0.0
+    self.requests = 0
+
+  # Estimated time until a new request sent to this plugin would complete
+  def load(self):
+    return ((self.inflight + 1) * self.latency, self.inflight)
+
+  def status(self):
+    status = self.breaker.status()
+    status.update({'url': self.url, 'inflight': self.inflight, 'latency': round(self.latency, 3), 'requests': self.requests})
+    return status
+
+class Scheduler:
+
+  LATENCY_SMOOTHING = 0.2
+
+  def __init__(self, cameras, plugins, camera_inflight=1):
+    self.cameras = cameras
+    self.plugins = plugins
+    self.camera_inflight = camera_inflight
+    self.cond = threading.Condition()
+    self.next_dispatch = 0.0
+
+  # Returns (plugin, 0) for the least-loaded usable plugin, or (None, wait)
+  def _pick_plugin(self, now):
+    wait = PLUGIN_BREAKER_COOLDOWN
+    for plugin in sorted(self.plugins, key=Plugin.load):
+      if plugin.retry_at > now:
+        wait = min(wait, plugin.retry_at - now)
+        continue
+      breaker_wait = plugin.breaker.wait_time()
+      if 0 == breaker_wait:
+        return (plugin, 0)
+      wait = min(wait, breaker_wait)
+    return (None, wait)
+
+  # Block until pacing allows, some camera is due and some plugin can take it
+  def next_job(self):
+    with self.cond:
+      while True:
+        now = time.time()
+        if self.next_dispatch > now:
+          self.cond.wait(self.next_dispatch - now)
+          continue
+        ready = [c for c in self.cameras if c.inflight < self.camera_inflight]
+        if 0 == len(ready):
+          self.cond.wait()
           continue
-      if LOG_DETAIL: print('Successful response received!')
-      j = r.json()
-      if LOG_DETAIL or LOG_STATS:
-        d = datetime.fromtimestamp(j['detect']['date']).strftime('%Y-%m-%d %H:%M:%S')
-        print('Date: %s, Cam: %0.2f sec, Yolo: %0.2f msec.' % (d, j['detect']['cam-time'], j['detect']['inf-time'] * 1000.0))
-
-      # Add info into the JSON about this example
-      j['source'] = 'achatina (with plugin "' + ACHATINA_PLUGIN + '")'
-      j['source-url'] = ACHATINA_URL
-      if '' != NODE:
-        j['device-id'] = NODE
+        camera = min(ready, key=lambda c: c.next_due)
+        if camera.next_due > now:
+          self.cond.wait(camera.next_due - now)
+          continue
+        (plugin, wait) = self._pick_plugin(now)
+        if None == plugin:
+          self.cond.wait(wait)
+          continue
+        camera.inflight += 1
+        camera.next_due = now + camera.interval
+        self.next_dispatch = now + rate_controller.interval()
+        plugin.inflight += 1
+        plugin.requests += 1
+        if plugin.backoff.delay > 0 or camera.backoff.delay > 0:
+          metrics.inc('achatina_retries_total', stage='plugin')
+        return (camera, plugin)
+
+  # Report the outcome of a job ("error" is None, 'camera' or 'plugin')
+  def done(self, camera, plugin, elapsed, error=None):
+    with self.cond:
+      now = time.time()
+      camera.inflight -= 1
+      plugin.inflight -= 1
+      if None == error:
+        camera.frames += 1
+        camera.backoff.success()
+        plugin.backoff.success()
+        plugin.breaker.success()
+        if 0 == plugin.latency:
+          plugin.latency = elapsed
+        else:
+          plugin.latency += Scheduler.LATENCY_SMOOTHING * (elapsed - plugin.latency)
+      elif 'camera' == error:
+        camera.errors += 1
+        camera.next_due = max(camera.next_due, now + camera.backoff.failure())
+        plugin.breaker.success()
       else:
-        j['device-id'] = '** NO DEVICE ID ** KAFKA PUBLISHING DISABLED **'
+        plugin.breaker.failure()
+        plugin.retry_at = now + plugin.backoff.failure()
+      self.cond.notify_all()
+
+  def status(self):
+    with self.cond:
+      return {'cameras': [c.status() for c in self.cameras], 'plugins': [p.status() for p in self.plugins]}
+
+scheduler = Scheduler(
+  [Camera(url, rate) for (url, rate) in zip(CAMERA_URLS, CAMERA_TARGET_RATES)],
+  [Plugin(url) for url in PLUGIN_BASE_URLS],
+  max(1, PLUGIN_INFLIGHT))
+
+# One pooled, keep-alive HTTP session to the plugins (shared by all fetchers)
+plugin_session = requests.Session()
+plugin_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=len(PLUGIN_BASE_URLS), pool_maxsize=max(1, PLUGIN_INFLIGHT)))
+
+# In split mode the image is requested as raw JPEG bytes alongside the JSON,
+# in a multipart response, rather than as base64 within it (or not at all,
+# and so not even drawn, if images are never published)
+PLUGIN_KIND = ''
+if 'split' == PUBLISH_MODE:
+  PLUGIN_KIND = 'multipart' if (IMAGE_EVERY_N > 0 or IMAGE_ON_CHANGE) else 'json'
+
+# Split a multipart response body into (the bodies of) its parts. Raises
+# ValueError if the content type has no boundary.
+def multipart_parts(content_type, body):
+  if not 'boundary=' in content_type:
+    raise ValueError('multipart response without a boundary')
+  boundary = b'--' + content_type.split('boundary=', 1)[1].strip('"').encode('ascii')
+  return [part.partition(b'\r\n\r\n')[2][:-2] for part in body.split(boundary)[1:-1]]
+
+# And another to the cameras (only used in push mode)
+camera_session = requests.Session()
+camera_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=len(CAMERA_URLS), pool_maxsize=max(1, PLUGIN_INFLIGHT)))
 
-      # Push JSON to a file (so we can publish it, since it overflows the CLI)
-      with open(TEMP_FILE, 'w') as temp_file:
-        json.dump(j, temp_file)
+# Pull one frame from a camera (for push mode). Returns (jpg binary, seconds
+# taken), or None on failure.
+def fetch_frame(camera):
+  start = time.time()
+  try:
+    r = camera_session.get(camera.url, timeout=(PLUGIN_CONNECT_TIMEOUT, PLUGIN_READ_TIMEOUT))
+    if (r.status_code > 299):
+      raise requests.RequestException('status ' + str(r.status_code))
+  except requests.RequestException as e:
+    print('ERROR: Camera request failed: ' + str(e))
+    return None
+  return (r.content, time.time() - start)
 
-      # Publish to kafka if a device ID and appropriate creds were provided
-      if '' != NODE and '' != KAFKA_PUB_COMMAND:
-        if LOG_DETAIL: print('--> Kafka: ' + KAFKA_PUB_COMMAND + TEMP_FILE)
-        discard = subprocess.run(KAFKA_PUB_COMMAND + TEMP_FILE, shell=True)
+# Fetch one result from a plugin REST service (returns None on failure, or
+# when the plugin suppressed an unchanged frame). However it ends (even with
+# an exception), the job is reported done to the scheduler, so its camera and
+# plugin are never left holding it. Anything unexpected counts as a plugin
+# error.
+def fetch_result():
+  (camera, plugin) = scheduler.next_job()
+  start = time.time()
+  error = 'plugin'
+  try:
+    url = plugin.url + '/detect?url=' + urllib.parse.quote(camera.url)
+    if '' != PLUGIN_KIND:
+      url += '&kind=' + PLUGIN_KIND
+    if GATE_THRESHOLD > 0:
+      url += '&gate=%g&gatemode=%s&gatemaxage=%g' % (GATE_THRESHOLD, GATE_MODE, GATE_MAX_AGE)
+    frame = None
+    if PUSH_FRAMES:
+      frame = fetch_frame(camera)
+      if None == frame:
+        error = 'camera'
+        metrics.inc('achatina_errors_total', stage='camera')
+        return None
+      url += '&camtime=%f' % frame[1]
+    if LOG_DETAIL:
+      print('\nInitiating a request...')
+      print('--> URL: ' + url)
+    start = time.time()
+    try:
+      if None != frame:
+        r = plugin_session.post(url, data=frame[0], headers={'Content-Type': 'image/jpeg'}, timeout=(PLUGIN_CONNECT_TIMEOUT, PLUGIN_READ_TIMEOUT))
+      else:
+        r = plugin_session.get(url, timeout=(PLUGIN_CONNECT_TIMEOUT, PLUGIN_READ_TIMEOUT))
+      if (r.status_code > 299):
+        print('ERROR: Plugin request failed: ' + str(r.status_code))
+        error = 'plugin' if r.status_code > 499 else 'camera'
+        metrics.inc('achatina_errors_total', stage=error)
+        return None
+      if 204 == r.status_code:
+        if LOG_DETAIL: print('Unchanged frame suppressed by the plugin.')
+        error = None
+        metrics.inc('achatina_dropped_total', reason='suppressed')
+        return None
+      if r.headers.get('Content-Type', '').startswith('multipart/'):
+        (content, image) = multipart_parts(r.headers['Content-Type'], r.content)
+        j = decode_json(content)
+        j['detect']['image'] = image
       else:
-        if LOG_DETAIL: print('--> Kafka: *** PUBLICATION DISABLED **')
-
-      # (Optionally) publish to the debug topic (with subscribe info if approp)
-      if '' != MQTT_PUB_TOPIC:
-        # Did we publish this stuff to kafka?
-        if '' != KAFKA_PUB_COMMAND:
-          # Provide info to the caller about how to subscribe to this kafka stream
-          j['kafka-sub'] = 'kafkacat -C -b ' + KAFKA_BROKER_URLS + ' -X api.version.request=true -X security.protocol=sasl_ssl -X sasl.mechanisms=PLAIN -X sasl.username=token -X sasl.password="' + KAFKA_API_KEY + '" -t ' + KAFKA_PUB_TOPIC
-          # Rewrite the file with the updated JSON
-          with open(TEMP_FILE, 'w') as temp_file:
-            json.dump(j, temp_file)
-        if LOG_DETAIL: print('--> MQTT: ' + MQTT_PUB_COMMAND + TEMP_FILE)
-        discard = subprocess.run(MQTT_PUB_COMMAND + TEMP_FILE, shell=True)
-
-    except:
-      if LOG_EXCEPT: print('*** Exception in main achatina loop! ***')
+        j = decode_json(r.content)
+      (cam_time, inf_time) = (j['detect']['cam-time'], j['detect']['inf-time'])
+    except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+      print('ERROR: Plugin request failed: ' + str(e))
+      metrics.inc('achatina_errors_total', stage='plugin')
+      return None
+    if LOG_DETAIL: print('Successful response received!')
+    error = None
+  finally:
+    elapsed = time.time() - start
+    scheduler.done(camera, plugin, elapsed, error)
+  rate_controller.observe(cam_time, inf_time)
+  metrics.inc('achatina_frames_total', camera=camera.url)
+  metrics.observe('achatina_request_seconds', elapsed, plugin=plugin.url)
+  metrics.observe('achatina_camera_seconds', j['detect']['cam-time'], camera=camera.url)
+  if not j['detect'].get('gated', False) and not j['detect'].get('cached', False):
+    metrics.observe('achatina_inference_seconds', j['detect']['inf-time'], plugin=plugin.url)
+  j['input-url'] = camera.url
+  return j
+
+# Log the timing information the plugin reported for this result
+def log_result(j):
+  if LOG_DETAIL or LOG_STATS:
+    d = datetime.fromtimestamp(j['detect']['date']).strftime('%Y-%m-%d %H:%M:%S')
+    print('Date: %s, Cam: %0.2f sec, Yolo: %0.2f msec.' % (d, j['detect']['cam-time'], j['detect']['inf-time'] * 1000.0))
+
+#
+# In event mode each camera's detections are tracked from frame to frame.
+# Detections are matched to the tracked objects of the same class, greedily
+# by box overlap (intersection-over-union of at least EVENT_MATCH_IOU). An
+# unmatched detection "appear"s as a new object, an object that stays
+# unmatched for EVENT_MISS_FRAMES frames in a row "disappear"s, and a matched
+# object whose box overlaps less than EVENT_CHANGE_IOU with the box last
+# reported for it has "changed" (i.e., moved or resized). Each event gives
+# the object's "track-id", "eclass", "confidence", "cx", "cy", "w" and "h".
+#
+
+# Intersection-over-union of two detail dicts (with "cx", "cy", "w" and "h")
+def iou(a, b):
+  w = min(a['cx'] + a['w'] / 2, b['cx'] + b['w'] / 2) - max(a['cx'] - a['w'] / 2, b['cx'] - b['w'] / 2)
+  h = min(a['cy'] + a['h'] / 2, b['cy'] + b['h'] / 2) - max(a['cy'] - a['h'] / 2, b['cy'] - b['h'] / 2)
+  if w <= 0 or h <= 0:
+    return 0.0
+  overlap = float(w * h)
+  return overlap / (a['w'] * a['h'] + b['w'] * b['h'] - overlap)
+
+class Tracker:
+
+  def __init__(self, match_iou, change_iou, miss_frames, keyframe_interval):
+    self.match_iou = match_iou
+    self.change_iou = change_iou
+    self.miss_frames = miss_frames
+    self.keyframe_interval = keyframe_interval
+    self.tracks = []
+    self.next_id = 1
+    self.keyframe_at = 0
+
+  def _event(self, event, track):
+    e = {'event': event, 'track-id': track['track-id'], 'eclass': track['eclass']}
+    e.update(track['reported'])
+    return e
+
+  # Update the tracks with one frame's entities. Returns (events, keyframe).
+  def update(self, entities, now):
+    detections = [(e['eclass'], d) for e in entities for d in e['details']]
+    pairs = []
+    for (t, track) in enumerate(self.tracks):
+      for (k, (eclass, detail)) in enumerate(detections):
+        if eclass == track['eclass']:
+          overlap = iou(track['detail'], detail)
+          if overlap >= self.match_iou:
+            pairs.append((overlap, t, k))
+    pairs.sort(reverse=True)
+    matched_tracks = set()
+    matched_detections = set()
+    events = []
+    for (overlap, t, k) in pairs:
+      if t in matched_tracks or k in matched_detections:
+        continue
+      matched_tracks.add(t)
+      matched_detections.add(k)
+      track = self.tracks[t]
+      track['detail'] = detections[k][1]
+      track['missed'] = 0
+      if iou(track['reported'], track['detail']) < self.change_iou:
+        track['reported'] = track['detail']
+        events.append(self._event('changed', track))
+    tracks = []
+    for (t, track) in enumerate(self.tracks):
+      if not t in matched_tracks:
+        track['missed'] += 1
+        if track['missed'] >= self.miss_frames:
+          track['reported'] = track['detail']
+          events.append(self._event('disappear', track))
+          continue
+      tracks.append(track)
+    for (k, (eclass, detail)) in enumerate(detections):
+      if not k in matched_detections:
+        track = {'track-id': self.next_id, 'eclass': eclass, 'detail': detail, 'reported': detail, 'missed': 0}
+        self.next_id += 1
+        tracks.append(track)
+        events.append(self._event('appear', track))
+    self.tracks = tracks
+    keyframe = now - self.keyframe_at >= self.keyframe_interval
+    if keyframe:
+      self.keyframe_at = now
+    return (events, keyframe)
+
+# Per-camera trackers (for event mode)
+trackers = {}
+
+# Add the "events" and "keyframe" fields to the result (returns False if
+# there is nothing worth publishing)
+def track_events(j):
+  camera = j.get('input-url', '')
+  if not camera in trackers:
+    trackers[camera] = Tracker(EVENT_MATCH_IOU, EVENT_CHANGE_IOU, EVENT_MISS_FRAMES, EVENT_KEYFRAME_INTERVAL)
+  (events, keyframe) = trackers[camera].update(j['detect'].get('entities', []), time.time())
+  j['events'] = events
+  j['keyframe'] = keyframe
+  return keyframe or len(events) > 0
+
+#
+# In "split" PUBLISH_MODE the annotated image is removed from the JSON, which
+# then carries only metadata plus a unique "frame-id". The image itself is
+# published separately as raw JPEG bytes (no base64), on the MQTT topic
+# "<MQTT_IMAGE_TOPIC>/<frame-id>" and on KAFKA_IMAGE_TOPIC with the frame-id
+# as the message key. Images are only sent for every IMAGE_EVERY_N-th frame
+# from each camera (0 means never), and, if IMAGE_ON_CHANGE is "true", also
+# whenever the set of detected entities differs from the previous frame's.
+# The "image-sent" field says whether this frame's image was published.
+#
+
+# Per-camera state for image decimation: (frame count, entity signature)
+image_state = {}
+
+def entity_signature(entities):
+  return sorted([(e['eclass'], len(e['details'])) for e in entities])
+
+# Split the image out of the result (returns the JPEG bytes, or None). The
+# image is base64, or already bytes if it came in a multipart response.
+def split_image(j):
+  j['frame-id'] = uuid.uuid4().hex
+  image = j['detect'].pop('image', None)
+  camera = j.get('input-url', '')
+  signature = entity_signature(j['detect'].get('entities', []))
+  (frames, last_signature) = image_state.get(camera, (0, None))
+  image_state[camera] = (frames + 1, signature)
+  send = (IMAGE_EVERY_N > 0 and 0 == frames % IMAGE_EVERY_N) or (IMAGE_ON_CHANGE and signature != last_signature)
+  j['image-sent'] = send and None != image
+  if not j['image-sent']:
+    return None
+  if isinstance(image, bytes):
+    return image
+  return base64.b64decode(image)
+
+# Can this sink take messages right now?
+def sink_ready(sink):
+  if 'mqtt' == sink and None != mqtt_publisher:
+    return mqtt_publisher.connected
+  if 'kafka' == sink and None != kafka_publisher:
+    return kafka_publisher.healthy()
+  return True
+
+# Hand one message to a sink (returns False if it could not be handed over)
+def deliver(sink, topic, key, payload):
+  if 'mqtt' == sink:
+    if None != mqtt_publisher:
+      return mqtt_publisher.publish(topic, payload)
+    return 0 == subprocess.run(MQTT_PUB_COMMAND + topic, shell=True, input=payload).returncode
+  else:
+    if None != kafka_publisher:
+      return kafka_publisher.publish(topic, payload, key)
+    # (reading the file /dev/stdin makes kafkacat send it all as one message)
+    command = KAFKA_PUB_COMMAND + topic
+    if None != key:
+      command += ' -k ' + key.decode('utf-8')
+    return 0 == subprocess.run(command + ' /dev/stdin', shell=True, input=payload).returncode
+
+# Publish one message, spooling it if the sink cannot take it right now
+def publish_message(sink, topic, key, payload):
+  if sink_ready(sink):
+    start = time.time()
+    delivered = deliver(sink, topic, key, payload)
+    metrics.observe('achatina_publish_seconds', time.time() - start, sink=sink)
+    if delivered:
+      return
+  metrics.inc('achatina_errors_total', stage='publish')
+  if None != spool:
+    if LOG_DETAIL: print('--> %s: spooling message for %s' % (sink, topic))
+    spool.append(sink, topic, key, payload)
+  else:
+    if LOG_DETAIL: print('--> %s: message for %s was dropped' % (sink, topic))
+    metrics.inc('achatina_dropped_total', reason='undeliverable')
+
+# Add info into the JSON about this example, then publish it
+def publish_result(j):
+
+  # In event mode, only publish changes (and the periodic keyframes)
+  if EVENT_MODE and not track_events(j):
+    if LOG_DETAIL: print('--> No events, nothing to publish.')
+    metrics.inc('achatina_dropped_total', reason='no-events')
+    return
+
+  j['source'] = 'achatina (with plugin "' + ACHATINA_PLUGIN + '")'
+  j['source-url'] = ACHATINA_URL
+  if '' != NODE:
+    j['device-id'] = NODE
+  else:
+    j['device-id'] = '** NO DEVICE ID ** KAFKA PUBLISHING DISABLED **'
+
+  # Separate the image from the metadata (if configured to do that)
+  image = None
+  frame_id = None
+  if 'split' == PUBLISH_MODE:
+    image = split_image(j)
+    frame_id = j['frame-id']
+
+  # Serialize once (all of the sinks below share this payload)
+  start = time.time()
+  payload = encode_json(j)
+  metrics.observe('achatina_serialize_seconds', time.time() - start)
+
+  # Publish to kafka if a device ID and appropriate creds were provided
+  if '' != NODE and '' != KAFKA_PUB_COMMAND:
+    if LOG_DETAIL: print('--> Kafka: ' + KAFKA_PUB_TOPIC)
+    key = frame_id.encode('utf-8') if None != frame_id else None
+    publish_message('kafka', KAFKA_PUB_TOPIC, key, payload)
+    if None != image:
+      publish_message('kafka', KAFKA_IMAGE_TOPIC, key, image)
+  else:
+    if LOG_DETAIL: print('--> Kafka: *** PUBLICATION DISABLED **')
+
+  # (Optionally) publish to the debug topic (with subscribe info if approp)
+  if '' != MQTT_PUB_TOPIC:
+    # Did we publish this stuff to kafka?
+    if '' != KAFKA_PUB_COMMAND:
+      # Provide info to the caller about how to subscribe to this kafka stream
+      kafka_sub = 'kafkacat -C -b ' + KAFKA_BROKER_URLS + ' -X api.version.request=true -X security.protocol=sasl_ssl -X sasl.mechanisms=PLAIN -X sasl.username=token -X sasl.password="' + KAFKA_API_KEY + '" -t ' + KAFKA_PUB_TOPIC
+      payload = add_json_fields(payload, {'kafka-sub': kafka_sub})
+    if LOG_DETAIL: print('--> MQTT: ' + MQTT_PUB_TOPIC)
+    publish_message('mqtt', MQTT_PUB_TOPIC, None, payload)
+    if None != image:
+      publish_message('mqtt', MQTT_IMAGE_TOPIC + '/' + frame_id, None, image)
+
+#
+# A small HTTP status server (on STATUS_PORT) for monitoring. GET /status
+# returns the camera and plugin (incl. circuit breaker) state, and the
+# publisher counters. GET /metrics returns the metrics (see above).
+#
+def get_status():
+  status = scheduler.status()
+  status['pacing'] = rate_controller.status()
+  if None != mqtt_publisher:
+    status['mqtt'] = {'connected': mqtt_publisher.connected, 'published': mqtt_publisher.published, 'refused': mqtt_publisher.refused}
+  if None != kafka_publisher:
+    status['kafka'] = {'sent': kafka_publisher.sent, 'delivered': kafka_publisher.delivered, 'failed': kafka_publisher.failed}
+  if None != spool:
+    status['spool'] = spool.status()
+  return status
+
+class StatusHandler(BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    content_type = 'application/json'
+    if '/status' == self.path:
+      body = encode_json(get_status()) + b'\n'
+      self.send_response(200)
+    elif '/metrics' == self.path:
+      body = metrics.render()
+      content_type = 'text/plain; version=0.0.4'
+      self.send_response(200)
+    else:
+      body = b'{"error": "not found"}\n'
+      self.send_response(404)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if LOG_DETAIL: BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def start_status_server():
+  server = ThreadingHTTPServer(('0.0.0.0', STATUS_PORT), StatusHandler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, name='status', daemon=True).start()
+
+# The original, strictly serial, loop: fetch (paced), log, publish, repeat
+def serial_loop():
+  while True:
+    try:
+      j = fetch_result()
+      if None != j:
+        log_result(j)
+        publish_result(j)
+    except Exception as e:
+      if LOG_EXCEPT: print('*** Exception in main achatina loop! *** (%s)' % str(e))
+      time.sleep(1)
+
+#
+# The pipelined loop. PLUGIN_INFLIGHT fetcher threads each keep one request
+# outstanding at the plugin, handing results to a single publisher thread
+# through a bounded queue, which in turn hands them to a logger thread. A
+# full publish queue blocks the fetchers (so memory stays bounded) while a
+# full log queue just drops log lines (so logging never stalls publishing).
+#
+
+# Stage 1: keep one plugin request in flight, forever
+def fetch_stage(publish_queue):
+  while True:
+    try:
+      j = fetch_result()
+      if None != j:
+        publish_queue.put(j)
+    except Exception as e:
+      if LOG_EXCEPT: print('*** Exception in achatina fetch stage! *** (%s)' % str(e))
+      time.sleep(1)
+
+# Stage 2: publish each result as it arrives
+def publish_stage(publish_queue, log_queue):
+  while True:
+    j = publish_queue.get()
+    try:
+      publish_result(j)
+    except Exception as e:
+      if LOG_EXCEPT: print('*** Exception in achatina publish stage! *** (%s)' % str(e))
+    try:
+      log_queue.put_nowait(j['detect'])
+    except queue.Full:
       pass
 
-    # Pause briefly (to not hog the CPU too much on small machines)
-    if LOG_SLEEP: print('Sleeping for ' + str(SLEEP_BETWEEN_CALLS) + ' seconds...')
-    time.sleep(SLEEP_BETWEEN_CALLS)
+# Stage 3: log the timing information (off the publishing path)
+def log_stage(log_queue):
+  while True:
+    detect = log_queue.get()
+    try:
+      log_result({'detect': detect})
+    except Exception as e:
+      if LOG_EXCEPT: print('*** Exception in achatina log stage! *** (%s)' % str(e))
+
+def pipelined_loop():
+  publish_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+  log_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+  pipeline_queues['publish'] = publish_queue
+  pipeline_queues['log'] = log_queue
+  for i in range(PLUGIN_INFLIGHT):
+    threading.Thread(target=fetch_stage, args=(publish_queue,), name='fetch-%d' % i, daemon=True).start()
+  threading.Thread(target=publish_stage, args=(publish_queue, log_queue), name='publish', daemon=True).start()
+  threading.Thread(target=log_stage, args=(log_queue,), name='log', daemon=True).start()
+  while True:
+    time.sleep(60)
+
+if __name__ == '__main__':
+  if STATUS_PORT > 0:
+    start_status_server()
+  if None != mqtt and '' != MQTT_PUB_TOPIC:
+    mqtt_publisher = MqttPublisher(MQTT_BROKER_URL, MQTT_BROKER_PORT, qos=MQTT_QOS, max_inflight=MQTT_MAX_INFLIGHT, max_queued=MQTT_MAX_QUEUED, keepalive=MQTT_KEEPALIVE)
+  if '' != NODE and '' != KAFKA_PUB_COMMAND and (None != kafka or 'kafka-python' != KAFKA_TRANSPORT):
+    transport = make_kafka_transport(KAFKA_BROKER_URLS, KAFKA_API_KEY, KAFKA_LINGER_MS, KAFKA_BATCH_SIZE, KAFKA_COMPRESSION)
+    kafka_publisher = KafkaPublisher(transport, on_failure=lambda *message: None != spool and spool.append(*message))
+  if '' != SPOOL_DIR:
+    spool = Spool(SPOOL_DIR, SPOOL_MAX_BYTES, SPOOL_MAX_AGE, SPOOL_SEGMENT_BYTES)
+    threading.Thread(target=spool.replay, args=(sink_ready, deliver), name='spool', daemon=True).start()
+  if PLUGIN_INFLIGHT > 0:
+    pipelined_loop()
+  else:
+    serial_loop()
@@ -0,0 +1,278 @@
+#
+# achatina benchmark
+#
+# Runs achatina end-to-end on this host, with no cameras, no darknet, no
+# OpenVINO and no brokers needed:
+#   - restcam.py serves a corpus of JPEGs (in place of a camera)
+#   - the real plugin code runs against a stub detector (stubs/libdarknet.so
+#     for cpu-only and cuda, stubs/openvino for openvino) whose latency and
+#     number of detections are configurable
+#   - broker.py stands in for the MQTT broker and the Kafka broker (achatina
+#     uses benchkafka.py as its Kafka transport)
+# and then reports the throughput and the p50/p95/p99 latencies of each
+# stage. See the Makefile in this directory for the usual ways to run it.
+#
+# Written for the achatina project.
+#
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+import broker
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, 'stubs')
+DEFAULT_CORPUS = [
+  os.path.join(TOP_DIR, 'shared', 'restcam', 'mock.jpg'),
+  os.path.join(TOP_DIR, 'shared', 'monitor', 'dummy_detect.jpg'),
+]
+MQTT_TOPIC = '/detect'
+KAFKA_TOPIC = 'bench'
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='Benchmark achatina end-to-end with stub cameras, detectors and brokers.')
+  parser.add_argument('--plugin', default='cpu-only', choices=['cpu-only', 'cuda', 'openvino'])
+  parser.add_argument('--duration', type=float, default=30.0, help='seconds to measure (default 30)')
+  parser.add_argument('--warmup', type=float, default=5.0, help='seconds to run before measuring (default 5)')
+  parser.add_argument('--cameras', type=int, default=1, help='number of (mock) cameras (default 1)')
+  parser.add_argument('--camera-latency-ms', type=float, default=0.0, help='mock camera response delay (default 0)')
+  parser.add_argument('--latency-ms', type=int, default=50, help='stub detector inference time (default 50)')
+  parser.add_argument('--jitter-ms', type=int, default=0, help='random extra stub inference time (default 0)')
+  parser.add_argument('--detections', type=int, default=3, help='detections per frame from the stub (default 3)')
+  parser.add_argument('--corpus', nargs='+', default=DEFAULT_CORPUS, help='JPEG files and/or directories to serve')
+  parser.add_argument('--no-kafka', action='store_true', help='do not publish to the Kafka stand-in')
+  parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='extra achatina (and plugin) configuration, e.g., PLUGIN_INFLIGHT=2')
+  parser.add_argument('--port', type=int, default=18500, help='first of 5 local ports to use (default 18500)')
+  parser.add_argument('--json', metavar='FILE', help='also write the results to this file as JSON')
+  return parser.parse_args()
+
+# Start a subprocess with its output going to a log file
+def start(name, command, env, cwd, log_dir):
+  log = open(os.path.join(log_dir, name + '.log'), 'wb')
+  full_env = dict(os.environ)
+  full_env.update(env)
+  full_env['PYTHONUNBUFFERED'] = '1'
+  return subprocess.Popen(command, env=full_env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_for(url, processes, timeout=60.0):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    for (name, process) in processes:
+      if None != process.poll():
+        raise RuntimeError('%s exited (status %d) during start up' % (name, process.returncode))
+    try:
+      if requests.get(url, timeout=5).status_code < 300:
+        return
+    except requests.RequestException:
+      pass
+    time.sleep(0.25)
+  raise RuntimeError('timed out waiting for ' + url)
+
+def plugin_command(plugin):
+  if 'openvino' == plugin:
+    script = os.path.join(TOP_DIR, 'plugins', 'openvino', 'openvinoyolo.py')
+    return [sys.executable, script, 'stub.xml', 'stub.bin', 'coco.names']
+  library = os.path.join(STUBS_DIR, 'libdarknet.so')
+  if not os.path.exists(library):
+    raise RuntimeError('%s is missing (run "make stub" in %s)' % (library, BENCH_DIR))
+  script = os.path.join(TOP_DIR, 'plugins', plugin, 'darknet.py')
+  return [sys.executable, script, 'stub.cfg', 'stub.weights', 'stub.data']
+
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+# Parse the Prometheus text format into {(name, ((label, value), ...)): value}
+def parse_metrics(text):
+  samples = {}
+  for line in text.splitlines():
+    if '' == line or line.startswith('#'):
+      continue
+    (series, value) = line.rsplit(' ', 1)
+    labels = ()
+    if '{' in series:
+      (series, label_text) = series[:-1].split('{', 1)
+      labels = tuple(sorted(LABEL.findall(label_text)))
+    samples[(series, labels)] = float(value)
+  return samples
+
+def scrape(port):
+  return parse_metrics(requests.get('http://127.0.0.1:%d/metrics' % port, timeout=5).text)
+
+# Estimate quantiles of a histogram from its bucket count deltas (as the
+# Prometheus histogram_quantile() function does, interpolating linearly)
+def histogram_quantiles(before, after, name, match, quantiles):
+  buckets = {}
+  for ((series, labels), value) in after.items():
+    if series != name + '_bucket':
+      continue
+    others = dict([(k, v) for (k, v) in labels if 'le' != k])
+    if any([others.get(k) != v for (k, v) in match.items()]):
+      continue
+    le = dict(labels)['le']
+    bound = float('inf') if '+Inf' == le else float(le)
+    buckets[bound] = buckets.get(bound, 0.0) + value - before.get((series, labels), 0.0)
+  bounds = sorted(buckets)
+  if 0 == len(bounds) or 0 == buckets[bounds[-1]]:
+    return None
+  total = buckets[bounds[-1]]
+  results = []
+  for q in quantiles:
+    rank = q * total
+    lower = 0.0
+    previous = 0.0
+    for bound in bounds:
+      if buckets[bound] >= rank:
+        if float('inf') == bound:
+          results.append(lower)
+        else:
+          fraction = (rank - previous) / (buckets[bound] - previous) if buckets[bound] > previous else 0.0
+          results.append(lower + (bound - lower) * fraction)
+        break
+      lower = bound
+      previous = buckets[bound]
+  return (results, int(total))
+
+def percentiles(values, quantiles):
+  if 0 == len(values):
+    return None
+  ordered = sorted(values)
+  return ([ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in quantiles], len(ordered))
+
+def main():
+  args = parse_args()
+  quantiles = [0.5, 0.95, 0.99]
+  log_dir = tempfile.mkdtemp(prefix='achatina-bench-')
+  (camera_port, plugin_port, mqtt_port, kafka_port, status_port) = range(args.port, args.port + 5)
+
+  mqtt_recorder = broker.Recorder(MQTT_TOPIC)
+  kafka_recorder = broker.Recorder(KAFKA_TOPIC)
+  broker.MqttBroker(mqtt_port, mqtt_recorder).start()
+  broker.KafkaBroker(kafka_port, kafka_recorder).start()
+
+  stub_env = {
+    'STUB_LATENCY_MS': str(args.latency_ms),
+    'STUB_JITTER_MS': str(args.jitter_ms),
+    'STUB_DETECTIONS': str(args.detections),
+  }
+  extra_env = dict([e.split('=', 1) for e in args.env])
+  processes = []
+  try:
+    camera = start('restcam', [sys.executable, os.path.join(BENCH_DIR, 'restcam.py'), str(camera_port), str(args.camera_latency_ms)] + args.corpus, {}, BENCH_DIR, log_dir)
+    processes.append(('restcam', camera))
+
+    plugin_env = dict(stub_env)
+    plugin_env.update({
+      'FLASK_PORT': str(plugin_port),
+      'LOGO_IMAGE': os.path.join(TOP_DIR, 'plugins', args.plugin, 'logo.png'),
+      'DARKNET_LIB': os.path.join(STUBS_DIR, 'libdarknet.so'),
+      'PYTHONPATH': STUBS_DIR,
+      # (the corpus repeats, which a real camera does not, so frames are not
+      # to be answered from the plugin's output cache)
+      'OUTPUT_CACHE_SIZE': '0',
+    })
+    plugin_env.update(extra_env)
+    plugin = start('plugin', plugin_command(args.plugin), plugin_env, STUBS_DIR, log_dir)
+    processes.append(('plugin', plugin))
+    camera_url = 'http://127.0.0.1:%d/' % camera_port
+    wait_for('http://127.0.0.1:%d/detect?url=%s' % (plugin_port, camera_url), processes)
+
+    achatina_env = {
+      'ACHATINA_PLUGIN': args.plugin,
+      'INPUT_URLS': ','.join(['%s?camera=%d' % (camera_url, i) for i in range(args.cameras)]),
+      'PLUGIN_URLS': 'http://127.0.0.1:%d' % plugin_port,
+      'MQTT_BROKER_URL': '127.0.0.1',
+      'MQTT_BROKER_PORT': str(mqtt_port),
+      'MQTT_PUB_TOPIC': MQTT_TOPIC,
+      'STATUS_PORT': str(status_port),
+      'PYTHONPATH': BENCH_DIR,
+    }
+    if not args.no_kafka:
+      achatina_env.update({
+        'NODE': 'bench',
+        'KAFKA_BROKER_URLS': '127.0.0.1:%d' % kafka_port,
+        'KAFKA_API_KEY': 'bench',
+        'KAFKA_PUB_TOPIC': KAFKA_TOPIC,
+        'KAFKA_TRANSPORT': 'benchkafka:BenchKafkaTransport',
+      })
+    achatina_env.update(extra_env)
+    achatina = start('achatina', [sys.executable, os.path.join(TOP_DIR, 'achatina', 'achatina.py')], achatina_env, BENCH_DIR, log_dir)
+    processes.append(('achatina', achatina))
+    wait_for('http://127.0.0.1:%d/status' % status_port, processes)
+
+    print('Warming up for %g seconds...' % args.warmup)
+    time.sleep(args.warmup)
+    before = scrape(status_port)
+    window_start = time.time()
+    print('Measuring for %g seconds...' % args.duration)
+    time.sleep(args.duration)
+    window_end = time.time()
+    after = scrape(status_port)
+    for (name, process) in processes:
+      if None != process.poll():
+        raise RuntimeError('%s exited (status %d) during the run' % (name, process.returncode))
+  except RuntimeError as e:
+    print('bench: ERROR: %s (logs are in %s)' % (str(e), log_dir))
+    sys.exit(1)
+  finally:
+    for (name, process) in processes:
+      process.terminate()
+    for (name, process) in processes:
+      process.wait()
+
+  # Gather the results
+  elapsed = window_end - window_start
+  (mqtt_messages, detects) = mqtt_recorder.window(window_start, window_end)
+  (kafka_messages, kafka_detects) = kafka_recorder.window(window_start, window_end)
+  frames = sum([v - before.get(k, 0.0) for (k, v) in after.items() if 'achatina_frames_total' == k[0]])
+  results = {
+    'plugin': args.plugin,
+    'cameras': args.cameras,
+    'duration': round(elapsed, 3),
+    'frames': int(frames),
+    'fps': round(frames / elapsed, 3),
+    'published-fps': round(len(detects) / elapsed, 3),
+    'mqtt-messages': len(mqtt_messages),
+    'kafka-messages': len(kafka_messages),
+    'stages': {},
+  }
+  stages = [
+    ('camera', percentiles([d[1] for d in detects], quantiles), 'plugin-reported'),
+    ('inference', percentiles([d[2] for d in detects if not d[3]], quantiles), 'plugin-reported'),
+    ('plugin request', histogram_quantiles(before, after, 'achatina_request_seconds', {}, quantiles), 'histogram'),
+    ('serialize', histogram_quantiles(before, after, 'achatina_serialize_seconds', {}, quantiles), 'histogram'),
+    ('publish mqtt', histogram_quantiles(before, after, 'achatina_publish_seconds', {'sink': 'mqtt'}, quantiles), 'histogram'),
+    ('publish kafka', histogram_quantiles(before, after, 'achatina_publish_seconds', {'sink': 'kafka'}, quantiles), 'histogram'),
+  ]
+
+  # Report them
+  print('')
+  print('achatina benchmark: %s plugin, %d camera(s), %0.1f seconds' % (args.plugin, args.cameras, elapsed))
+  print('  stub: %d ms inference (+%d ms jitter), %d detections; extra config: %s' % (args.latency_ms, args.jitter_ms, args.detections, ' '.join(args.env) or '(none)'))
+  print('  throughput: %0.2f frames/sec (%d frames), %0.2f published/sec' % (results['fps'], results['frames'], results['published-fps']))
+  print('  messages:   mqtt %d, kafka %d' % (len(mqtt_messages), len(kafka_messages)))
+  print('')
+  print('  %-16s %10s %10s %10s %9s  %s' % ('stage', 'p50 ms', 'p95 ms', 'p99 ms', 'samples', 'source'))
+  for (stage, result, source) in stages:
+    if None == result:
+      print('  %-16s %10s %10s %10s %9d  %s' % (stage, '-', '-', '-', 0, source))
+      continue
+    (values, count) = result
+    results['stages'][stage] = {'p50': values[0], 'p95': values[1], 'p99': values[2], 'samples': count, 'source': source}
+    print('  %-16s %10.2f %10.2f %10.2f %9d  %s' % (stage, values[0] * 1000.0, values[1] * 1000.0, values[2] * 1000.0, count, source))
+  print('')
+  print('  (histogram percentiles are interpolated within the metric buckets; logs are in %s)' % log_dir)
+  if None != args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2)
+      f.write('\n')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,69 @@
+#
+# An achatina Kafka transport that talks to the benchmark's Kafka stand-in
+# (see broker.py). Select it in achatina with:
+#   KAFKA_TRANSPORT=benchkafka:BenchKafkaTransport
+# (with this directory on the PYTHONPATH). KAFKA_BROKER_URLS must then be
+# "host:port" of the stand-in. Messages are sent as soon as they are handed
+# over and the delivery callbacks run, in order, as the acks come back.
+#
+
+import collections
+import socket
+import struct
+import threading
+
+class BenchKafkaTransport:
+
+  def __init__(self, brokers, api_key, linger_ms, batch_size, compression):
+    (host, port) = brokers.split(',')[0].rsplit(':', 1)
+    self.sock = socket.create_connection((host, int(port)))
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.lock = threading.Lock()
+    self.idle = threading.Condition(self.lock)
+    self.pending = collections.deque()
+    threading.Thread(target=self._read_acks, name='bench-kafka', daemon=True).start()
+
+  def _read_acks(self):
+    error = None
+    try:
+      while True:
+        acks = self.sock.recv(4096)
+        if not acks:
+          raise EOFError('connection closed')
+        for ack in acks:
+          with self.lock:
+            callback = self.pending.popleft()
+            self.idle.notify_all()
+          callback(None)
+    except (EOFError, OSError) as e:
+      error = e
+    with self.lock:
+      callbacks = list(self.pending)
+      self.pending.clear()
+      self.idle.notify_all()
+    for callback in callbacks:
+      callback(error)
+
+  def send(self, topic, value, key, callback):
+    topic = topic.encode('utf-8')
+    key_field = struct.pack('>I', 0xffffffff) if None == key else struct.pack('>I', len(key)) + key
+    frame = struct.pack('>H', len(topic)) + topic + key_field + value
+    error = None
+    with self.lock:
+      self.pending.append(callback)
+      try:
+        self.sock.sendall(struct.pack('>I', len(frame)) + frame)
+      except OSError as e:
+        self.pending.pop()
+        error = e
+    if None != error:
+      callback(error)
+
+  def flush(self):
+    with self.lock:
+      while len(self.pending) > 0:
+        self.idle.wait()
+
+  def close(self):
+    self.flush()
+    self.sock.close()
@@ -0,0 +1,147 @@
+#
+# Local stand-ins for the MQTT and Kafka brokers, for the benchmark.
+#
+# MqttBroker speaks just enough MQTT 3.1.1 for a publisher (CONNECT, PUBLISH
+# at any QoS, PINGREQ, SUBSCRIBE and DISCONNECT). Nothing is forwarded to
+# subscribers; every message is just recorded.
+#
+# KafkaBroker speaks a trivial framed protocol (see benchkafka.py, which is
+# the matching achatina Kafka transport): each message is a 4 byte length,
+# then a 2 byte topic length and the topic, a 4 byte key length (0xffffffff
+# if there is no key) and the key, and then the value. Each message is
+# acknowledged, in order, with a single 0 byte.
+#
+# Both record (arrival time, topic, payload size), and for JSON messages on
+# the watched topic they also keep the "detect" timings from the payload.
+#
+
+import json
+import socket
+import struct
+import threading
+import time
+
+class Recorder:
+
+  def __init__(self, watch_topic):
+    self.watch_topic = watch_topic
+    self.lock = threading.Lock()
+    self.messages = []
+    self.detects = []
+
+  def record(self, topic, payload):
+    now = time.time()
+    detect = None
+    if topic == self.watch_topic:
+      try:
+        detect = json.loads(payload.decode('utf-8'))['detect']
+      except (ValueError, KeyError):
+        pass
+    with self.lock:
+      self.messages.append((now, topic, len(payload)))
+      if None != detect:
+        self.detects.append((now, detect.get('cam-time', 0.0), detect.get('inf-time', 0.0), detect.get('gated', False)))
+
+  # Messages and detect timings that arrived in [start, end)
+  def window(self, start, end):
+    with self.lock:
+      messages = [m for m in self.messages if start <= m[0] < end]
+      detects = [d for d in self.detects if start <= d[0] < end]
+    return (messages, detects)
+
+def read_exactly(sock, n):
+  data = b''
+  while len(data) < n:
+    chunk = sock.recv(n - len(data))
+    if not chunk:
+      raise EOFError()
+    data += chunk
+  return data
+
+class Server:
+
+  def __init__(self, port, recorder):
+    self.recorder = recorder
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind(('127.0.0.1', port))
+    self.sock.listen(16)
+    self.port = self.sock.getsockname()[1]
+
+  def start(self):
+    threading.Thread(target=self._accept, daemon=True).start()
+    return self
+
+  def _accept(self):
+    while True:
+      (conn, address) = self.sock.accept()
+      conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+  def _serve(self, conn):
+    try:
+      self.serve(conn)
+    except (EOFError, OSError):
+      pass
+    finally:
+      conn.close()
+
+class MqttBroker(Server):
+
+  def _read_packet(self, conn):
+    header = read_exactly(conn, 1)[0]
+    length = 0
+    multiplier = 1
+    while True:
+      byte = read_exactly(conn, 1)[0]
+      length += (byte & 0x7f) * multiplier
+      multiplier *= 128
+      if 0 == byte & 0x80:
+        break
+    return (header, read_exactly(conn, length))
+
+  def serve(self, conn):
+    while True:
+      (header, body) = self._read_packet(conn)
+      kind = header >> 4
+      if 1 == kind:
+        conn.sendall(b'\x20\x02\x00\x00')
+      elif 3 == kind:
+        qos = (header >> 1) & 0x03
+        topic_length = struct.unpack('>H', body[0:2])[0]
+        topic = body[2:2 + topic_length].decode('utf-8')
+        offset = 2 + topic_length
+        if qos > 0:
+          packet_id = body[offset:offset + 2]
+          offset += 2
+          conn.sendall((b'\x40\x02' if 1 == qos else b'\x50\x02') + packet_id)
+        self.recorder.record(topic, body[offset:])
+      elif 6 == kind:
+        conn.sendall(b'\x70\x02' + body[0:2])
+      elif 8 == kind:
+        count = 0
+        offset = 2
+        while offset < len(body):
+          offset += 2 + struct.unpack('>H', body[offset:offset + 2])[0] + 1
+          count += 1
+        conn.sendall(bytes([0x90, 2 + count]) + body[0:2] + b'\x00' * count)
+      elif 12 == kind:
+        conn.sendall(b'\xd0\x00')
+      elif 14 == kind:
+        return
+
+class KafkaBroker(Server):
+
+  def serve(self, conn):
+    while True:
+      length = struct.unpack('>I', read_exactly(conn, 4))[0]
+      frame = read_exactly(conn, length)
+      topic_length = struct.unpack('>H', frame[0:2])[0]
+      topic = frame[2:2 + topic_length].decode('utf-8')
+      offset = 2 + topic_length
+      key_length = struct.unpack('>I', frame[offset:offset + 4])[0]
+      offset += 4
+      if 0xffffffff != key_length:
+        offset += key_length
+      self.recorder.record(topic, frame[offset:])
+      conn.sendall(b'\x00')
@@ -0,0 +1,60 @@
+#
+# A mock "restcam" for the benchmark. It serves a corpus of JPEG files, one
+# per request (in rotation), on any URL path, optionally after a delay.
+#
+# Usage:  python3 restcam.py port latency_ms file_or_directory ...
+#
+
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def load_corpus(paths):
+  corpus = []
+  for path in paths:
+    if os.path.isdir(path):
+      names = sorted([n for n in os.listdir(path) if n.lower().endswith(('.jpg', '.jpeg'))])
+      paths_here = [os.path.join(path, n) for n in names]
+    else:
+      paths_here = [path]
+    for p in paths_here:
+      with open(p, 'rb') as f:
+        corpus.append(f.read())
+  return corpus
+
+class CameraHandler(BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    with self.server.lock:
+      jpg = self.server.corpus[self.server.served % len(self.server.corpus)]
+      self.server.served += 1
+    if self.server.latency > 0:
+      time.sleep(self.server.latency)
+    self.send_response(200)
+    self.send_header('Content-Type', 'image/jpeg')
+    self.send_header('Content-Length', str(len(jpg)))
+    self.end_headers()
+    self.wfile.write(jpg)
+
+  def log_message(self, format, *args):
+    pass
+
+if __name__ == '__main__':
+  if len(sys.argv) < 4:
+    print('Usage:  %s port latency_ms file_or_directory ...' % sys.argv[0])
+    sys.exit(1)
+  server = ThreadingHTTPServer(('127.0.0.1', int(sys.argv[1])), CameraHandler)
+  server.daemon_threads = True
+  server.lock = threading.Lock()
+  server.served = 0
+  server.latency = float(sys.argv[2]) / 1000.0
+  server.corpus = load_corpus(sys.argv[3:])
+  if 0 == len(server.corpus):
+    print('restcam: no JPEG files found!')
+    sys.exit(1)
+  print('restcam: serving %d images on port %s' % (len(server.corpus), sys.argv[1]))
+  server.serve_forever()
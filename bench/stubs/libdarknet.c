@@ -0,0 +1,346 @@
+//
+// A stub for libdarknet.so, for benchmarking without darknet or a GPU.
+//
+// It exports the darknet symbols that plugins/*/darknet.py loads with ctypes,
+// with the same struct layouts. Instead of running a network, "inference"
+// sleeps for STUB_LATENCY_MS (plus up to STUB_JITTER_MS more) milliseconds
+// and then reports STUB_DETECTIONS detections at pseudo-random places in the
+// image (picked from the network input, so an image gets the same ones
+// whether it is run alone or in a batch). A batched network (batch > 1 in the
+// .cfg) takes STUB_BATCH_SCALE (default 0.3) times longer for each extra
+// image, and its output holds each image's output in turn, the size of a
+// [region] layer's (num, classes and coords from the .cfg) on a 32 pixel
+// grid, as for a yolo-tiny network. Images are not really decoded:
+// load_image_color() only reads the JPEG dimensions (and allocates an image
+// of that size).
+//
+// For tests, STUB_BOXES gives the detections to report instead, as a list of
+// boxes separated by ";", each "x,y,w,h,objectness,class=prob,..." with x,
+// y, w and h as fractions of the image size, and the class probabilities
+// that are not over the threshold reported as 0 (as darknet does).
+//
+// Written for the achatina benchmark (see bench/Makefile).
+//
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+typedef struct { float x, y, w, h; } box;
+
+typedef struct {
+  box bbox;
+  int classes;
+  float *prob;
+  float *mask;
+  float objectness;
+  int sort_class;
+} detection;
+
+typedef struct { int w; int h; int c; float *data; } image;
+
+typedef struct { int classes; char **names; } metadata;
+
+typedef struct {
+  int w;
+  int h;
+  int batch;
+  int outputs;
+  float *output;
+  unsigned int frame;
+} network;
+
+static int stub_classes = 80;
+
+static int env_int(const char *name, int fallback) {
+  const char *value = getenv(name);
+  return (value && *value) ? atoi(value) : fallback;
+}
+
+// A small deterministic generator (so runs are repeatable)
+static unsigned int next_random(unsigned int *state) {
+  *state = *state * 1103515245u + 12345u;
+  return (*state >> 16) & 0x7fff;
+}
+
+static float random_unit(unsigned int *state) {
+  return (float)next_random(state) / 32767.0f;
+}
+
+static void sleep_ms(int ms) {
+  struct timespec t;
+  if (ms <= 0) return;
+  t.tv_sec = ms / 1000;
+  t.tv_nsec = (long)(ms % 1000) * 1000000L;
+  nanosleep(&t, NULL);
+}
+
+// Parse "key=value" lines (darknet .cfg and .data files)
+static int read_option(const char *path, const char *key, char *value, int size) {
+  char line[1024];
+  size_t n = strlen(key);
+  FILE *f = fopen(path, "r");
+  if (!f) return 0;
+  while (fgets(line, sizeof(line), f)) {
+    char *p = line;
+    while (*p == ' ' || *p == '\t') p++;
+    if (0 == strncmp(p, key, n)) {
+      p += n;
+      while (*p == ' ' || *p == '\t') p++;
+      if (*p != '=') continue;
+      p++;
+      while (*p == ' ' || *p == '\t') p++;
+      strncpy(value, p, size - 1);
+      value[size - 1] = 0;
+      value[strcspn(value, "\r\n")] = 0;
+      fclose(f);
+      return 1;
+    }
+  }
+  fclose(f);
+  return 0;
+}
+
+image make_image(int w, int h, int c) {
+  image im;
+  im.w = w;
+  im.h = h;
+  im.c = c;
+  im.data = calloc((size_t)w * h * c, sizeof(float));
+  return im;
+}
+
+void free_image(image m) {
+  free(m.data);
+}
+
+// Only reads the dimensions from the JPEG (SOF marker), no decoding
+image load_image_color(char *filename, int w, int h) {
+  unsigned char b[4];
+  int width = 640, height = 480;
+  FILE *f = fopen(filename, "rb");
+  if (f) {
+    if (2 == fread(b, 1, 2, f) && 0xff == b[0] && 0xd8 == b[1]) {
+      while (2 == fread(b, 1, 2, f) && 0xff == b[0]) {
+        int marker = b[1];
+        int length;
+        if (2 != fread(b, 1, 2, f)) break;
+        length = (b[0] << 8) | b[1];
+        if (marker >= 0xc0 && marker <= 0xcf && marker != 0xc4 && marker != 0xc8 && marker != 0xcc) {
+          unsigned char sof[5];
+          if (5 == fread(sof, 1, 5, f)) {
+            height = (sof[1] << 8) | sof[2];
+            width = (sof[3] << 8) | sof[4];
+          }
+          break;
+        }
+        fseek(f, length - 2, SEEK_CUR);
+      }
+    }
+    fclose(f);
+  }
+  if (w > 0 && h > 0) {
+    width = w;
+    height = h;
+  }
+  return make_image(width, height, 3);
+}
+
+image letterbox_image(image im, int w, int h) {
+  return make_image(w, h, im.c);
+}
+
+void rgbgr_image(image im) {
+  int i;
+  int size = im.w * im.h;
+  for (i = 0; i < size; ++i) {
+    float swap = im.data[i];
+    im.data[i] = im.data[i + size * 2];
+    im.data[i + size * 2] = swap;
+  }
+}
+
+void *load_network(char *cfg, char *weights, int clear) {
+  char value[64];
+  int num, classes, coords;
+  network *net = calloc(1, sizeof(network));
+  net->w = read_option(cfg, "width", value, sizeof(value)) ? atoi(value) : 416;
+  net->h = read_option(cfg, "height", value, sizeof(value)) ? atoi(value) : 416;
+  net->batch = read_option(cfg, "batch", value, sizeof(value)) ? atoi(value) : 1;
+  num = read_option(cfg, "num", value, sizeof(value)) ? atoi(value) : 5;
+  classes = read_option(cfg, "classes", value, sizeof(value)) ? atoi(value) : 80;
+  coords = read_option(cfg, "coords", value, sizeof(value)) ? atoi(value) : 4;
+  net->outputs = (net->w / 32) * (net->h / 32) * num * (classes + coords + 1);
+  net->output = calloc((size_t)net->outputs * net->batch, sizeof(float));
+  return net;
+}
+
+int network_width(void *net) { return ((network *)net)->w; }
+int network_height(void *net) { return ((network *)net)->h; }
+
+void cuda_set_device(int n) {}
+void reset_rnn(void *net) {}
+
+// A seed for an image's detections, from (some of) its pixels. It is kept as
+// the first float of the image's output (so it must be exact as a float).
+static unsigned int input_seed(const float *input, int size) {
+  unsigned int seed = 0;
+  int i;
+  for (i = 0; i < size; i += 61) seed = seed * 31u + (unsigned int)(input[i] * 255.0f + 0.5f);
+  return seed & 0xffff;
+}
+
+// Runs the given number of images, each of the given size (in floats)
+static float *predict(network *n, float *input, int size, int images) {
+  const char *scale = getenv("STUB_BATCH_SCALE");
+  int latency = env_int("STUB_LATENCY_MS", 50);
+  int b;
+  latency += (int)(latency * (n->batch - 1) * ((scale && *scale) ? atof(scale) : 0.3));
+  sleep_ms(latency + (int)(random_unit(&n->frame) * env_int("STUB_JITTER_MS", 0)));
+  n->frame++;
+  for (b = 0; b < images; ++b) n->output[b * n->outputs] = (float)input_seed(input + (size_t)b * size, size);
+  return n->output;
+}
+
+float *network_predict(void *net, float *input) {
+  network *n = net;
+  return predict(n, input, n->w * n->h * 3, n->batch);
+}
+
+float *network_predict_image(void *net, image im) {
+  return predict(net, im.data, im.w * im.h * im.c, 1);
+}
+
+detection *make_network_boxes(void *net, float thresh, int *num) {
+  int i, count = env_int("STUB_DETECTIONS", 3);
+  detection *dets = calloc(count > 0 ? count : 1, sizeof(detection));
+  for (i = 0; i < count; ++i) {
+    dets[i].classes = stub_classes;
+    dets[i].prob = calloc(stub_classes, sizeof(float));
+  }
+  if (num) *num = count;
+  return dets;
+}
+
+// The detections given by STUB_BOXES (see above)
+static detection *fixed_boxes(const char *boxes, int w, int h, float thresh, int *num) {
+  const char *p;
+  int count = 1, i, used, k;
+  float prob;
+  detection *dets;
+  for (p = boxes; *p; ++p) if (';' == *p) count++;
+  dets = calloc(count, sizeof(detection));
+  for (i = 0, p = boxes; i < count; ++i) {
+    dets[i].classes = stub_classes;
+    dets[i].prob = calloc(stub_classes, sizeof(float));
+    if (5 == sscanf(p, "%f,%f,%f,%f,%f%n", &dets[i].bbox.x, &dets[i].bbox.y, &dets[i].bbox.w, &dets[i].bbox.h, &dets[i].objectness, &used)) {
+      p += used;
+      while (2 == sscanf(p, ",%d=%f%n", &k, &prob, &used)) {
+        p += used;
+        if (k >= 0 && k < stub_classes) dets[i].prob[k] = prob > thresh ? prob : 0;
+      }
+    }
+    dets[i].bbox.x *= w;
+    dets[i].bbox.y *= h;
+    dets[i].bbox.w *= w;
+    dets[i].bbox.h *= h;
+    p = strchr(p, ';');
+    if (!p) break;
+    p++;
+  }
+  *num = count;
+  return dets;
+}
+
+// Detections are placed pseudo-randomly (but the same for the same input,
+// see input_seed), from the first image's output, like a region layer's
+detection *get_network_boxes(void *net, int w, int h, float thresh, float hier, int *map, int relative, int *num) {
+  network *n = net;
+  unsigned int state = (unsigned int)n->output[0];
+  const char *boxes = getenv("STUB_BOXES");
+  int i, count;
+  detection *dets;
+  if (boxes && *boxes) return fixed_boxes(boxes, w, h, thresh, num);
+  dets = make_network_boxes(net, thresh, &count);
+  for (i = 0; i < count; ++i) {
+    float confidence = 0.5f + 0.5f * random_unit(&state);
+    dets[i].bbox.w = w * (0.1f + 0.3f * random_unit(&state));
+    dets[i].bbox.h = h * (0.1f + 0.3f * random_unit(&state));
+    dets[i].bbox.x = dets[i].bbox.w / 2 + (w - dets[i].bbox.w) * random_unit(&state);
+    dets[i].bbox.y = dets[i].bbox.h / 2 + (h - dets[i].bbox.h) * random_unit(&state);
+    dets[i].objectness = confidence;
+    dets[i].prob[next_random(&state) % stub_classes] = confidence > thresh ? confidence : 0;
+  }
+  *num = count;
+  return dets;
+}
+
+void free_detections(detection *dets, int n) {
+  int i;
+  for (i = 0; i < n; ++i) {
+    free(dets[i].prob);
+    free(dets[i].mask);
+  }
+  free(dets);
+}
+
+void free_ptrs(void **ptrs, int n) {
+  int i;
+  for (i = 0; i < n; ++i) free(ptrs[i]);
+  free(ptrs);
+}
+
+static float overlap(float x1, float w1, float x2, float w2) {
+  float left = (x1 - w1 / 2) > (x2 - w2 / 2) ? (x1 - w1 / 2) : (x2 - w2 / 2);
+  float right = (x1 + w1 / 2) < (x2 + w2 / 2) ? (x1 + w1 / 2) : (x2 + w2 / 2);
+  return right - left;
+}
+
+static float box_iou(box a, box b) {
+  float w = overlap(a.x, a.w, b.x, b.w);
+  float h = overlap(a.y, a.h, b.y, b.h);
+  float intersection = (w < 0 || h < 0) ? 0 : w * h;
+  return intersection / (a.w * a.h + b.w * b.h - intersection);
+}
+
+// Greedy per-class suppression (darknet sorts first, this does not bother)
+void do_nms_sort(detection *dets, int total, int classes, float thresh) {
+  int i, j, k;
+  for (k = 0; k < classes; ++k) {
+    for (i = 0; i < total; ++i) {
+      if (0 == dets[i].prob[k]) continue;
+      for (j = i + 1; j < total; ++j) {
+        if (box_iou(dets[i].bbox, dets[j].bbox) > thresh) dets[j].prob[k] = 0;
+      }
+    }
+  }
+}
+
+void do_nms_obj(detection *dets, int total, int classes, float thresh) {
+  do_nms_sort(dets, total, classes, thresh);
+}
+
+// Reads "classes" and "names" from a darknet .data file (names are numbered
+// "class-N" if there is no names file)
+metadata get_metadata(char *file) {
+  metadata m;
+  char value[1024], line[256];
+  int i = 0;
+  FILE *f;
+  m.classes = read_option(file, "classes", value, sizeof(value)) ? atoi(value) : 80;
+  m.names = calloc(m.classes, sizeof(char *));
+  if (read_option(file, "names", value, sizeof(value)) && (f = fopen(value, "r"))) {
+    while (i < m.classes && fgets(line, sizeof(line), f)) {
+      line[strcspn(line, "\r\n")] = 0;
+      m.names[i++] = strdup(line);
+    }
+    fclose(f);
+  }
+  for (; i < m.classes; ++i) {
+    snprintf(line, sizeof(line), "class-%d", i);
+    m.names[i] = strdup(line);
+  }
+  stub_classes = m.classes;
+  return m;
+}
@@ -0,0 +1,4 @@
+#
+# A stand-in for the OpenVINO python package, for benchmarking the openvino
+# plugin without OpenVINO or a VPU (see openvino/inference_engine).
+#
@@ -0,0 +1,103 @@
+#
+# A stand-in for "openvino.inference_engine", for benchmarking the openvino
+# plugin (plugins/openvino/openvinoyolo.py) without OpenVINO or a VPU.
+#
+# ExecutableNetwork.infer() sleeps for STUB_LATENCY_MS (plus up to
+# STUB_JITTER_MS more) milliseconds and returns YOLOv3 style region outputs
+# (13x13 and 26x26) containing STUB_DETECTIONS confident detections at
+# pseudo-random places (picked from the input image, so an image gets the
+# same ones whether it is run alone or in a batch). A batch of several images
+# takes STUB_BATCH_SCALE (default 0.3) times longer for each extra image.
+#
+# Written for the achatina benchmark (see bench/Makefile).
+#
+
+import os
+import random
+import time
+
+import numpy as np
+
+CLASSES = 80
+COORDS = 4
+ANCHORS = 3
+OUTPUTS = {
+  'detector/yolo-v3/Conv_6/BiasAdd/YoloRegion': 13,
+  'detector/yolo-v3/Conv_14/BiasAdd/YoloRegion': 26,
+}
+
+def get_from_env(v, d):
+  if v in os.environ and '' != os.environ[v]:
+    return os.environ[v]
+  else:
+    return d
+
+class InputInfo:
+
+  def __init__(self, shape):
+    self.input_data = self
+    self.shape = shape
+
+class IENetwork:
+
+  def __init__(self, model=None, weights=None):
+    self.model = model
+    self.weights = weights
+    self.batch_size = 1
+    self.input_info = {'inputs': InputInfo([1, 3, 416, 416])}
+    self.outputs = dict([(name, None) for name in OUTPUTS])
+
+class ExecutableNetwork:
+
+  def __init__(self, network):
+    self.batch_size = network.batch_size
+    self.latency = float(get_from_env('STUB_LATENCY_MS', '50')) / 1000.0
+    self.jitter = float(get_from_env('STUB_JITTER_MS', '0')) / 1000.0
+    self.batch_scale = float(get_from_env('STUB_BATCH_SCALE', '0.3'))
+    self.detections = int(get_from_env('STUB_DETECTIONS', '3'))
+    self.frame = 0
+
+  # One batch entry's outputs, with the detections in the 13x13 output
+  def _outputs(self, rng):
+    outputs = {}
+    for (name, side) in OUTPUTS.items():
+      blob = np.full((ANCHORS, COORDS + 1 + CLASSES, side * side), -10.0, dtype=np.float32)
+      blob[:, COORDS, :] = 0.0
+      if 13 == side:
+        for i in range(self.detections):
+          n = rng.randrange(ANCHORS)
+          location = rng.randrange(side * side)
+          blob[n, 0:COORDS, location] = [0.5, 0.5, rng.uniform(-0.5, 0.5), rng.uniform(-0.5, 0.5)]
+          blob[n, COORDS, location] = 0.9
+          blob[n, COORDS + 1 + rng.randrange(CLASSES), location] = rng.uniform(0.8, 1.0)
+      outputs[name] = blob.reshape(1, ANCHORS * (COORDS + 1 + CLASSES), side, side)
+    return outputs
+
+  def infer(self, inputs=None):
+    images = [None]
+    for value in (inputs or {}).values():
+      images = list(value)
+    batch = len(images)
+    time.sleep(self.latency * (1 + self.batch_scale * (batch - 1)) + random.uniform(0, self.jitter))
+    results = [self._outputs(random.Random(self.frame if None is image else int(image.ravel()[::61].astype(np.int64).sum()))) for image in images]
+    self.frame += batch
+    return dict([(name, np.concatenate([r[name] for r in results])) for name in OUTPUTS])
+
+class IECore:
+
+  def read_network(self, model=None, weights=None):
+    return IENetwork(model, weights)
+
+  def load_network(self, network=None, device_name='CPU', num_requests=1):
+    return ExecutableNetwork(network)
+
+  def set_config(self, config=None, device_name=None):
+    pass
+
+class IEPlugin:
+
+  def __init__(self, device='CPU', plugin_dirs=None):
+    self.device = device
+
+  def load(self, network=None, num_requests=1):
+    return ExecutableNetwork(network)
@@ -4,15 +4,17 @@
 # and specifically, in here:
 #   https://github.com/pjreddie/darknet/blob/master/python/darknet.py
 #
-# Following the darknet code, I have added a shell that makes the
-# "detect()" function available through a REST API using Python Flask.
+# Following the darknet code, I have added a shell that makes the network's
+# detections available through a REST API using Python Flask.
 #
 # Search ahead for "Glen Darling" to see the added code.
 #
 
 from ctypes import *
 import math
+import os
 import random
+import numpy as np
 
 def sample(probs):
     s = sum(probs)
@@ -44,6 +46,14 @@ class DETECTION(Structure):
                 ("sort_class", c_int)]
 
 
+# A zero-copy numpy view of the DETECTION fields that get_candidates() uses
+DETECTION_DTYPE = np.dtype({
+    'names': ['bbox', 'prob', 'objectness'],
+    'formats': [(np.float32, 4), np.uintp, np.float32],
+    'offsets': [DETECTION.bbox.offset, DETECTION.prob.offset, DETECTION.objectness.offset],
+    'itemsize': sizeof(DETECTION)})
+
+
 class IMAGE(Structure):
     _fields_ = [("w", c_int),
                 ("h", c_int),
@@ -55,7 +65,8 @@ class METADATA(Structure):
                 ("names", POINTER(c_char_p))]
 
 #lib = CDLL("/home/pjreddie/documents/darknet/libdarknet.so", RTLD_GLOBAL)
-lib = CDLL("/darknet/libdarknet.so", RTLD_GLOBAL)
+# (DARKNET_LIB can point elsewhere, e.g., to the stub used by bench/)
+lib = CDLL(os.environ.get('DARKNET_LIB', '/darknet/libdarknet.so'), RTLD_GLOBAL)
 lib.network_width.argtypes = [c_void_p]
 lib.network_width.restype = c_int
 lib.network_height.argtypes = [c_void_p]
@@ -132,63 +143,747 @@ def classify(net, meta, im):
     res = sorted(res, key=lambda x: -x[1])
     return res
 
-def detect(net, meta, image, thresh=.5, hier_thresh=.5, nms=.45):
-    im = load_image(image, 0, 0)
+# Collect the candidate boxes from the network's (already computed) output,
+# before any suppression, as numpy arrays (boxes, objectness, probs), so that
+# select_detections() can be applied to them, with any thresh >= this one
+def get_candidates(net, meta, w, h, thresh=.5, hier_thresh=.5):
     num = c_int(0)
     pnum = pointer(num)
-    predict_image(net, im)
-    dets = get_network_boxes(net, im.w, im.h, thresh, hier_thresh, None, 0, pnum)
+    dets = get_network_boxes(net, w, h, thresh, hier_thresh, None, 0, pnum)
     num = pnum[0]
-    if (nms): do_nms_obj(dets, num, meta.classes, nms);
+    boxes = np.zeros((0, 4), dtype=np.float32)
+    objectness = np.zeros(0, dtype=np.float32)
+    probs = np.zeros((0, meta.classes), dtype=np.float32)
+    if num > 0:
+        view = np.frombuffer((c_char * (num * sizeof(DETECTION))).from_address(addressof(dets.contents)), dtype=DETECTION_DTYPE)
+        candidates = np.nonzero(view['objectness'] > 0)[0]
+        if len(candidates) > 0:
+            boxes = view['bbox'][candidates].copy()
+            objectness = view['objectness'][candidates].copy()
+            probs = np.vstack([np.frombuffer((c_float * meta.classes).from_address(int(p)), dtype=np.float32) for p in view['prob'][candidates]])
+    free_detections(dets, num)
+    return (boxes, objectness, probs)
 
+# Select the detections from candidates (from get_candidates()), with the
+# same results as darknet's own do_nms_obj(): the boxes are taken in order of
+# objectness, and any later box overlapping a box that was kept by more than
+# nms is suppressed
+def select_detections(meta, candidates, thresh=.5, nms=.45):
+    (boxes, objectness, probs) = candidates
+    keep = np.nonzero(objectness > thresh)[0]
+    keep = keep[np.argsort(-objectness[keep], kind='mergesort')]
+    boxes = boxes[keep]
+    probs = probs[keep]
+    if nms and len(keep) > 1:
+        left = boxes[:, 0] - boxes[:, 2] / 2
+        right = boxes[:, 0] + boxes[:, 2] / 2
+        top = boxes[:, 1] - boxes[:, 3] / 2
+        bottom = boxes[:, 1] + boxes[:, 3] / 2
+        areas = boxes[:, 2] * boxes[:, 3]
+        alive = np.ones(len(keep), dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(len(keep) - 1):
+                if alive[i]:
+                    w = np.minimum(right[i], right[i + 1:]) - np.maximum(left[i], left[i + 1:])
+                    h = np.minimum(bottom[i], bottom[i + 1:]) - np.maximum(top[i], top[i + 1:])
+                    overlap = np.where((w < 0) | (h < 0), 0, w * h)
+                    alive[i + 1:] &= ~(overlap / (areas[i] + areas[i + 1:] - overlap) > nms)
+        boxes = boxes[alive]
+        probs = probs[alive]
     res = []
-    for j in range(num):
-        for i in range(meta.classes):
-            if dets[j].prob[i] > 0:
-                b = dets[j].bbox
-                res.append((meta.names[i], dets[j].prob[i], (b.x, b.y, b.w, b.h)))
-    res = sorted(res, key=lambda x: -x[1])
-    free_image(im)
-    free_detections(dets, num)
+    (rows, classes) = np.nonzero(probs > thresh)
+    confidences = probs[rows, classes]
+    order = np.argsort(-confidences, kind='mergesort')
+    for (i, confidence, b) in zip(classes[order].tolist(), confidences[order].tolist(), boxes[rows[order]].tolist()):
+        res.append((meta.names[i], confidence, tuple(b)))
     return res
-    
+
 #
 # Aside from the "load_net()" and "load_meta()" calls below, the rest of
 # this source file is added code, whose purpose is to enable access to the
-# existing "detect()" function (directly above) over a Python Flask REST API.
+# network (through get_candidates() and select_detections(), directly above)
+# over a Python Flask REST API.
 #
 # Glen Darling <mosquito@darlingevil.com>
 #
 
-import os
 import sys
 import json
+import collections
+import hashlib
+import multiprocessing
 import time
 import base64
 import requests
 import shutil
+import subprocess
+import threading
+import uuid
 from flask import Flask
 from flask import request
 from flask import send_file
 from io import BytesIO
 from PIL import Image, ImageDraw
 
+# (the queue module was renamed in Python 3)
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+# The msgpack response kind is optional (it is only available with msgpack)
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
 # Pull in the achatina logo image (for later drawing in the bounding boxes)
 # Feel free to put your own logo here! :-)
-LOGO_IMAGE = '/logo.png'
+LOGO_IMAGE = os.environ.get('LOGO_IMAGE', '/logo.png')
 LOGO_SIZE = (27,13)
 global logo
 biglogo = Image.open(LOGO_IMAGE)
 logo = biglogo.resize(LOGO_SIZE, Image.LANCZOS)
 
+# Configuration from the environment (an empty setting, e.g., one that is
+# passed through by the Makefile but not set there, gets the default)
+def get_from_env(v, d):
+  if v in os.environ and '' != os.environ[v]:
+    return os.environ[v]
+  else:
+    return d
+
 # Configuration constants
 FLASK_BIND_ADDRESS = '0.0.0.0'
-FLASK_PORT = 80
-INCOMING_IMAGE = '/tmp/incoming.jpg'
-OUTGOING_IMAGE = '/tmp/outgoing.jpg'
+FLASK_PORT = int(os.environ.get('FLASK_PORT', '80'))
+BATCH_SIZE = int(get_from_env('BATCH_SIZE', '1'))
+BATCH_CONFIG = '/tmp/batch.cfg'
+FRAME_CACHE_SIZE = int(get_from_env('FRAME_CACHE_SIZE', '16'))
+OUTPUT_CACHE_SIZE = int(get_from_env('OUTPUT_CACHE_SIZE', '16'))
+OUTPUT_CACHE_THRESH = float(get_from_env('OUTPUT_CACHE_THRESH', '10'))
+WORKERS = int(get_from_env('WORKERS', '1'))
+WORKER_QUEUE_SIZE = int(get_from_env('WORKER_QUEUE_SIZE', str(2 * WORKERS)))
+WORKER_START = get_from_env('WORKER_START', 'fork')
+WORKER_TIMEOUT = float(get_from_env('WORKER_TIMEOUT', '300'))
+PREFETCH_MAX_AGE = float(get_from_env('PREFETCH_MAX_AGE', '0'))
+PREFETCH_IDLE = 30
+TILE_SIZE = int(get_from_env('TILE_SIZE', '0'))
+TILE_OVERLAP = float(get_from_env('TILE_OVERLAP', '20'))
+TILE_MAX = int(get_from_env('TILE_MAX', '0'))
 COLOR_OUTLINE = '#ffffff'
 COLOR_LABEL = '#000000'
 
+# Change gating: a tiny grayscale thumbnail of the last frame that inference
+# was run on, for each camera URL, is kept along with that frame's result.
+# New frames are compared to it, cell by cell, and a cell has "changed" if it
+# differs by more than GATE_CELL_DELTA (out of 255, to ignore sensor noise).
+GATE_SIZE = (32, 24)
+GATE_CELL_DELTA = 24
+gate_lock = threading.Lock()
+gate_state = {}
+
+# Decode just enough of the JPEG to make a GATE_SIZE grayscale thumbnail
+def gate_thumbnail(frame, size=None):
+  im = open_frame(frame, size)
+  im.draft('L', (GATE_SIZE[0] * 4, GATE_SIZE[1] * 4))
+  return list(im.convert('L').resize(GATE_SIZE, Image.BILINEAR).getdata())
+
+# Percentage of the thumbnail cells that have changed
+def gate_changed(a, b):
+  changed = 0
+  for (x, y) in zip(a, b):
+    if abs(x - y) > GATE_CELL_DELTA:
+      changed += 1
+  return 100.0 * changed / len(a)
+
+# Letterboxing, the same as darknet's letterbox_image() does it, but without
+# a full size float copy of the frame, or new IMAGEs for every frame. The
+# frame is scaled to fit the network (bilinear, on the 8-bit pixels, which
+# can be done ahead of time), and then it is normalized, planar float32
+# (channel, row, column) scaled to 0..1, straight into the middle of the
+# network's input buffer (allocated once), whose border is gray (0.5).
+
+# The size of an iw x ih image scaled to fit in w x h (keeping its aspect)
+def letterbox_fit(iw, ih, w, h):
+  if float(w) / iw < float(h) / ih:
+    return (w, (ih * w) // iw)
+  return ((iw * h) // ih, h)
+
+# Scale an RGB PIL image, of a frame of the given size (if the image is a
+# reduced size one), to fit in w x h. Returns (scaled image, x offset, y
+# offset) of it in the letterboxed image.
+def letterbox_scale(pil, w, h, size=None):
+  (iw, ih) = pil.size if None == size else size
+  (nw, nh) = letterbox_fit(iw, ih, w, h)
+  if (nw, nh) != pil.size:
+    pil = pil.resize((nw, nh), Image.BILINEAR)
+  return (pil, (w - nw) // 2, (h - nh) // 2)
+
+# Copy a scaled image (from letterbox_scale) into an input buffer (3 x h x w)
+def letterbox_into(boxed, buffer):
+  (scaled, dx, dy) = boxed
+  buffer.fill(0.5)
+  pixels = np.asarray(scaled).transpose(2, 0, 1)
+  np.multiply(pixels, 1.0 / 255.0, out=buffer[:, dy:dy + scaled.size[1], dx:dx + scaled.size[0]], dtype=np.float32)
+
+#
+# Tiling. Scaled down to fit the network, small (or distant) objects in a
+# large frame are too small to be found. With TILE_MAX > 1, a frame that is
+# larger than TILE_SIZE pixels (the network's size, if TILE_SIZE is 0) is
+# also cut into square tiles of that size, overlapping by (at least)
+# TILE_OVERLAP percent, and the network is run on each of them, as well as
+# on the whole frame (for the large objects), all in one batch. The boxes
+# found in the tiles are moved to where the tiles are in the frame, and then
+# they are suppressed (see select_detections) along with all of the others,
+# so an object found in more than one tile is only reported once. If more
+# than TILE_MAX tiles would be needed, the tiles are made larger until they
+# are not, so the time taken stays bounded.
+#
+
+# The origins along a length of tiles of size t, overlapping by (at least)
+# the given fraction, spread evenly from one end to the other
+def tile_origins(length, t, overlap):
+  if t >= length:
+    return [0]
+  stride = max(1, int(t * (1.0 - overlap)))
+  n = (length - t + stride - 1) // stride + 1
+  return [(k * (length - t)) // (n - 1) for k in range(n)]
+
+# The tiles of a w x h frame, as a list of (x, y, width, height), or [] if
+# it is not tiled (see above)
+def frame_tiles(w, h):
+  if TILE_MAX < 2:
+    return []
+  t = TILE_SIZE if TILE_SIZE > 0 else max(net_size)
+  while True:
+    xs = tile_origins(w, t, TILE_OVERLAP / 100.0)
+    ys = tile_origins(h, t, TILE_OVERLAP / 100.0)
+    if len(xs) * len(ys) <= TILE_MAX:
+      break
+    t += max(1, t // 4)
+  if 1 == len(xs) * len(ys):
+    return []
+  return [(x, y, min(t, w), min(t, h)) for y in ys for x in xs]
+
+# The frame candidates, from those found in each of its network inputs (see
+# decode_frame), i.e., with the tiles' boxes moved to where the tiles are
+def merge_candidates(inputs, found):
+  if 1 == len(found):
+    return found[0]
+  for ((boxed, size, (x, y)), (boxes, objectness, probs)) in zip(inputs, found):
+    boxes[:, 0] += x
+    boxes[:, 1] += y
+  return tuple(np.concatenate(parts) for parts in zip(*found))
+
+# Annotated images are only drawn (and encoded) when they are asked for. The
+# most recent FRAME_CACHE_SIZE frames are kept, by frame id, along with their
+# detections (and, once it is drawn, the annotated jpg), least recently used
+# first. Each is a dict with the 'frame' and its 'size' (see open_frame), the
+# 'detections' and the 'jpg' (None until drawn).
+#
+# Similarly, the detection candidates (see get_candidates) of the most recent
+# OUTPUT_CACHE_SIZE frames are kept, by a hash of the frame's content, so that
+# asking about the same frame again (e.g., with other thresholds) does not
+# run the network again. They are found with a threshold of (at most)
+# OUTPUT_CACHE_THRESH percent, so that any higher one can be applied later.
+cache_lock = threading.Lock()
+frame_cache = collections.OrderedDict()
+output_cache = collections.OrderedDict()
+
+# Add to a (least recently used first) cache, holding at most size entries
+def cache_put(cache, key, value, size):
+  with cache_lock:
+    cache[key] = value
+    while len(cache) > size:
+      cache.popitem(last=False)
+
+# Look up a cache entry (it becomes the most recently used), or None
+def cache_get(cache, key):
+  with cache_lock:
+    value = cache.pop(key, None)
+    if None != value:
+      cache[key] = value
+  return value
+
+# Remember a frame, returning its (new) frame id
+def remember_frame(entry):
+  frame_id = uuid.uuid4().hex
+  cache_put(frame_cache, frame_id, entry, FRAME_CACHE_SIZE)
+  return frame_id
+
+# Look up a remembered frame, or None
+def recall_frame(frame_id):
+  return cache_get(frame_cache, frame_id)
+
+# The key for a frame (see open_frame) in the output cache
+def output_key(frame, size, hier_thresh):
+  return (hashlib.sha1(frame).hexdigest(), size, hier_thresh)
+
+# Response kinds (see /detect below)
+KINDS = ['', 'json', 'jpg', 'multipart', 'msgpack']
+
+# The detect data as sent in a response of the given kind, i.e., with the
+# annotated jpg embedded as base64 (the default), as binary (msgpack), or not
+# at all (the other kinds)
+def response_detect(kind, detect_data, jpg):
+  if 'msgpack' == kind:
+    detect_data = dict(detect_data)
+    detect_data['image'] = bytearray(jpg)
+  elif '' == kind:
+    detect_data = dict(detect_data)
+    detect_data['image'] = base64.b64encode(jpg).decode('ascii')
+  return detect_data
+
+# On Python 2 plain strings are bytes, which msgpack would pack as binary, so
+# they are converted to unicode first (the bytearray image stays binary)
+def msgpack_strings(o):
+  if isinstance(o, dict):
+    return dict([(msgpack_strings(k), msgpack_strings(v)) for (k, v) in o.items()])
+  elif isinstance(o, list):
+    return [msgpack_strings(v) for v in o]
+  elif bytes == str and isinstance(o, str):
+    return o.decode('utf-8')
+  return o
+
+# Construct the response for the given kind, from the data to return and the
+# annotated jpg binary
+def detect_response(kind, data, jpg):
+  if 'jpg' == kind:
+    return (jpg, 200, {'Content-Type': 'image/jpeg'})
+  elif 'multipart' == kind:
+    boundary = uuid.uuid4().hex.encode('ascii')
+    body = b''
+    for (content_type, part) in [(b'application/json', json.dumps(data).encode('utf-8')), (b'image/jpeg', jpg)]:
+      body += b'--' + boundary + b'\r\nContent-Type: ' + content_type + b'\r\n\r\n' + part + b'\r\n'
+    body += b'--' + boundary + b'--\r\n'
+    return (body, 200, {'Content-Type': 'multipart/mixed; boundary=' + boundary.decode('ascii')})
+  elif 'msgpack' == kind:
+    return (msgpack.packb(msgpack_strings(data), use_bin_type=True), 200, {'Content-Type': 'application/msgpack'})
+  return (json.dumps(data) + '\n', 200)
+
+# Open a frame as a PIL image. The frame is a jpg (or other image file)
+# binary, or, if size (width, height) is given, raw 8-bit RGB pixels, row by
+# row. Image files are only decoded when the pixels are first needed.
+def open_frame(frame, size=None):
+  if None == size:
+    return Image.open(BytesIO(frame))
+  return Image.frombytes('RGB', size, frame)
+
+# Decode a frame, in memory, into (RGB PIL image or None, the frame's size,
+# its network inputs). The inputs are the whole frame and then its tiles (if
+# it is tiled, see frame_tiles), each as (the image scaled for the network
+# (see letterbox_scale), the (width, height) of the part of the frame it
+# covers, and that part's (x, y) in the frame). Unless the full size image
+# is wanted (i.e., to annotate it), a JPEG is only decoded at 1/2, 1/4 or 1/8
+# size (in the DCT domain, with draft mode), the smallest that is still no
+# smaller than the network (or the tiles) need, and it is not kept.
+def decode_frame(frame, size=None, full=True):
+  pil = open_frame(frame, size)
+  frame_size = pil.size
+  tiles = frame_tiles(frame_size[0], frame_size[1])
+  if not full:
+    needed = letterbox_fit(frame_size[0], frame_size[1], net_size[0], net_size[1])
+    if tiles:
+      (tw, th) = letterbox_fit(tiles[0][2], tiles[0][3], net_size[0], net_size[1])
+      needed = (-(-frame_size[0] * tw // tiles[0][2]), -(-frame_size[1] * th // tiles[0][3]))
+    pil.draft('RGB', needed)
+  if 'RGB' != pil.mode:
+    pil = pil.convert('RGB')
+  inputs = [(letterbox_scale(pil, net_size[0], net_size[1], frame_size), frame_size, (0, 0))]
+  (sx, sy) = (float(pil.size[0]) / frame_size[0], float(pil.size[1]) / frame_size[1])
+  for (x, y, w, h) in tiles:
+    tile = pil.crop((int(x * sx), int(y * sy), int((x + w) * sx), int((y + h) * sy)))
+    inputs.append((letterbox_scale(tile, net_size[0], net_size[1], (w, h)), (w, h), (x, y)))
+  return (pil if full else None, frame_size, inputs)
+
+# Pull images from several camera URLs concurrently. Returns a list, in
+# order, of (jpg binary or None on failure, seconds taken).
+def fetch_frames(urls, user, password):
+  frames = [(None, 0.0)] * len(urls)
+  def fetch(k):
+    start = time.time()
+    try:
+      if ('' != user):
+        r = requests.get(urls[k], auth=(user, password))
+      else:
+        r = requests.get(urls[k])
+      if (r.status_code < 300):
+        frames[k] = (r.content, time.time() - start)
+    except requests.RequestException:
+      pass
+  threads = [threading.Thread(target=fetch, args=(k,)) for k in range(len(urls))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return frames
+
+#
+# Batched inference. With BATCH_SIZE > 1 (it is 1, i.e., off, by default,
+# since it costs the memory and start up time of a second network), for
+# simple region (YOLOv2) networks, i.e., only convolutional and maxpool
+# layers and then one [region] layer, like the yolo-tiny network used here,
+# a second copy of the network is loaded with batch=BATCH_SIZE, so a batch of
+# frames goes through one forward pass. The region layer only reads the
+# first image's output though, so each image's output is moved there in turn
+# before its detections are collected. Other networks just run the frames one
+# after another.
+#
+
+# Parse a darknet .cfg file into a list of (section, {option: value})
+def read_cfg(path):
+  sections = []
+  with open(path) as f:
+    for line in f:
+      line = line.split('#')[0].strip()
+      if line.startswith('['):
+        sections.append((line.strip('[]'), {}))
+      elif '=' in line and len(sections) > 0:
+        (k, v) = line.split('=', 1)
+        sections[-1][1][k.strip()] = v.strip()
+  return sections
+
+# The size (in floats) of one image's output from a simple region network
+# (following darknet's own layer size arithmetic), or None for any other
+def region_outputs(sections):
+  (w, h) = (int(sections[0][1].get('width', 0)), int(sections[0][1].get('height', 0)))
+  for (k, (section, options)) in enumerate(sections[1:]):
+    stride = int(options.get('stride', 1))
+    if 'convolutional' == section:
+      size = int(options.get('size', 1))
+      pad = (size // 2) if '0' != options.get('pad', '0') else int(options.get('padding', 0))
+      (w, h) = ((w + 2 * pad - size) // stride + 1, (h + 2 * pad - size) // stride + 1)
+    elif 'maxpool' == section:
+      size = int(options.get('size', stride))
+      pad = int(options.get('padding', size - 1))
+      (w, h) = ((w + pad - size) // stride + 1, (h + pad - size) // stride + 1)
+    elif 'region' == section and k == len(sections) - 2:
+      return w * h * int(options.get('num', 1)) * (int(options.get('classes', 20)) + int(options.get('coords', 4)) + 1)
+    else:
+      return None
+  return None
+
+# Write a copy of a .cfg file with the given batch size (and no subdivisions)
+def write_batch_cfg(config, batch, path):
+  with open(config) as f:
+    lines = f.readlines()
+  with open(path, 'w') as f:
+    section = ''
+    for line in lines:
+      stripped = line.strip()
+      if stripped.startswith('['):
+        section = stripped
+      elif '[net]' == section and stripped.split('=')[0].strip() in ('batch', 'subdivisions'):
+        continue
+      f.write(line)
+      if '[net]' == stripped:
+        f.write('batch=%d\nsubdivisions=1\n' % batch)
+
+# Run the network on network inputs (see decode_frame). Returns the list of
+# their detection candidates (see get_candidates), in order.
+def detect_inputs(inputs, thresh=.5, hier_thresh=.5):
+  results = []
+  if None == batch_net or 1 == len(inputs):
+    for (boxed, (w, h), origin) in inputs:
+      letterbox_into(boxed, input_buffer)
+      predict(net, input_buffer.ctypes.data_as(POINTER(c_float)))
+      results.append(get_candidates(net, meta, w, h, thresh, hier_thresh))
+    return results
+  for start in range(0, len(inputs), BATCH_SIZE):
+    chunk = inputs[start:start + BATCH_SIZE]
+    for (b, (boxed, size, origin)) in enumerate(chunk):
+      letterbox_into(boxed, batch_buffer[b])
+    output = predict(batch_net, batch_buffer.ctypes.data_as(POINTER(c_float)))
+    for (b, (boxed, (w, h), origin)) in enumerate(chunk):
+      if b > 0:
+        memmove(output, addressof(output.contents) + b * batch_outputs * sizeof(c_float), batch_outputs * sizeof(c_float))
+      results.append(get_candidates(batch_net, meta, w, h, thresh, hier_thresh))
+  return results
+
+# Run the network on one decoded frame (see decode_frame). Returns its
+# detection candidates.
+def detect_frame(decoded, thresh=.5, hier_thresh=.5):
+  return detect_batch([decoded], thresh, hier_thresh)[0]
+
+# Run the network on several decoded frames (and their tiles, all in one
+# batch). Returns the list of their detection candidates, in order.
+def detect_batch(frames, thresh=.5, hier_thresh=.5):
+  found = detect_inputs([i for decoded in frames for i in decoded[2]], thresh, hier_thresh)
+  results = []
+  for decoded in frames:
+    results.append(merge_candidates(decoded[2], found[:len(decoded[2])]))
+    del found[:len(decoded[2])]
+  return results
+
+# Load the network (and the batched copy of it, if batching is possible),
+# and allocate their input buffers
+def load_networks(config, weights):
+  global net
+  global batch_net
+  global input_buffer
+  global batch_buffer
+  net = load_net(config.encode('utf-8'), weights.encode('utf-8'), 0)
+  input_buffer = np.zeros((3, net_size[1], net_size[0]), dtype=np.float32)
+  batch_net = None
+  if BATCH_SIZE > 1 and None != batch_outputs:
+    batch_net = load_net(BATCH_CONFIG.encode('utf-8'), weights.encode('utf-8'), 0)
+    batch_buffer = np.zeros((BATCH_SIZE, 3, net_size[1], net_size[0]), dtype=np.float32)
+
+#
+# Inference jobs. These run the network (in this process, or in one of the
+# worker processes below), and return what they found. The full size decoded
+# images are only returned if full is True (i.e., they are to be annotated)
+# and images is True (they are not sent back from workers).
+#
+
+# Decode a frame (unless it was decoded already, see decode_frame) and run the
+# network on it. Returns (RGB PIL image or None, candidates (see
+# get_candidates), seconds the network took).
+def infer_frame(frame, size, thresh, hier_thresh, decoded, full, images):
+  if None == decoded:
+    decoded = decode_frame(frame, size, full and images)
+  with inference_lock:
+    start = time.time()
+    candidates = detect_frame(decoded, thresh, hier_thresh)
+    seconds = time.time() - start
+  return (decoded[0] if images else None, candidates, seconds)
+
+# Decode several jpgs and run the network on them (see detect_batch). Returns
+# (list of RGB PIL images (or True) or None for those that did not decode,
+# candidates for the decoded ones, seconds the network took).
+def infer_frames(jpgs, thresh, hier_thresh, full, images):
+  decoded = []
+  for jpg in jpgs:
+    try:
+      decoded.append(decode_frame(jpg, None, full and images))
+    except IOError:
+      decoded.append(None)
+  with inference_lock:
+    start = time.time()
+    candidates = detect_batch([d for d in decoded if None != d], thresh, hier_thresh)
+    seconds = time.time() - start
+  pils = [None if None == d else (d[0] if None != d[0] else True) for d in decoded]
+  return (pils, candidates, seconds)
+
+INFERENCE_JOBS = {'frame': infer_frame, 'frames': infer_frames}
+
+#
+# Worker pool. With WORKERS > 1, the inference jobs run in that many worker
+# processes, each with its own network, instead of one at a time in this
+# one. Jobs wait in a queue of at most WORKER_QUEUE_SIZE (so when all of the
+# workers are busy, requests wait to be queued rather than piling up), and a
+# feeder thread for each worker hands it the jobs, one at a time, through a
+# pipe of its own, and hands each result back to the request waiting for it.
+# Each worker is pinned to its own CPU (round robin, if there are more
+# workers than CPUs).
+#
+# With WORKER_START 'fork' (the default), the network is loaded once and then
+# the workers are forked, so they all share the one copy of the weights
+# (copy-on-write, and darknet does not write to them when inferencing).
+# Darknet reads the weights into memory of its own, so they can not simply
+# be memory mapped from the weights file instead. CUDA state does not survive
+# a fork though, so for GPUs WORKER_START must be 'load', and then each worker
+# loads its own copy of the network after it starts.
+#
+# If a worker dies (e.g., it runs out of memory, or darknet crashes), or it
+# takes over WORKER_TIMEOUT seconds over a job (and is killed), the job fails
+# (with a 500) and a new worker takes its place. Nothing is shared between
+# the workers, so the others carry on regardless.
+#
+worker_jobs = None
+worker_files = None
+
+# Pin this process to one CPU (of those it is allowed to use)
+def pin_to_cpu(k):
+  if hasattr(os, 'sched_getaffinity'):
+    cpus = sorted(os.sched_getaffinity(0))
+  else:
+    cpus = list(range(multiprocessing.cpu_count()))
+  cpu = cpus[k % len(cpus)]
+  try:
+    if hasattr(os, 'sched_setaffinity'):
+      os.sched_setaffinity(0, [cpu])
+    else:
+      with open(os.devnull, 'w') as devnull:
+        subprocess.call(['taskset', '-p', '-c', str(cpu), str(os.getpid())], stdout=devnull)
+  except (OSError, ValueError):
+    print("Worker %d could not be pinned to CPU %d." % (k, cpu))
+    return
+  print("Worker %d is pinned to CPU %d." % (k, cpu))
+
+# The main loop of worker process k, running the jobs that come through its
+# end of a pipe (it ends if the parent process does)
+def worker_main(k, config, weights, jobs):
+  parent = os.getppid()
+  pin_to_cpu(k)
+  if 'load' == WORKER_START:
+    load_networks(config, weights)
+  while parent == os.getppid():
+    if not jobs.poll(1.0):
+      continue
+    (name, args) = jobs.recv()
+    try:
+      jobs.send((None, INFERENCE_JOBS[name](*args)))
+    except IOError as e:
+      jobs.send((IOError(str(e)), None))
+    except Exception as e:
+      jobs.send((RuntimeError(str(e)), None))
+
+# Start worker process k. Returns (the process, this end of its pipe).
+def start_worker(k):
+  (jobs, worker_end) = multiprocessing.Pipe()
+  worker = multiprocessing.Process(target=worker_main, args=(k,) + worker_files + (worker_end,), name='worker-%d' % k)
+  worker.daemon = True
+  worker.start()
+  worker_end.close()
+  return (worker, jobs)
+
+# Run one job in a worker. Returns its (error, result), or None if the worker
+# died, or took too long over it (and was killed).
+def run_job(worker, jobs, job):
+  deadline = time.time() + WORKER_TIMEOUT
+  try:
+    jobs.send(job)
+    while time.time() < deadline:
+      if jobs.poll(1.0):
+        return jobs.recv()
+      if not worker.is_alive():
+        return None
+  except (EOFError, IOError, OSError):
+    return None
+  worker.terminate()
+  return None
+
+# Replace worker k, which has died (or was killed)
+def restart_worker(k, worker, jobs):
+  worker.join(1.0)
+  print("Worker %d died (exit code %s), starting a new one." % (k, worker.exitcode))
+  jobs.close()
+  return start_worker(k)
+
+# The feeder thread for worker k (see above). The worker is checked on (and
+# replaced if it has died) while it is idle too, so no job is sent to it dead.
+def feed_worker(k):
+  (worker, jobs) = start_worker(k)
+  while True:
+    try:
+      (waiting, name, args) = worker_jobs.get(timeout=1.0)
+    except queue.Empty:
+      if not worker.is_alive():
+        (worker, jobs) = restart_worker(k, worker, jobs)
+      continue
+    if not worker.is_alive():
+      (worker, jobs) = restart_worker(k, worker, jobs)
+    outcome = run_job(worker, jobs, (name, args))
+    if None == outcome:
+      outcome = (RuntimeError('the inference worker died'), None)
+      (worker, jobs) = restart_worker(k, worker, jobs)
+    waiting[1] = outcome
+    waiting[0].set()
+
+# Start the worker processes (and their feeder threads)
+def start_workers(config, weights):
+  global worker_jobs
+  global worker_files
+  worker_jobs = queue.Queue(WORKER_QUEUE_SIZE)
+  worker_files = (config, weights)
+  for k in range(WORKERS):
+    feeder = threading.Thread(target=feed_worker, args=(k,), name='feeder-%d' % k)
+    feeder.daemon = True
+    feeder.start()
+
+# Run one of the INFERENCE_JOBS (by name), in a worker if there are any, or
+# else right here. Raises RuntimeError if a worker could not run it. (A job
+# waits behind at most WORKER_QUEUE_SIZE others, each of which the workers
+# give up on after WORKER_TIMEOUT seconds, so a result is due by then.)
+def infer(name, *args):
+  if None == worker_jobs:
+    return INFERENCE_JOBS[name](*(args + (True,)))
+  waiting = [threading.Event(), None]
+  worker_jobs.put((waiting, name, args + (False,)))
+  if not waiting[0].wait((WORKER_QUEUE_SIZE // WORKERS + 2) * WORKER_TIMEOUT):
+    raise RuntimeError('no result from the inference workers')
+  (error, result) = waiting[1]
+  if None != error:
+    raise error
+  return result
+
+#
+# Camera prefetch. With PREFETCH_MAX_AGE > 0, once a frame is pulled from a
+# camera url for /detect, a prefetcher thread for that url keeps the next
+# frame pulled (and, unless the workers decode it, decoded, at full size only
+# if the last request wanted it), so the next request for that url (usually)
+# finds it ready, rather than pulling it only then. A prefetched frame is
+# never used once it is over PREFETCH_MAX_AGE seconds old (the prefetcher
+# pulls a newer one instead), and a prefetcher stops when its url has not been
+# asked for in PREFETCH_IDLE seconds.
+#
+prefetch_lock = threading.Lock()
+prefetch_changed = threading.Condition(prefetch_lock)
+prefetchers = {}
+
+# Is a prefetched frame (jpg or None, seconds taken, time pulled, decoded or
+# None) fresh enough to use?
+def prefetch_fresh(prefetched):
+  return None != prefetched and time.time() - prefetched[2] <= PREFETCH_MAX_AGE
+
+# The prefetcher thread for a camera url (with the given state, see below)
+def prefetch(key, state):
+  (url, user, password) = key
+  while True:
+    with prefetch_lock:
+      while prefetch_fresh(state['frame']) and time.time() - state['used'] < PREFETCH_IDLE:
+        prefetch_changed.wait(max(0.0, PREFETCH_MAX_AGE - (time.time() - state['frame'][2])))
+      if time.time() - state['used'] >= PREFETCH_IDLE:
+        del prefetchers[key]
+        return
+    start = time.time()
+    jpg = None
+    try:
+      if ('' != user):
+        r = requests.get(url, auth=(user, password))
+      else:
+        r = requests.get(url)
+      if (r.status_code < 300):
+        jpg = r.content
+    except requests.RequestException:
+      pass
+    decoded = None
+    if None != jpg and None == worker_jobs:
+      try:
+        decoded = decode_frame(jpg, None, state['full'])
+      except IOError:
+        pass
+    with prefetch_lock:
+      state['frame'] = (jpg, time.time() - start, time.time(), decoded)
+      prefetch_changed.notify_all()
+
+# Take the prefetched frame for a camera url, as (jpg, decoded or None),
+# waiting for it if it is being pulled, or None if there is no fresh one (or
+# it could not be pulled). Starts the url's prefetcher if it is not running.
+# The next frame is decoded at full size if full is True (see decode_frame).
+def take_prefetched(url, user, password, full):
+  key = (url, user, password)
+  with prefetch_lock:
+    state = prefetchers.get(key)
+    if None == state:
+      state = {'frame': None, 'used': time.time(), 'full': full}
+      prefetchers[key] = state
+      prefetcher = threading.Thread(target=prefetch, args=(key, state), name='prefetch')
+      prefetcher.daemon = True
+      prefetcher.start()
+    state['used'] = time.time()
+    state['full'] = full
+    deadline = time.time() + PREFETCH_IDLE
+    while not prefetch_fresh(state['frame']) and time.time() < deadline:
+      prefetch_changed.wait(deadline - time.time())
+    prefetched = state['frame']
+    state['frame'] = None
+    prefetch_changed.notify_all()
+  if not prefetch_fresh(prefetched) or None == prefetched[0]:
+    return None
+  return (prefetched[0], prefetched[3])
+
 if __name__ == "__main__":
 
   # Consume ClI arguments
@@ -202,11 +897,37 @@ if __name__ == "__main__":
   print("Model weights file:  %s" % weights)
   print("Class metadata file: %s" % metadata)
 
-  # Load the neural network and metadata about the classes
-  global net
-  net = load_net(config, weights, 0)
+  # Load the metadata about the classes
   global meta
-  meta = load_meta(metadata)
+  meta = load_meta(metadata.encode('utf-8'))
+
+  # Prepare for a batched copy of the network too (if batching is possible)
+  global net_size
+  global batch_outputs
+  sections = read_cfg(config)
+  net_size = (int(sections[0][1]['width']), int(sections[0][1]['height']))
+  batch_outputs = region_outputs(sections)
+  if BATCH_SIZE > 1 and None != batch_outputs:
+    write_batch_cfg(config, BATCH_SIZE, BATCH_CONFIG)
+    print("Batches of up to %d frames use one forward pass." % BATCH_SIZE)
+  else:
+    print("Batches of frames are processed one frame at a time.")
+  if TILE_MAX > 1:
+    print("Frames larger than %d pixels are also run as (up to %d) tiles." % (TILE_SIZE if TILE_SIZE > 0 else max(net_size), TILE_MAX))
+
+  # The network is not thread-safe, so only one request at a time may use it
+  global inference_lock
+  inference_lock = threading.Lock()
+
+  # Load the neural network(s), and start the workers (if there are any)
+  if WORKERS > 1 and 'load' == WORKER_START:
+    start_workers(config, weights)
+  else:
+    load_networks(config, weights)
+    if WORKERS > 1:
+      start_workers(config, weights)
+  if WORKERS > 1:
+    print("Inferencing is done by %d workers (started by %s)." % (WORKERS, WORKER_START))
 
   # Configure REST server args
   webapp = Flask('yolo')
@@ -229,83 +950,42 @@ if __name__ == "__main__":
     draw.text((bl_x + LOGO_SIZE[0], bl_y - 12), label, fill=COLOR_LABEL)
     original.paste(logo, (int(bl_x + 3), int(bl_y - 12)))
 
-  #
-  # Expose the YoloV3 "detect()" function
-  #
-  # URL parameters (i.e., "?key=value&..."):
-  #  x kind:        default (if not specified) is 'jpg'
-  #  * url:         (required) url to retrieve the source image
-  #    user:        if url requires HTTP basic auth, this is the user
-  #    password:    if url requires HTTP basic auth, this is the password
-  #  x thresh:      detection confidence threshold in percent (i.e., 0..100)
-  #  x hierthresh:  hierarchical detection confidence threshold in % (0..100) 
-  #  x nms:         non-max suppression intersection-over-union threshold in %
-  #
-  # Note:
-  #  * indicates a required parameter
-  #  x indicates a currently ignored parameter
-  #
-  # Usage example:
-  #   curl "http://localhost:5252/detect?kind=json&url=http%3A%2F%2Frestcam"
-  #
-  @webapp.route("/detect", methods=['GET'])
-  def get_detect():
+  # Annotate a (decoded) frame with its detections, returning the jpg binary
+  def render(prediction, r):
+    draw = ImageDraw.Draw(prediction)
+    for (entity, confidence, (center_x, center_y, width, height)) in r:
+      if isinstance(entity, bytes):
+        entity = entity.decode('utf-8')
+      outline(prediction, draw, entity, confidence, center_x - (width / 2), center_y - (height / 2), width, height)
+    buffer = BytesIO()
+    prediction.save(buffer, format='JPEG')
+    return buffer.getvalue()
 
-    #print("\n\nREST request received.")
-    #print(request.args)
-    kind = request.args.get('kind', '')
-    url = request.args.get('url', '')
-    #print("URL is:   %s" % url)
-    user = request.args.get('user', '')
-    password = request.args.get('password', '')
-    thresh = request.args.get('thresh', '')
-    hierthresh = request.args.get('hierthresh', '')
-    nms = request.args.get('nms', '')
-
-    # Pull image from the provided camera URL
-    #print("Pulling an image from the camera REST service...")
-    cam_start = time.time()
-    if ('' != user):
-      r = requests.get(url, auth=(user, password))
-    else:
-      r = requests.get(url)
-    #print("Camera service returned.")
-    if (r.status_code > 299):
-      return (json.dumps({"error": "unable to get image from camera"}) + '\n', 400)
-    #if (r.headers['content-type'] != 'image/jpg'):
-    #  return (json.dumps({"error": "camera did not return a jpg image"}) + '\n', 400)
-    cam_end = time.time()
-    # We have a jpg binary
-    with open(INCOMING_IMAGE, 'wb') as f:
-      for chunk in r.iter_content(1024):
-        f.write(chunk)
-    #print("Image is ready for yolo...")
-
-    prediction_start = time.time()
-    # @@@ Ideally detect() should use the image in memory instead of a file
-    r = detect(net, meta, INCOMING_IMAGE)
-    prediction_end = time.time()
-    #print("Yolo finished. Preparing prediction image and formatting data...")
+  # The annotated jpg for a remembered frame. It is drawn the first time it is
+  # asked for (on the given decoded frame, or else the frame is decoded again).
+  def frame_image(entry, prediction=None):
+    if None == entry['jpg']:
+      if None == prediction:
+        prediction = open_frame(entry['frame'], entry['size'])
+        if 'RGB' != prediction.mode:
+          prediction = prediction.convert('RGB')
+      entry['jpg'] = render(prediction, entry['detections'])
+    return entry['jpg']
+
+  # Construct the return JSON detect data from the detection results
+  def make_detect_data(r, cam_time, inf_time):
+    #print("Yolo finished. Formatting data...")
     #print r
-    # @@@ This should use Image.fromBytes instead of reading this physical file
-    prediction = Image.open(INCOMING_IMAGE)
-    # Process the prediction result, drawing outline boxes around entities
-    # Construct the return JSON as we go too
-    data = {}
     entity_raw = {}
-    draw = ImageDraw.Draw(prediction)
-    os.remove(INCOMING_IMAGE)
     for k in range(len(r)):
-      # Prepare info for the prediction image
       entity =  r[k][0]
+      if isinstance(entity, bytes):
+        entity = entity.decode('utf-8')
       confidence =  r[k][1]
       center_x = r[k][2][0]
       center_y = r[k][2][1]
       width =  r[k][2][2]
       height = r[k][2][3]
-      bottomLeft_x = center_x - (width / 2)
-      bottomLeft_y = center_y - (height / 2)
-      outline(prediction, draw, entity, confidence, bottomLeft_x, bottomLeft_y, width, height)
       if not (entity in entity_raw):
         this_entity = {}
         this_entity['eclass'] = entity
@@ -320,26 +1000,278 @@ if __name__ == "__main__":
       this_instance['w'] = int(width)
       this_instance['h'] = int(height)
       this_entity['details'].append(this_instance)
-    prediction.save(OUTGOING_IMAGE)
-    buffer = BytesIO()
-    prediction.save(buffer, format='JPEG')
-    buffer.seek(0)
-    prediction_image_b64 = base64.b64encode(buffer.read())
     entity_data = []
     for cls in entity_raw:
       entity_data.append(entity_raw[cls])
     detect_data = {}
     detect_data['tool'] = 'cpu-only'
     detect_data['date'] = int(time.time())
-    detect_data['cam-time'] = round(cam_end - cam_start, 3)
-    detect_data['inf-time'] = round(prediction_end - prediction_start, 3)
+    detect_data['cam-time'] = round(cam_time, 3)
+    detect_data['inf-time'] = round(inf_time, 3)
     detect_data['entities'] = entity_data
-    detect_data['image'] = prediction_image_b64
-    data['detect'] = detect_data
+    return detect_data
+
+  #
+  # Expose YoloV3 detection
+  #
+  # The source image is either pulled from a camera url (GET), or pushed in
+  # the request body (POST), as a jpg (or other image file) binary or, if
+  # width and height are given, as raw 8-bit RGB pixels (row by row).
+  #
+  # Each result has a "frame-id", which can be used to get the annotated image
+  # later on (see /frame below).
+  #
+  # URL parameters (i.e., "?key=value&..."):
+  #    kind:        the response format, one of:
+  #                   (default) JSON, with the annotated image as base64
+  #                   'json' JSON, without any image (none is drawn)
+  #                   'jpg' the annotated image alone
+  #                   'multipart' multipart/mixed, the JSON (without any
+  #                           image) and then the annotated image
+  #                   'msgpack' msgpack, with the annotated image as binary
+  #                           (only if msgpack is installed)
+  #  * url:         (required for GET) url to retrieve the source image (for
+  #                 POST it optionally names the source, for gating)
+  #    user:        if url requires HTTP basic auth, this is the user
+  #    password:    if url requires HTTP basic auth, this is the password
+  #    width:       (POST only) width of the raw pixels in the body
+  #    height:      (POST only) height of the raw pixels in the body
+  #    camtime:     (POST only) seconds taken to get the image, to be reported
+  #                 as the "cam-time" (default 0)
+  #    thresh:      detection confidence threshold in percent (i.e., 0..100),
+  #                 default 50
+  #    hierthresh:  hierarchical detection confidence threshold in % (0..100),
+  #                 default 50
+  #    nms:         non-max suppression intersection-over-union threshold in %
+  #                 (0 disables suppression), default 45
+  #    gate:        skip inference unless this % of the scene has changed
+  #    gatemode:    'reuse' (the default) returns the previous result again,
+  #                 marked "gated", and 'suppress' returns 204 (no content)
+  #    gatemaxage:  always re-run inference after this many seconds (60)
+  #
+  # If the same frame was seen recently, the network is not run again (see
+  # OUTPUT_CACHE_SIZE), and the result is marked "cached". Frames from a url
+  # may be prefetched (see PREFETCH_MAX_AGE), and then the "cam-time" is just
+  # the time spent waiting for the frame.
+  #
+  # Note:
+  #  * indicates a required parameter
+  #  x indicates a currently ignored parameter
+  #
+  # Usage examples:
+  #   curl "http://localhost:5252/detect?kind=json&url=http%3A%2F%2Frestcam"
+  #   curl -X POST --data-binary @frame.jpg "http://localhost:5252/detect"
+  #
+  @webapp.route("/detect", methods=['GET', 'POST'])
+  def get_detect():
+
+    #print("\n\nREST request received.")
+    #print(request.args)
+    kind = request.args.get('kind', '')
+    if kind not in KINDS or ('msgpack' == kind and None == msgpack):
+      return (json.dumps({"error": "unsupported kind"}) + '\n', 400)
+    url = request.args.get('url', '')
+    #print("URL is:   %s" % url)
+    user = request.args.get('user', '')
+    password = request.args.get('password', '')
+    thresh = float(request.args.get('thresh', '50')) / 100.0
+    hierthresh = float(request.args.get('hierthresh', '50')) / 100.0
+    nms = float(request.args.get('nms', '45')) / 100.0
+    gate = request.args.get('gate', '')
+    gatemode = request.args.get('gatemode', 'reuse')
+    gatemaxage = float(request.args.get('gatemaxage', '60'))
+
+    size = None
+    decoded = None
+    if 'POST' == request.method:
+      # The image was pushed in the request body
+      frame = request.get_data()
+      cam_time = float(request.args.get('camtime', '0'))
+      if '' != request.args.get('width', ''):
+        size = (int(request.args.get('width')), int(request.args.get('height', '0')))
+        if (len(frame) != size[0] * size[1] * 3):
+          return (json.dumps({"error": "body is not width x height RGB pixels"}) + '\n', 400)
+    else:
+      # Pull image from the provided camera URL
+      #print("Pulling an image from the camera REST service...")
+      cam_start = time.time()
+      prefetched = None
+      if PREFETCH_MAX_AGE > 0:
+        prefetched = take_prefetched(url, user, password, 'json' != kind)
+      if None != prefetched:
+        (frame, decoded) = prefetched
+      else:
+        if ('' != user):
+          r = requests.get(url, auth=(user, password))
+        else:
+          r = requests.get(url)
+        #print("Camera service returned.")
+        if (r.status_code > 299):
+          return (json.dumps({"error": "unable to get image from camera"}) + '\n', 400)
+        #if (r.headers['content-type'] != 'image/jpg'):
+        #  return (json.dumps({"error": "camera did not return a jpg image"}) + '\n', 400)
+        frame = r.content
+      cam_time = time.time() - cam_start
+    if 0 == len(frame):
+      return (json.dumps({"error": "no image provided"}) + '\n', 400)
+
+    # Skip inference if the scene has not changed enough since the last time
+    thumbnail = None
+    if '' != gate:
+      try:
+        thumbnail = gate_thumbnail(frame, size)
+      except IOError:
+        return (json.dumps({"error": "unable to decode the image"}) + '\n', 400)
+      with gate_lock:
+        previous = gate_state.get(url)
+      if None != previous and time.time() - previous[2] < gatemaxage and gate_changed(thumbnail, previous[0]) < float(gate):
+        if 'suppress' == gatemode:
+          return ('', 204)
+        detect_data = dict(previous[1])
+        detect_data['date'] = int(time.time())
+        detect_data['cam-time'] = round(cam_time, 3)
+        detect_data['inf-time'] = 0.0
+        detect_data['gated'] = True
+        jpg = None if 'json' == kind else frame_image(previous[3])
+        return detect_response(kind, {'detect': response_detect(kind, detect_data, jpg)}, jpg)
+
+    # Use the candidates found for this frame earlier, if there are any (and
+    # they were found with a low enough threshold)
+    key = output_key(frame, size, hierthresh)
+    cached = cache_get(output_cache, key)
+    prediction = None
+    inf_time = 0.0
+    if None != cached and thresh >= cached[0]:
+      candidates = cached[1]
+    else:
+      cached = None
+      # We have the image. Decode it once (unless the prefetcher did), in
+      # memory, and run the network on it (this decoded frame is also the one
+      # that gets annotated below, if the image is needed now, unless a
+      # worker decoded it).
+      floor = min(thresh, OUTPUT_CACHE_THRESH / 100.0)
+      try:
+        (prediction, candidates, inf_time) = infer('frame', frame, size, floor, hierthresh, decoded, 'json' != kind)
+      except IOError:
+        return (json.dumps({"error": "unable to decode the image"}) + '\n', 400)
+      except RuntimeError as e:
+        return (json.dumps({"error": "inference failed: " + str(e)}) + '\n', 500)
+      cache_put(output_cache, key, (floor, candidates), OUTPUT_CACHE_SIZE)
+    r = select_detections(meta, candidates, thresh, nms)
+    entry = {'frame': frame, 'size': size, 'detections': r, 'jpg': None}
+    detect_data = make_detect_data(r, cam_time, inf_time)
+    detect_data['frame-id'] = remember_frame(entry)
+    if None != cached:
+      detect_data['cached'] = True
+    jpg = None
+    if 'json' != kind:
+      jpg = frame_image(entry, prediction)
+    if None != thumbnail:
+      detect_data['gated'] = False
+      with gate_lock:
+        gate_state[url] = (thumbnail, detect_data, time.time(), entry)
+    data = {}
+    data['detect'] = response_detect(kind, detect_data, jpg)
     #print data
-    json_data = json.dumps(data)
     #print("Returning REST response...")
-    return (json_data + '\n', 200)
+    return detect_response(kind, data, jpg)
+
+  #
+  # Expose batched detection, i.e., several frames (e.g., from several
+  # cameras) through one network forward pass (see "Batched inference")
+  #
+  # URL parameters are as for /detect above, except that:
+  #    kind:        only the (default) JSON, 'json' and 'msgpack' kinds
+  #  * url:         (required) may be given several times, once per frame
+  #  x gate, gatemode, gatemaxage:  (gating is not done for batches)
+  #
+  # The response is {"results": [...]} with one result per url, in order,
+  # that is either {"detect": {...}} (as from /detect above, with "batch-size"
+  # added and "inf-time" being its share of the batch time) or {"error": ...}.
+  #
+  # Usage example:
+  #   curl "http://localhost:5252/detect/batch?url=http%3A%2F%2Frestcam&url=http%3A%2F%2Fcam2"
+  #
+  @webapp.route("/detect/batch", methods=['GET'])
+  def get_detect_batch():
+
+    kind = request.args.get('kind', '')
+    if kind not in ['', 'json', 'msgpack'] or ('msgpack' == kind and None == msgpack):
+      return (json.dumps({"error": "unsupported kind"}) + '\n', 400)
+    urls = request.args.getlist('url')
+    if 0 == len(urls):
+      return (json.dumps({"error": "no url provided"}) + '\n', 400)
+    user = request.args.get('user', '')
+    password = request.args.get('password', '')
+    thresh = float(request.args.get('thresh', '50')) / 100.0
+    hierthresh = float(request.args.get('hierthresh', '50')) / 100.0
+    nms = float(request.args.get('nms', '45')) / 100.0
+
+    # Pull the images from the cameras (concurrently), and decode the ones
+    # whose candidates are not cached (see /detect above)
+    frames = fetch_frames(urls, user, password)
+    cached = [None] * len(urls)
+    for (k, (jpg, cam_time)) in enumerate(frames):
+      if None != jpg:
+        cached[k] = cache_get(output_cache, output_key(jpg, None, hierthresh))
+        if None != cached[k] and thresh < cached[k][0]:
+          cached[k] = None
+    jpgs = [frames[k][0] for k in range(len(urls)) if None != frames[k][0] and None == cached[k]]
+
+    # Run the inferencing on all of the others at once
+    floor = min(thresh, OUTPUT_CACHE_THRESH / 100.0)
+    try:
+      (pils, candidates, seconds) = infer('frames', jpgs, floor, hierthresh, 'json' != kind)
+    except RuntimeError as e:
+      return (json.dumps({"error": "inference failed: " + str(e)}) + '\n', 500)
+    decoded = [None] * len(urls)
+    for k in range(len(urls)):
+      if None != frames[k][0] and None == cached[k]:
+        decoded[k] = pils.pop(0)
+    ims = [d for d in decoded if None != d]
+    inf_time = seconds / max(1, len(ims))
+
+    results = []
+    for k in range(len(urls)):
+      if None != decoded[k]:
+        cache_put(output_cache, output_key(frames[k][0], None, hierthresh), (floor, candidates[0]), OUTPUT_CACHE_SIZE)
+        r = select_detections(meta, candidates.pop(0), thresh, nms)
+      elif None != cached[k]:
+        r = select_detections(meta, cached[k][1], thresh, nms)
+      elif None == frames[k][0]:
+        results.append({"error": "unable to get image from camera"})
+        continue
+      else:
+        results.append({"error": "unable to decode the image"})
+        continue
+      entry = {'frame': frames[k][0], 'size': None, 'detections': r, 'jpg': None}
+      detect_data = make_detect_data(r, frames[k][1], 0.0 if None != cached[k] else inf_time)
+      detect_data['frame-id'] = remember_frame(entry)
+      detect_data['batch-size'] = len(ims)
+      if None != cached[k]:
+        detect_data['cached'] = True
+      jpg = None
+      if 'json' != kind:
+        jpg = frame_image(entry, decoded[k] if isinstance(decoded[k], Image.Image) else None)
+      results.append({'detect': response_detect(kind, detect_data, jpg)})
+    return detect_response(kind, {'results': results}, None)
+
+  #
+  # Expose the annotated image of a recent frame (drawn when first asked for)
+  #
+  # The frame id is the "frame-id" of a /detect (or /detect/batch) result.
+  # Only the most recent FRAME_CACHE_SIZE frames are kept, so older ones are
+  # not found (404).
+  #
+  # Usage example:
+  #   curl -o frame.jpg "http://localhost:5252/frame/0123456789abcdef0123456789abcdef"
+  #
+  @webapp.route("/frame/<frame_id>", methods=['GET'])
+  def get_frame(frame_id):
+    entry = recall_frame(frame_id)
+    if None == entry:
+      return (json.dumps({"error": "unknown frame"}) + '\n', 404)
+    return detect_response('jpg', None, frame_image(entry))
 
   # Start up the REST server
   webapp.run(host=FLASK_BIND_ADDRESS, port=FLASK_PORT)
@@ -5,8 +5,10 @@
 #
 
 import base64
+import collections
 from datetime import datetime
 from flask import Flask, request
+import hashlib
 import os
 from io import BytesIO
 import json
@@ -14,21 +16,42 @@ from math import exp as exp
 import numpy as np, math
 import requests
 import shutil
-import subprocess
+import struct
 import sys
 import threading
 import time
+import uuid
 
 import cv2
 from openvino.inference_engine import IECore, IENetwork, IEPlugin
 
+# The msgpack response kind is optional (it is only available with msgpack)
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+# Configuration from the environment (an empty setting, e.g., one that is
+# passed through by the Makefile but not set there, gets the default)
+def get_from_env(v, d):
+  if v in os.environ and '' != os.environ[v]:
+    return os.environ[v]
+  else:
+    return d
+
 # Configuration constants
 FLASK_BIND_ADDRESS = '0.0.0.0'
-FLASK_PORT = 80
-LOGO_IMAGE = '/logo.png'
+FLASK_PORT = int(os.environ.get('FLASK_PORT', '80'))
+BATCH_SIZE = int(get_from_env('BATCH_SIZE', '1'))
+LOGO_IMAGE = os.environ.get('LOGO_IMAGE', '/logo.png')
 LOGO_SIZE = (27,13)
-INCOMING_IMAGE = '/tmp/incoming.jpg'
-OUTGOING_IMAGE = '/tmp/outgoing.jpg'
+FRAME_CACHE_SIZE = int(get_from_env('FRAME_CACHE_SIZE', '16'))
+OUTPUT_CACHE_SIZE = int(get_from_env('OUTPUT_CACHE_SIZE', '16'))
+PREFETCH_MAX_AGE = float(get_from_env('PREFETCH_MAX_AGE', '0'))
+PREFETCH_IDLE = 30
+TILE_SIZE = int(get_from_env('TILE_SIZE', '0'))
+TILE_OVERLAP = float(get_from_env('TILE_OVERLAP', '20'))
+TILE_MAX = int(get_from_env('TILE_MAX', '0'))
 COLOR_OUTLINE = (255, 255, 255)
 COLOR_LABEL = (0, 0, 0)
 MINIMUM_CONFIDENCE = 0.2
@@ -37,12 +60,16 @@ label_background_color = (125, 175, 75)
 box_color = (255, 128, 0)
 box_thickness = 1
 
-# Configuration from the environment
-def get_from_env(v, d):
-  if v in os.environ and '' != os.environ[v]:
-    return os.environ[v]
-  else:
-    return d
+# Change gating: a tiny grayscale thumbnail of the last frame that inference
+# was run on, for each camera URL, is kept along with that frame's result.
+# New frames are compared to it, cell by cell, and a cell has "changed" if it
+# differs by more than GATE_CELL_DELTA (out of 255, to ignore sensor noise).
+GATE_SIZE = (32, 24)
+GATE_CELL_DELTA = 24
+gate_lock = threading.Lock()
+gate_state = {}
+
+# The device to run the inferencing engine on
 OPENVINO_PLUGIN = get_from_env('OPENVINO_PLUGIN', 'CPU')
 print('OPENVINO_PLUGIN = %s' % (OPENVINO_PLUGIN))
 
@@ -73,9 +100,10 @@ def outline (original, entity, confidence, xmin, ymin, xmax, ymax):
   cv2.rectangle(original, (xmin, ymin), (xmax, ymax), COLOR_OUTLINE, 2)
   # Then the text box (filled)
   cv2.rectangle(original, (xmin - 1, ymin - 1), (xmax + 1, ymin - 14), COLOR_OUTLINE, -1)
-  # And then the logo (directly overwrite the image bytes -- hack)
-  lx = xmin + 3
-  ly = ymin - 12
+  # And then the logo (directly overwrite the image bytes -- hack), kept
+  # within the image
+  lx = min(max(0, xmin + 3), original.shape[1] - logo.shape[1])
+  ly = min(max(0, ymin - 12), original.shape[0] - logo.shape[0])
   original[ly : ly + logo.shape[0], lx : lx + logo.shape[1]] = logo
   # And finally the label
   label = (" %s (%0.2f%%)" % (labels[entity], 100.0 * confidence))
@@ -96,6 +124,32 @@ class Detected():
     self.entity = entity
     self.confidence = confidence
 
+  # Move an object found in a tile at (x, y) of a frame into the frame, with
+  # the frame's (w_scale, h_scale)
+  def move(self, x, y, scale):
+    self.cx = (x + self.cx * self.scale[0]) / scale[0]
+    self.cy = (y + self.cy * self.scale[1]) / scale[1]
+    self.w = self.w * self.scale[0] / scale[0]
+    self.h = self.h * self.scale[1] / scale[1]
+    self.scale = scale
+    self.xmin += x
+    self.ymin += y
+    self.xmax += x
+    self.ymax += y
+
+# Decode the JPEG at 1/8 scale, in grayscale, into a GATE_SIZE thumbnail
+# (or, if size is given, convert the raw RGB pixels, see decode_image below)
+def gate_thumbnail(frame, size=None):
+  if None == size:
+    small = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+  else:
+    small = cv2.cvtColor(decode_image(frame, size), cv2.COLOR_BGR2GRAY)
+  return cv2.resize(small, GATE_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+# Percentage of the thumbnail cells that have changed
+def gate_changed(a, b):
+  return 100.0 * np.count_nonzero(np.abs(a - b) > GATE_CELL_DELTA) / a.size
+
 # Taken as a "black box" from the original PINTO code
 def EntryIndex(side, lcoords, lclasses, location, entry):
   n = int(location / (side * side))
@@ -116,13 +170,14 @@ def IntersectionOverUnion(box_1, box_2):
   area_of_union = box_1_area + box_2_area - area_of_overlap
   return (area_of_overlap / area_of_union)
 
-# Mostly taken as a "black box" from the original PINTO code
+# Based on the original PINTO code, but vectorized with numpy. The blob is
+# (anchor, entry, location) with entries x, y, w, h, objectness, then the
+# class probabilities. Only the (few) boxes whose objectness meets the
+# threshold are examined further, in the original (location, anchor) order.
 def ParseYOLOV3Output(blob, resized_im_h, resized_im_w, original_im_h, original_im_w, threshold, objects):
-  out_blob_h = blob.shape[2]
-  out_blob_w = blob.shape[3]
-  side = out_blob_h
+  side = blob.shape[2]
   side_square = side * side
-  output_blob = blob.flatten()
+  predictions = blob.reshape(num, coords + 1 + classes, side_square)
   anchor_offset = 0
   if 13 == side:
     anchor_offset = 2 * 6
@@ -130,58 +185,419 @@ def ParseYOLOV3Output(blob, resized_im_h, resized_im_w, original_im_h, original_
     anchor_offset = 2 * 3
   elif 52 == side:
     anchor_offset = 2 * 0
-  for i in range(side_square):
+  (locations, boxes) = np.nonzero(predictions[:, coords, :].T >= threshold)
+  for (i, n) in zip(locations.tolist(), boxes.tolist()):
     row = int(i / side)
     col = int(i % side)
-    for n in range(num):
-      obj_index = EntryIndex(side, coords, classes, n * side * side + i, coords)
-      box_index = EntryIndex(side, coords, classes, n * side * side + i, 0)
-      scale = output_blob[obj_index]
-      if (scale < threshold):
-        continue
-      x = (col + output_blob[box_index + 0 * side_square]) / side * resized_im_w
-      y = (row + output_blob[box_index + 1 * side_square]) / side * resized_im_h
-      height = math.exp(output_blob[box_index + 3 * side_square]) * anchors[anchor_offset + 2 * n + 1]
-      width = math.exp(output_blob[box_index + 2 * side_square]) * anchors[anchor_offset + 2 * n]
-      for j in range(classes):
-        class_index = EntryIndex(side, coords, classes, n * side_square + i, coords + 1 + j)
-        prob = scale * output_blob[class_index]
-        if prob < threshold:
-          continue
-        obj = Detected(x, y, height, width, j, prob, (original_im_h / resized_im_h), (original_im_w / resized_im_w))
-        objects.append(obj)
+    box = predictions[n, :, i]
+    scale = box[coords]
+    x = (col + box[0]) / side * resized_im_w
+    y = (row + box[1]) / side * resized_im_h
+    height = math.exp(box[3]) * anchors[anchor_offset + 2 * n + 1]
+    width = math.exp(box[2]) * anchors[anchor_offset + 2 * n]
+    probs = scale * box[coords + 1:]
+    for j in np.nonzero(probs >= threshold)[0].tolist():
+      obj = Detected(x, y, height, width, j, probs[j], (original_im_h / resized_im_h), (original_im_w / resized_im_w))
+      objects.append(obj)
   return objects
 
-# Based on "main_IE_infer" in the original PINTO code
-def do_detect(incoming, outgoing):
-
-    # Read image and prepare the corresponding numpy array for openvino
-    original_image = cv2.imread(incoming)
-    image_width = np.size(original_image,1)
-    image_height = np.size(original_image,0)
-    numpy_image = cv2.resize(original_image, yolo_shape)
-    numpy_image = numpy_image[np.newaxis, :, :, :]
-    numpy_image = numpy_image.transpose((0, 3, 1, 2))
+# Decode a frame, in memory, into a (BGR) image. The frame is a jpg (or other
+# image file) binary, or, if size (width, height) is given, raw 8-bit RGB
+# pixels, row by row. Returns None if the frame cannot be decoded.
+def decode_image(frame, size=None, flags=cv2.IMREAD_COLOR):
+    if None == size:
+        return cv2.imdecode(np.frombuffer(frame, np.uint8), flags)
+    return cv2.cvtColor(np.frombuffer(frame, np.uint8).reshape(size[1], size[0], 3), cv2.COLOR_RGB2BGR)
+
+# The (width, height) of a JPEG, read from its SOF (start of frame) marker
+# without decoding anything, or None if it is not a JPEG (or is cut short)
+def jpeg_size(jpg):
+    if b'\xff\xd8' != jpg[0:2]:
+        return None
+    i = 2
+    while i + 9 <= len(jpg) and 0xff == jpg[i]:
+        marker = jpg[i + 1]
+        if 0xff == marker:
+            i += 1
+        elif 0x01 == marker or 0xd0 <= marker <= 0xd7:
+            i += 2
+        elif 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            (height, width) = struct.unpack('>HH', jpg[i + 5:i + 9])
+            return (width, height)
+        else:
+            i += 2 + struct.unpack('>H', jpg[i + 2:i + 4])[0]
+    return None
+
+# OpenCV's reduced size (1/8, 1/4 and 1/2, in the DCT domain) JPEG decoding
+REDUCED_COLOR = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
 
-    # Run inferencing engine on this image (globals exec_net and input_blob)
-    outputs = exec_net.infer(inputs={input_blob: numpy_image})
+#
+# Tiling. Scaled down to the network's size, small (or distant) objects in a
+# large frame are too small to be found. With TILE_MAX > 1, a frame that is
+# larger than TILE_SIZE pixels (the network's size, if TILE_SIZE is 0) is
+# also cut into square tiles of that size, overlapping by (at least)
+# TILE_OVERLAP percent, and the inferencing engine is run on each of them,
+# as well as on the whole frame (for the large objects), all in one batch.
+# The objects found in the tiles are moved to where the tiles are in the
+# frame, and then they are suppressed (see find_objects) along with all of
+# the others, so an object found in more than one tile is only reported
+# once. If more than TILE_MAX tiles would be needed, the tiles are made
+# larger until they are not, so the time taken stays bounded.
+#
 
-    # Collect the detected objects
+# The origins along a length of tiles of size t, overlapping by (at least)
+# the given fraction, spread evenly from one end to the other
+def tile_origins(length, t, overlap):
+  if t >= length:
+    return [0]
+  stride = max(1, int(t * (1.0 - overlap)))
+  n = (length - t + stride - 1) // stride + 1
+  return [(k * (length - t)) // (n - 1) for k in range(n)]
+
+# The tiles of a w x h frame, as a list of (x, y, width, height), or [] if
+# it is not tiled (see above)
+def frame_tiles(w, h):
+  if TILE_MAX < 2:
+    return []
+  t = TILE_SIZE if TILE_SIZE > 0 else max(yolo_shape)
+  while True:
+    xs = tile_origins(w, t, TILE_OVERLAP / 100.0)
+    ys = tile_origins(h, t, TILE_OVERLAP / 100.0)
+    if len(xs) * len(ys) <= TILE_MAX:
+      break
+    t += max(1, t // 4)
+  if 1 == len(xs) * len(ys):
+    return []
+  return [(x, y, min(t, w), min(t, h)) for y in ys for x in xs]
+
+# Decode the image (in memory) and prepare the (CHW) numpy arrays for
+# openvino, of the whole image and then of its tiles (if it is tiled, see
+# frame_tiles). Returns (image or None, list of (numpy array, (x, y) and
+# (height, width) of the part of the image it is of)), or raises ValueError
+# if the image cannot be decoded. Unless the full size image is wanted (i.e.,
+# to annotate it), a JPEG is only decoded at 1/2, 1/4 or 1/8 size, the
+# smallest that is still no smaller than yolo_shape (for the whole image, or
+# its tiles), and it is not kept.
+def prepare_image(jpg, size=None, full=True):
+    flags = cv2.IMREAD_COLOR
+    image_size = None if full or None != size else jpeg_size(jpg)
+    if None != image_size:
+        tiles = frame_tiles(image_size[0], image_size[1])
+        needed = tiles[0][2:] if tiles else image_size
+        for (scale, reduced) in REDUCED_COLOR:
+            if needed[0] // scale >= yolo_shape[0] and needed[1] // scale >= yolo_shape[1]:
+                flags = reduced
+                break
+    original_image = decode_image(jpg, size, flags)
+    if None is original_image:
+        raise ValueError('unable to decode the image')
+    if None == image_size:
+        image_size = (original_image.shape[1], original_image.shape[0])
+    inputs = [(cv2.resize(original_image, yolo_shape).transpose((2, 0, 1)), (0, 0), (image_size[1], image_size[0]))]
+    (sx, sy) = (original_image.shape[1] / image_size[0], original_image.shape[0] / image_size[1])
+    for (x, y, w, h) in frame_tiles(image_size[0], image_size[1]):
+        tile = original_image[int(y * sy):int((y + h) * sy), int(x * sx):int((x + w) * sx)]
+        inputs.append((cv2.resize(tile, yolo_shape).transpose((2, 0, 1)), (x, y), (h, w)))
+    return (original_image if full else None, inputs)
+
+# Run the inferencing engine on (CHW numpy array) images, one at a time (with
+# globals exec_net and input_blob), or, if there are several, at once (in
+# batches of up to BATCH_SIZE, with global batch_exec_net). Returns (copies
+# of, the engine reuses them) the outputs for each image, in order.
+def infer_images(numpy_images):
+    if None == batch_exec_net or 1 == len(numpy_images):
+        return [image_outputs(exec_net.infer(inputs={input_blob: numpy_image[np.newaxis, :, :, :]}), 0) for numpy_image in numpy_images]
+    results = []
+    for start in range(0, len(numpy_images), BATCH_SIZE):
+        chunk = numpy_images[start:start + BATCH_SIZE]
+        batch = np.zeros((BATCH_SIZE, 3, yolo_shape[1], yolo_shape[0]), dtype=np.uint8)
+        for b in range(len(chunk)):
+            batch[b] = chunk[b]
+        outputs = batch_exec_net.infer(inputs={input_blob: batch})
+        for b in range(len(chunk)):
+            results.append(image_outputs(outputs, b))
+    return results
+
+# Based on "main_IE_infer" in the original PINTO code. Returns the image (or
+# None, see prepare_image) and the raw outputs of the inferencing engine for
+# it (see find_objects below). The image is prepared here unless it was
+# already.
+def do_detect(jpg, size=None, prepared=None, full=True):
+
+    if None == prepared:
+        prepared = prepare_image(jpg, size, full)
+    original_image, inputs = prepared
+
+    # Run inferencing engine on this image (and its tiles, if any)
+    outputs = infer_images([numpy_image for (numpy_image, origin, shape) in inputs])
+
+    # Return the image and the outputs (with the part of the image they are of)
+    return (original_image, [(outputs[i], inputs[i][1], inputs[i][2]) for i in range(len(inputs))])
+
+# Run the inferencing engine on several prepared images (see prepare_image)
+# at once (see infer_images). Returns a list of (image, outputs) as from
+# do_detect() above, in order.
+def do_detect_batch(prepared):
+    outputs = infer_images([numpy_image for (original_image, inputs) in prepared for (numpy_image, origin, shape) in inputs])
+    results = []
+    for (original_image, inputs) in prepared:
+        results.append((original_image, [(outputs.pop(0), origin, shape) for (numpy_image, origin, shape) in inputs]))
+    return results
+
+# Copy the outputs for image b out of the inferencing engine outputs
+def image_outputs(outputs, b):
+    return dict([(name, np.copy(output[b:b + 1])) for name, output in outputs.items()])
+
+# Collect the detected objects from the outputs for one image (see
+# do_detect), with the given confidence and non-max suppression thresholds
+def find_objects(outputs, thresh, nms):
+
+    # Collect the detected objects (moving those found in tiles into the
+    # whole image, see frame_tiles)
     objects = []
-    for output in outputs.values():
-        objects = ParseYOLOV3Output(output, yolo_shape[0], yolo_shape[1], image_height, image_width, 0.7, objects)
+    (image_height, image_width) = outputs[0][2]
+    for (i, (blobs, (x, y), (height, width))) in enumerate(outputs):
+        first = len(objects)
+        for output in blobs.values():
+            objects = ParseYOLOV3Output(output, yolo_shape[0], yolo_shape[1], height, width, thresh, objects)
+        if i > 0:
+            for obj in objects[first:]:
+                obj.move(x, y, (image_width / yolo_shape[1], image_height / yolo_shape[0]))
+
+    # With tiles, the same object may be found more than once, so keep the
+    # most confident of those (rather than the first one found)
+    if len(outputs) > 1:
+        objects.sort(key=lambda obj: -obj.confidence)
 
     # Filter overlapping boxes (set confidence to 0 to discard -- hack!)
     objlen = len(objects)
     for i in range(objlen):
-        if (objects[i].confidence == 0.0):
+        if (objects[i].confidence == 0.0 or nms <= 0):
             continue
         for j in range(i + 1, objlen):
-            if (IntersectionOverUnion(objects[i], objects[j]) >= 0.4):
+            if (IntersectionOverUnion(objects[i], objects[j]) >= nms):
                 objects[j].confidence = 0
 
-    # Return the image and the list of filtered detected objects
-    return (original_image, objects)
+    return objects
+
+# Pull images from several camera URLs concurrently. Returns a list, in
+# order, of (jpg binary or None on failure, seconds taken).
+def fetch_frames(urls, user, password):
+  frames = [(None, 0.0)] * len(urls)
+  def fetch(k):
+    start = time.time()
+    try:
+      if ('' != user):
+        r = requests.get(urls[k], auth=(user, password))
+      else:
+        r = requests.get(urls[k])
+      if (r.status_code < 300):
+        frames[k] = (r.content, time.time() - start)
+    except requests.RequestException:
+      pass
+  threads = [threading.Thread(target=fetch, args=(k,)) for k in range(len(urls))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return frames
+
+# Annotated images are only drawn (and encoded) when they are asked for. The
+# most recent FRAME_CACHE_SIZE frames are kept, by frame id, along with their
+# detected objects (and, once it is drawn, the annotated jpg), least recently
+# used first. Each is a dict with the 'frame' and its 'size' (see
+# decode_image), the 'detected' objects and the 'jpg' (None until drawn).
+#
+# Similarly, the inferencing engine outputs for the most recent
+# OUTPUT_CACHE_SIZE frames are kept, by a hash of the frame's content, so
+# that asking about the same frame again (e.g., with other thresholds) does
+# not run the network again. Each is as from do_detect (see find_objects).
+cache_lock = threading.Lock()
+frame_cache = collections.OrderedDict()
+output_cache = collections.OrderedDict()
+
+# Add to a (least recently used first) cache, holding at most size entries
+def cache_put(cache, key, value, size):
+  with cache_lock:
+    cache[key] = value
+    while len(cache) > size:
+      cache.popitem(last=False)
+
+# Look up a cache entry (it becomes the most recently used), or None
+def cache_get(cache, key):
+  with cache_lock:
+    value = cache.pop(key, None)
+    if None != value:
+      cache[key] = value
+  return value
+
+# Remember a frame, returning its (new) frame id
+def remember_frame(entry):
+  frame_id = uuid.uuid4().hex
+  cache_put(frame_cache, frame_id, entry, FRAME_CACHE_SIZE)
+  return frame_id
+
+# Look up a remembered frame (it becomes the most recently used), or None
+def recall_frame(frame_id):
+  return cache_get(frame_cache, frame_id)
+
+# The output cache key for a frame (see decode_image for size)
+def output_key(frame, size):
+  return (hashlib.sha1(frame).hexdigest(), size)
+
+# Draw the detected objects on a (decoded) image, returning the jpg binary
+def render(original_image, detected):
+  for obj in detected:
+    if obj.confidence >= MINIMUM_CONFIDENCE:
+      outline(original_image, obj.entity, obj.confidence, obj.xmin, obj.ymin, obj.xmax, obj.ymax)
+  return cv2.imencode('.jpg', original_image)[1].tobytes()
+
+# The annotated jpg for a remembered frame. It is drawn the first time it is
+# asked for (on the given decoded image, or else the frame is decoded again).
+def frame_image(entry, original_image=None):
+  if None == entry['jpg']:
+    if None is original_image:
+      original_image = decode_image(entry['frame'], entry['size'])
+    entry['jpg'] = render(original_image, entry['detected'])
+  return entry['jpg']
+
+# Construct the JSON detect data for the detected objects
+def make_detect_data(detected, cam_time, inf_time):
+  entity_raw = {}
+  for obj in detected:
+    if obj.confidence < MINIMUM_CONFIDENCE:
+      continue
+    if not (obj.entity in entity_raw):
+      this_entity = {}
+      this_entity['eclass'] = labels[obj.entity]
+      this_entity['details'] = []
+      entity_raw[obj.entity] = this_entity
+    this_entity = entity_raw[obj.entity]
+    # Prepare info for the return JSON payload
+    this_instance = {}
+    this_instance['confidence'] = round(float(obj.confidence), 3)
+    this_instance['cx'] = int(obj.cx)
+    this_instance['cy'] = int(obj.cy)
+    this_instance['w'] = int(obj.w)
+    this_instance['h'] = int(obj.h)
+    this_entity['details'].append(this_instance)
+  entity_data = []
+  for cls in entity_raw:
+    entity_data.append(entity_raw[cls])
+  detect_data = {}
+  detect_data['tool'] = 'openvino'
+  detect_data['date'] = int(time.time())
+  detect_data['cam-time'] = round(cam_time, 3)
+  detect_data['inf-time'] = round(inf_time, 3)
+  detect_data['entities'] = entity_data
+  return detect_data
+
+# Response kinds (see /detect below)
+KINDS = ['', 'json', 'jpg', 'multipart', 'msgpack']
+
+# The detect data as sent in a response of the given kind, i.e., with the
+# annotated jpg embedded as base64 (the default), as binary (msgpack), or not
+# at all (the other kinds)
+def response_detect(kind, detect_data, jpg):
+  if 'msgpack' == kind:
+    detect_data = dict(detect_data)
+    detect_data['image'] = jpg
+  elif '' == kind:
+    detect_data = dict(detect_data)
+    detect_data['image'] = base64.b64encode(jpg).decode('ascii')
+  return detect_data
+
+# Construct the response for the given kind, from the data to return and the
+# annotated jpg binary
+def detect_response(kind, data, jpg):
+  if 'jpg' == kind:
+    return (jpg, 200, {'Content-Type': 'image/jpeg'})
+  elif 'multipart' == kind:
+    boundary = uuid.uuid4().hex.encode('ascii')
+    body = b''
+    for (content_type, part) in [(b'application/json', json.dumps(data).encode('utf-8')), (b'image/jpeg', jpg)]:
+      body += b'--' + boundary + b'\r\nContent-Type: ' + content_type + b'\r\n\r\n' + part + b'\r\n'
+    body += b'--' + boundary + b'--\r\n'
+    return (body, 200, {'Content-Type': 'multipart/mixed; boundary=' + boundary.decode('ascii')})
+  elif 'msgpack' == kind:
+    return (msgpack.packb(data, use_bin_type=True), 200, {'Content-Type': 'application/msgpack'})
+  return (json.dumps(data) + '\n', 200)
+
+#
+# Camera prefetch. With PREFETCH_MAX_AGE > 0, once a frame is pulled from a
+# camera url for /detect, a prefetcher thread for that url keeps the next
+# frame pulled (and prepared, at full size only if the last request wanted
+# it), so the next request for that url (usually) finds it ready, rather than
+# pulling it only then. A prefetched frame is never used once it is over
+# PREFETCH_MAX_AGE seconds old (the prefetcher pulls a newer one instead),
+# and a prefetcher stops when its url has not been asked for in
+# PREFETCH_IDLE seconds.
+#
+prefetch_lock = threading.Lock()
+prefetch_changed = threading.Condition(prefetch_lock)
+prefetchers = {}
+
+# Is a prefetched frame (jpg or None, seconds taken, time pulled, prepared
+# or None) fresh enough to use?
+def prefetch_fresh(prefetched):
+  return None != prefetched and time.time() - prefetched[2] <= PREFETCH_MAX_AGE
+
+# The prefetcher thread for a camera url (with the given state, see below)
+def prefetch(key, state):
+  (url, user, password) = key
+  while True:
+    with prefetch_lock:
+      while prefetch_fresh(state['frame']) and time.time() - state['used'] < PREFETCH_IDLE:
+        prefetch_changed.wait(max(0.0, PREFETCH_MAX_AGE - (time.time() - state['frame'][2])))
+      if time.time() - state['used'] >= PREFETCH_IDLE:
+        del prefetchers[key]
+        return
+    start = time.time()
+    jpg = None
+    try:
+      if ('' != user):
+        r = requests.get(url, auth=(user, password))
+      else:
+        r = requests.get(url)
+      if (r.status_code < 300):
+        jpg = r.content
+    except requests.RequestException:
+      pass
+    prepared = None
+    if None != jpg:
+      try:
+        prepared = prepare_image(jpg, None, state['full'])
+      except (cv2.error, ValueError):
+        pass
+    with prefetch_lock:
+      state['frame'] = (jpg, time.time() - start, time.time(), prepared)
+      prefetch_changed.notify_all()
+
+# Take the prefetched frame for a camera url, as (jpg, prepared or None),
+# waiting for it if it is being pulled, or None if there is no fresh one (or
+# it could not be pulled). Starts the url's prefetcher if it is not running.
+# The next frame is prepared at full size if full is True (see prepare_image).
+def take_prefetched(url, user, password, full):
+  key = (url, user, password)
+  with prefetch_lock:
+    state = prefetchers.get(key)
+    if None == state:
+      state = {'frame': None, 'used': time.time(), 'full': full}
+      prefetchers[key] = state
+      prefetcher = threading.Thread(target=prefetch, args=(key, state), name='prefetch')
+      prefetcher.daemon = True
+      prefetcher.start()
+    state['used'] = time.time()
+    state['full'] = full
+    deadline = time.time() + PREFETCH_IDLE
+    while not prefetch_fresh(state['frame']) and time.time() < deadline:
+      prefetch_changed.wait(deadline - time.time())
+    prefetched = state['frame']
+    state['frame'] = None
+    prefetch_changed.notify_all()
+  if not prefetch_fresh(prefetched) or None == prefetched[0]:
+    return None
+  return (prefetched[0], prefetched[3])
 
 if __name__ == '__main__':
 
@@ -216,64 +632,165 @@ if __name__ == '__main__':
   global exec_net
   exec_net = ie_core.load_network(network=net, device_name=OPENVINO_PLUGIN)
 
+  # And the global batch_exec_net, a copy taking BATCH_SIZE images at once
+  # (only with BATCH_SIZE > 1, it is 1 by default, as the copy costs memory)
+  global batch_exec_net
+  batch_exec_net = None
+  if BATCH_SIZE > 1:
+    batch_net = ie_core.read_network(model=config_file, weights=weights_file)
+    batch_net.batch_size = BATCH_SIZE
+    batch_exec_net = ie_core.load_network(network=batch_net, device_name=OPENVINO_PLUGIN)
+    print("Batches of up to %d frames use one inference request." % BATCH_SIZE)
+  if TILE_MAX > 1:
+    print("Frames larger than %d pixels are also run as (up to %d) tiles." % (TILE_SIZE if TILE_SIZE > 0 else max(yolo_shape), TILE_MAX))
+
+  # Only one request at a time may use the inferencing engine
+  global inference_lock
+  inference_lock = threading.Lock()
+
   #
   # Expose the YoloV2 "detector.infer()" function
   #
+  # The source image is either pulled from a camera url (GET), or pushed in
+  # the request body (POST), as a jpg (or other image file) binary or, if
+  # width and height are given, as raw 8-bit RGB pixels (row by row).
+  #
+  # Each result has a "frame-id", which can be used to get the annotated image
+  # later on (see /frame below).
+  #
   # URL parameters (i.e., "?key=value&..."):
-  #  x kind:        default (if not specified) is 'jpg'
-  #  * url:         (required) url to retrieve the source image
+  #    kind:        the response format, one of:
+  #                   (default) JSON, with the annotated image as base64
+  #                   'json' JSON, without any image (none is drawn)
+  #                   'jpg' the annotated image alone
+  #                   'multipart' multipart/mixed, the JSON (without any
+  #                           image) and then the annotated image
+  #                   'msgpack' msgpack, with the annotated image as binary
+  #                           (only if msgpack is installed)
+  #  * url:         (required for GET) url to retrieve the source image (for
+  #                 POST it optionally names the source, for gating)
   #    user:        if url requires HTTP basic auth, this is the user
   #    password:    if url requires HTTP basic auth, this is the password
-  #  x thresh:      detection confidence threshold in percent (i.e., 0..100)
+  #    width:       (POST only) width of the raw pixels in the body
+  #    height:      (POST only) height of the raw pixels in the body
+  #    camtime:     (POST only) seconds taken to get the image, to be reported
+  #                 as the "cam-time" (default 0)
+  #    thresh:      detection confidence threshold in percent (i.e., 0..100),
+  #                 default 70
   #  x hierthresh:  hierarchical detection confidence threshold in % (0..100) 
-  #  x nms:         non-max suppression intersection-over-union threshold in %
+  #    nms:         non-max suppression intersection-over-union threshold in %
+  #                 (0 disables suppression), default 40
+  #    gate:        skip inference unless this % of the scene has changed
+  #    gatemode:    'reuse' (the default) returns the previous result again,
+  #                 marked "gated", and 'suppress' returns 204 (no content)
+  #    gatemaxage:  always re-run inference after this many seconds (60)
+  #
+  # If the same frame was seen recently, the network is not run again (see
+  # OUTPUT_CACHE_SIZE), and the result is marked "cached". Frames from a url
+  # may be prefetched (see PREFETCH_MAX_AGE), and then the "cam-time" is just
+  # the time spent waiting for the frame.
   #
   # Note:
   #  * indicates a required parameter
   #  x indicates a currently ignored parameter
   #
-  # Usage example:
+  # Usage examples:
   #   curl http://localhost:5252/detect?kind=json&url=http%3A%2F%2Frestcam
+  #   curl -X POST --data-binary @frame.jpg http://localhost:5252/detect
   #
-  @webapp.route("/detect", methods=['GET'])
+  @webapp.route("/detect", methods=['GET', 'POST'])
   def get_detect():
 
     print("\n\nREST request received.")
     print(request.args)
     kind = request.args.get('kind', '')
+    if kind not in KINDS or ('msgpack' == kind and None == msgpack):
+      return (json.dumps({"error": "unsupported kind"}) + '\n', 400)
     url = request.args.get('url', '')
-    if '' == url:
+    if '' == url and 'POST' != request.method:
       return('{"error": "URL not provided."}\n', 400)
     print("URL is:   %s" % url)
     user = request.args.get('user', '')
     password = request.args.get('password', '')
-    thresh = request.args.get('thresh', '')
+    thresh = float(request.args.get('thresh', '70')) / 100.0
     hierthresh = request.args.get('hierthresh', '')
-    nms = request.args.get('nms', '')
-
-    # Pull image from the provided camera URL
-    print("Pulling an image from the camera REST service...")
-    cam_start = time.time()
-    if ('' != user):
-      r = requests.get(url, auth=(user, password))
+    nms = float(request.args.get('nms', '40')) / 100.0
+    gate = request.args.get('gate', '')
+    gatemode = request.args.get('gatemode', 'reuse')
+    gatemaxage = float(request.args.get('gatemaxage', '60'))
+
+    size = None
+    prepared = None
+    if 'POST' == request.method:
+      # The image was pushed in the request body
+      frame = request.get_data()
+      cam_time = float(request.args.get('camtime', '0'))
+      if '' != request.args.get('width', ''):
+        size = (int(request.args.get('width')), int(request.args.get('height', '0')))
+        if (len(frame) != size[0] * size[1] * 3):
+          return (json.dumps({"error": "body is not width x height RGB pixels"}) + '\n', 400)
     else:
-      r = requests.get(url)
-    print("Camera service returned.")
-    if (r.status_code > 299):
-      return (json.dumps({"error": "unable to get image from camera"}) + '\n', 400)
-    #if (r.headers['content-type'] != 'image/jpg'):
-    #  return (json.dumps({"error": "camera did not return a jpg image"}) + '\n', 400)
-    cam_end = time.time()
-
-    # We have a jpg binary. Write it into the local file system.
-    with open(INCOMING_IMAGE, 'wb') as f:
-      for chunk in r.iter_content(1024):
-        f.write(chunk)
-    print("Image is ready in file system...")
-
-    # Run the inferencing algorithm...
-    prediction_start = time.time()
-    original_image, detected = do_detect(INCOMING_IMAGE, OUTGOING_IMAGE)
+      # Pull image from the provided camera URL
+      print("Pulling an image from the camera REST service...")
+      cam_start = time.time()
+      prefetched = None
+      if PREFETCH_MAX_AGE > 0:
+        prefetched = take_prefetched(url, user, password, 'json' != kind)
+      if None != prefetched:
+        (frame, prepared) = prefetched
+      else:
+        if ('' != user):
+          r = requests.get(url, auth=(user, password))
+        else:
+          r = requests.get(url)
+        print("Camera service returned.")
+        if (r.status_code > 299):
+          return (json.dumps({"error": "unable to get image from camera"}) + '\n', 400)
+        #if (r.headers['content-type'] != 'image/jpg'):
+        #  return (json.dumps({"error": "camera did not return a jpg image"}) + '\n', 400)
+        frame = r.content
+      cam_time = time.time() - cam_start
+    if 0 == len(frame):
+      return (json.dumps({"error": "no image provided"}) + '\n', 400)
+
+    # Skip inference if the scene has not changed enough since the last time
+    thumbnail = None
+    if '' != gate:
+      try:
+        thumbnail = gate_thumbnail(frame, size)
+      except (cv2.error, ValueError):
+        return (json.dumps({"error": "unable to decode the image"}) + '\n', 400)
+      with gate_lock:
+        previous = gate_state.get(url)
+      if None != previous and time.time() - previous[2] < gatemaxage and gate_changed(thumbnail, previous[0]) < float(gate):
+        print('Scene is unchanged, skipping inference.')
+        if 'suppress' == gatemode:
+          return ('', 204)
+        detect_data = dict(previous[1])
+        detect_data['date'] = int(time.time())
+        detect_data['cam-time'] = round(cam_time, 3)
+        detect_data['inf-time'] = 0.0
+        detect_data['gated'] = True
+        jpg = None if 'json' == kind else frame_image(previous[3])
+        return detect_response(kind, {'detect': response_detect(kind, detect_data, jpg)}, jpg)
+
+    # Use the outputs for this frame from earlier, if there are any, or else
+    # run the inferencing algorithm (on the image, in memory)...
+    key = output_key(frame, size)
+    cached = cache_get(output_cache, key)
+    original_image = None
+    if None != cached:
+      prediction_start = time.time()
+      outputs = cached
+    else:
+      with inference_lock:
+        prediction_start = time.time()
+        try:
+          original_image, outputs = do_detect(frame, size, prepared, 'json' != kind)
+        except (cv2.error, ValueError):
+          return (json.dumps({"error": "unable to decode the image"}) + '\n', 400)
+      cache_put(output_cache, key, outputs, OUTPUT_CACHE_SIZE)
+    detected = find_objects(outputs, thresh, nms)
     prediction_end = time.time()
     print('Inferencing is finished.')
 
@@ -281,41 +798,117 @@ if __name__ == '__main__':
     print('Preparing prediction image and formatting return data...')
 
     # Process the prediction result, constructing JSON and drawing outline boxes
+    entry = {'frame': frame, 'size': size, 'detected': detected, 'jpg': None}
+    detect_data = make_detect_data(detected, cam_time, prediction_end - prediction_start)
+    detect_data['frame-id'] = remember_frame(entry)
+    if None != cached:
+      detect_data['cached'] = True
+    jpg = None
+    if 'json' != kind:
+      jpg = frame_image(entry, original_image)
+    if '' != gate:
+      detect_data['gated'] = False
+      with gate_lock:
+        gate_state[url] = (thumbnail, detect_data, time.time(), entry)
     data = {}
-    entity_raw = {}
-    for obj in detected:
-      if obj.confidence < MINIMUM_CONFIDENCE:
+    data['detect'] = response_detect(kind, detect_data, jpg)
+    return detect_response(kind, data, jpg)
+
+  #
+  # Expose batched detection, i.e., several frames (e.g., from several
+  # cameras) through one inference request on the batch_exec_net
+  #
+  # URL parameters are as for /detect above, except that:
+  #    kind:        only the (default) JSON, 'json' and 'msgpack' kinds
+  #  * url:         (required) may be given several times, once per frame
+  #  x gate, gatemode, gatemaxage:  (gating is not done for batches)
+  #
+  # The response is {"results": [...]} with one result per url, in order,
+  # that is either {"detect": {...}} (as from /detect above, with "batch-size"
+  # added and "inf-time" being its share of the batch time) or {"error": ...}.
+  #
+  # Usage example:
+  #   curl "http://localhost:5252/detect/batch?url=http%3A%2F%2Frestcam&url=http%3A%2F%2Fcam2"
+  #
+  @webapp.route("/detect/batch", methods=['GET'])
+  def get_detect_batch():
+
+    kind = request.args.get('kind', '')
+    if kind not in ['', 'json', 'msgpack'] or ('msgpack' == kind and None == msgpack):
+      return (json.dumps({"error": "unsupported kind"}) + '\n', 400)
+    urls = request.args.getlist('url')
+    if 0 == len(urls):
+      return('{"error": "URL not provided."}\n', 400)
+    user = request.args.get('user', '')
+    password = request.args.get('password', '')
+
+    thresh = float(request.args.get('thresh', '70')) / 100.0
+    nms = float(request.args.get('nms', '40')) / 100.0
+
+    # Pull the images from the cameras (concurrently), and decode the ones
+    # whose outputs are not cached (see /detect above), each on its own, so
+    # one that cannot be decoded only fails its own result
+    frames = fetch_frames(urls, user, password)
+    cached = [None if None == jpg else cache_get(output_cache, output_key(jpg, None)) for (jpg, cam_time) in frames]
+    prepared = [None] * len(urls)
+    for k in range(len(urls)):
+      if None != frames[k][0] and None == cached[k]:
+        try:
+          prepared[k] = prepare_image(frames[k][0], None, 'json' != kind)
+        except (cv2.error, ValueError):
+          pass
+    batch = [p for p in prepared if None != p]
+
+    # Run the inferencing algorithm on all of those at once
+    with inference_lock:
+      prediction_start = time.time()
+      detections = do_detect_batch(batch)
+      prediction_end = time.time()
+    inf_time = (prediction_end - prediction_start) / max(1, len(batch))
+
+    results = []
+    for k in range(len(urls)):
+      if None == frames[k][0]:
+        results.append({"error": "unable to get image from camera"})
         continue
-      outline(original_image, obj.entity, obj.confidence, obj.xmin, obj.ymin, obj.xmax, obj.ymax)
-      if not (obj.entity in entity_raw):
-        this_entity = {}
-        this_entity['eclass'] = labels[obj.entity]
-        this_entity['details'] = []
-        entity_raw[obj.entity] = this_entity
-      this_entity = entity_raw[obj.entity]
-      # Prepare info for the return JSON payload
-      this_instance = {}
-      this_instance['confidence'] = round(float(obj.confidence), 3)
-      this_instance['cx'] = int(obj.cx)
-      this_instance['cy'] = int(obj.cy)
-      this_instance['w'] = int(obj.w)
-      this_instance['h'] = int(obj.h)
-      this_entity['details'].append(this_instance)
-    cv2.imwrite(OUTGOING_IMAGE, original_image)
-    entity_data = []
-    for cls in entity_raw:
-      entity_data.append(entity_raw[cls])
-    detect_data = {}
-    detect_data['tool'] = 'openvino'
-    detect_data['date'] = int(time.time())
-    detect_data['cam-time'] = round(cam_end - cam_start, 3)
-    detect_data['inf-time'] = round(prediction_end - prediction_start, 3)
-    detect_data['entities'] = entity_data
-    image_base64 = subprocess.check_output(['/usr/bin/base64 -w 0 -i ' + OUTGOING_IMAGE], shell=True, encoding='UTF-8')
-    detect_data['image'] = image_base64
-    data['detect'] = detect_data
-    json_data = json.dumps(data)
-    return (json_data + '\n', 200)
+      original_image = None
+      if None != cached[k]:
+        outputs = cached[k]
+      elif None != prepared[k]:
+        original_image, outputs = detections.pop(0)
+        cache_put(output_cache, output_key(frames[k][0], None), outputs, OUTPUT_CACHE_SIZE)
+      else:
+        results.append({"error": "unable to decode the image"})
+        continue
+      detected = find_objects(outputs, thresh, nms)
+      entry = {'frame': frames[k][0], 'size': None, 'detected': detected, 'jpg': None}
+      detect_data = make_detect_data(detected, frames[k][1], 0.0 if None != cached[k] else inf_time)
+      detect_data['frame-id'] = remember_frame(entry)
+      detect_data['batch-size'] = len(batch)
+      if None != cached[k]:
+        detect_data['cached'] = True
+      jpg = None
+      if 'json' != kind:
+        jpg = frame_image(entry, original_image)
+      results.append({'detect': response_detect(kind, detect_data, jpg)})
+    return detect_response(kind, {'results': results}, None)
+
+  #
+  # Expose the annotated image of a recent frame (drawn when first asked for)
+  #
+  # The frame id is the "frame-id" of a /detect (or /detect/batch) result.
+  # Only the most recent FRAME_CACHE_SIZE frames are kept, so older ones are
+  # not found (404).
+  #
+  # Usage example:
+  #   curl -o frame.jpg http://localhost:5252/frame/0123456789abcdef0123456789abcdef
+  #
+  @webapp.route("/frame/<frame_id>", methods=['GET'])
+  def get_frame(frame_id):
+    entry = recall_frame(frame_id)
+    if None == entry:
+      return (json.dumps({"error": "unknown frame"}) + '\n', 404)
+    return detect_response('jpg', None, frame_image(entry))
 
   # Start up the REST server
   webapp.run(host=FLASK_BIND_ADDRESS, port=FLASK_PORT)
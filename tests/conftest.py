@@ -0,0 +1,15 @@
+#
+# Shared setup for the tests (run "python3 -m pytest tests" from the top of
+# the repo). The achatina module reads its configuration when it is imported,
+# so just enough of it is set here, with the status server disabled.
+#
+
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+
+os.environ.setdefault('INPUT_URL', 'http://restcam')
+os.environ.setdefault('STATUS_PORT', '0')
+sys.path.insert(0, os.path.join(REPO_DIR, 'achatina'))
@@ -0,0 +1,183 @@
+#
+# Tests for achatina.py (the stages that need no plugin, camera or broker)
+#
+
+import threading
+import time
+
+import requests
+
+import achatina
+
+# One camera (e.g., the default setup) must still be able to keep several
+# requests outstanding when PLUGIN_INFLIGHT > 1
+def test_one_camera_keeps_several_requests_in_flight():
+  camera = achatina.Camera('http://restcam', 0)
+  plugin = achatina.Plugin('http://plugin')
+  scheduler = achatina.Scheduler([camera], [plugin], 3)
+  for i in range(3):
+    assert (camera, plugin) == scheduler.next_job()
+  assert 3 == camera.inflight
+  assert 3 == plugin.inflight
+
+  # A fourth request has to wait until one of them is done
+  jobs = []
+  fetcher = threading.Thread(target=lambda: jobs.append(scheduler.next_job()), daemon=True)
+  fetcher.start()
+  fetcher.join(0.2)
+  assert fetcher.is_alive()
+  scheduler.done(camera, plugin, 0.1)
+  fetcher.join(5)
+  assert [(camera, plugin)] == jobs
+  assert 3 == camera.inflight
+
+class FakeResponse:
+
+  def __init__(self, status_code, content, content_type):
+    self.status_code = status_code
+    self.content = content
+    self.headers = {'Content-Type': content_type}
+
+# Whatever the plugin returns, the job must be reported done, so the camera
+# (and the plugin) are free for the next one
+def test_bad_plugin_responses_release_the_camera(monkeypatch):
+  camera = achatina.Camera('http://restcam', 0)
+  plugin = achatina.Plugin('http://plugin')
+  monkeypatch.setattr(achatina, 'scheduler', achatina.Scheduler([camera], [plugin], 1))
+  responses = [
+    FakeResponse(200, b'--x--', 'multipart/mixed'),
+    FakeResponse(200, b'{"error": "no detect here"}', 'application/json'),
+    FakeResponse(200, b'not json', 'application/json'),
+    FakeResponse(503, b'', 'application/json')]
+  for response in responses:
+    monkeypatch.setattr(achatina.plugin_session, 'get', lambda url, timeout: response)
+    assert None == achatina.fetch_result()
+    assert 0 == camera.inflight
+    assert 0 == plugin.inflight
+    plugin.retry_at = 0.0
+  assert 0 == camera.frames
+
+# Spooled records that expire, and then are in a segment that is evicted, are
+# counted as evicted once, however many times replay reads past them
+def test_spool_counts_each_lost_record_once(tmp_path):
+  spool = achatina.Spool(str(tmp_path), 1 << 20, 0.2, 1 << 20)
+  spool.append('kafka', 'topic', None, b'x' * 100)
+  spool.segment_bytes = 3 * spool.write_offset
+  spool.append('kafka', 'topic', None, b'x' * 100)
+  time.sleep(0.3)
+  spool.append('kafka', 'topic', None, b'x' * 100)
+  spool.append('kafka', 'topic', None, b'x' * 100)
+  assert 2 == len(spool.segments)
+
+  # Replay reads (but fails to deliver) the one fresh record in the first
+  # segment, twice
+  for i in range(2):
+    batch = spool._read_batch(10)
+    assert 1 == len(batch)
+    assert 2 == spool.evicted
+
+  # Then the first segment (with that undelivered record) is evicted
+  spool.max_bytes = 0
+  spool.append('kafka', 'topic', None, b'x' * 100)
+  assert 3 == spool.evicted
+  assert 2 == len(spool._read_batch(10))
+  assert 5 == spool.spooled
+
+# One frame's entities, from (eclass, cx, cy, w, h) tuples
+def entities(*objects):
+  found = {}
+  for (eclass, cx, cy, w, h) in objects:
+    found.setdefault(eclass, []).append({'confidence': 0.9, 'cx': cx, 'cy': cy, 'w': w, 'h': h})
+  return [{'eclass': eclass, 'details': details} for (eclass, details) in sorted(found.items())]
+
+# The events, as (event, track-id, eclass, cx)
+def events(tracker, now, *objects):
+  (found, keyframe) = tracker.update(entities(*objects), now)
+  return [(e['event'], e['track-id'], e['eclass'], e['cx']) for e in found]
+
+# Objects appear, are followed by box overlap as they move (a "changed" event
+# only once they have drifted away from the box last reported), and disappear
+def test_tracker_follows_objects():
+  tracker = achatina.Tracker(0.3, 0.7, 2, 60.0)
+  assert [('appear', 1, 'person', 100), ('appear', 2, 'person', 400)] == events(tracker, 0.0, ('person', 100, 100, 100, 100), ('person', 400, 100, 100, 100))
+
+  # (each step overlaps the last one by 0.82, the reported box by less
+  # after two of them)
+  assert [] == events(tracker, 0.1, ('person', 400, 100, 100, 100), ('person', 110, 100, 100, 100))
+  assert [('changed', 1, 'person', 120)] == events(tracker, 0.2, ('person', 120, 100, 100, 100), ('person', 400, 100, 100, 100))
+  assert [] == events(tracker, 0.3, ('person', 130, 100, 100, 100), ('person', 400, 100, 100, 100))
+
+  # An object of another class in the same place is another object
+  assert [('appear', 3, 'dog', 130)] == events(tracker, 0.4, ('person', 130, 100, 100, 100), ('dog', 130, 100, 100, 100), ('person', 400, 100, 100, 100))
+
+  # A box that overlaps too little (0.18) with the last one is a new object,
+  # and the old one disappears (where it was last seen)
+  assert [('appear', 4, 'person', 200)] == events(tracker, 0.5, ('person', 200, 100, 100, 100), ('dog', 130, 100, 100, 100), ('person', 400, 100, 100, 100))
+  assert [('disappear', 1, 'person', 130)] == events(tracker, 0.6, ('person', 200, 100, 100, 100), ('dog', 130, 100, 100, 100), ('person', 400, 100, 100, 100))
+  assert [('disappear', 2, 'person', 400), ('disappear', 3, 'dog', 130), ('disappear', 4, 'person', 200)] == events(tracker, 0.7) + events(tracker, 0.8)
+  assert [] == tracker.tracks
+
+# Each detection goes to the object it overlaps most, whatever their order
+def test_tracker_matches_by_overlap():
+  tracker = achatina.Tracker(0.3, 0.7, 2, 60.0)
+  events(tracker, 0.0, ('car', 100, 100, 100, 100), ('car', 160, 100, 100, 100))
+  (found, keyframe) = tracker.update(entities(('car', 150, 100, 100, 100), ('car', 105, 100, 100, 100)), 0.1)
+  assert [] == found
+  assert [(1, 105), (2, 150)] == [(track['track-id'], track['detail']['cx']) for track in tracker.tracks]
+
+# An object missed for fewer than EVENT_MISS_FRAMES frames in a row (i.e., a
+# flickering detection) neither disappears nor appears again
+def test_tracker_debounces_flicker():
+  tracker = achatina.Tracker(0.3, 0.7, 3, 60.0)
+  person = ('person', 100, 100, 100, 100)
+  assert [('appear', 1, 'person', 100)] == events(tracker, 0.0, person)
+  flicker = []
+  for (now, seen) in enumerate([False, True, False, False, True, False, True]):
+    flicker += events(tracker, 0.1 * now, *[person for k in range(seen)])
+  assert [] == flicker
+  assert [] == events(tracker, 0.7) + events(tracker, 0.8)
+  assert [('disappear', 1, 'person', 100)] == events(tracker, 0.9)
+
+# A keyframe is due every keyframe_interval seconds, from the first frame
+def test_tracker_keyframes():
+  tracker = achatina.Tracker(0.3, 0.7, 2, 60.0)
+  keyframes = [tracker.update([], now)[1] for now in [1000.0, 1030.0, 1059.9, 1060.0, 1070.0, 1125.0, 1130.0]]
+  assert [True, False, False, True, False, True, False] == keyframes
+
+# Recorded samples are served at GET /metrics, histograms with cumulative
+# buckets (up to "+Inf", which counts every sample), "_sum" and "_count",
+# and label values escaped
+def test_metrics_are_served(monkeypatch):
+  metrics = achatina.Metrics()
+  monkeypatch.setattr(achatina, 'metrics', metrics)
+  for value in [0.003, 0.003, 0.2, 0.2, 0.2, 99.0]:
+    metrics.observe('achatina_request_seconds', value, plugin='http://plugin')
+  metrics.inc('achatina_errors_total', stage='plugin')
+  metrics.inc('achatina_errors_total', 2, stage='plugin')
+  metrics.inc('achatina_frames_total', camera='C:\\cam "1"\nx')
+  server = achatina.ThreadingHTTPServer(('127.0.0.1', 0), achatina.StatusHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  try:
+    r = requests.get('http://127.0.0.1:%d/metrics' % server.server_address[1], timeout=5)
+  finally:
+    server.shutdown()
+    server.server_close()
+  assert 200 == r.status_code
+  assert r.headers['Content-Type'].startswith('text/plain')
+  lines = r.text.splitlines()
+  samples = dict([line.rsplit(' ', 1) for line in lines if not line.startswith('#')])
+
+  assert '# TYPE achatina_request_seconds histogram' in lines
+  buckets = [(line.split('le="')[1].split('"')[0], float(value)) for (line, value) in samples.items() if line.startswith('achatina_request_seconds_bucket{plugin="http://plugin",le="')]
+  assert len(achatina.Histogram.BUCKETS) + 1 == len(buckets)
+  assert ('+Inf', 6.0) == buckets[-1]
+  counts = [count for (le, count) in buckets]
+  assert sorted(counts) == counts
+  bucket = dict(buckets)
+  assert (0.0, 2.0, 2.0, 5.0, 5.0) == (bucket['0.0025'], bucket['0.005'], bucket['0.1'], bucket['0.25'], bucket['60'])
+  assert 6.0 == float(samples['achatina_request_seconds_count{plugin="http://plugin"}'])
+  assert abs(99.606 - float(samples['achatina_request_seconds_sum{plugin="http://plugin"}'])) < 1e-9
+
+  assert '# TYPE achatina_errors_total counter' in lines
+  assert 3.0 == float(samples['achatina_errors_total{stage="plugin"}'])
+  assert 1.0 == float(samples['achatina_frames_total{camera="C:\\\\cam \\"1\\"\\nx"}'])
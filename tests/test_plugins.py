@@ -0,0 +1,428 @@
+#
+# Tests for the plugins, run as they are in the benchmark: the real plugin
+# code, as its own process, with the stub detectors in bench/stubs (so the
+# stub library must be built, with "make stub" in bench/)
+#
+
+import importlib.util
+import io
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+import requests
+
+from conftest import REPO_DIR
+
+sys.path.insert(0, os.path.join(REPO_DIR, 'bench'))
+import bench
+
+PORT = 18590
+FRAME = os.path.join(REPO_DIR, 'shared', 'restcam', 'mock.jpg')
+
+needs_stub = pytest.mark.skipif(not os.path.exists(os.path.join(bench.STUBS_DIR, 'libdarknet.so')), reason='the stub library is not built')
+
+# The openvino plugin closes any OpenCV windows when it starts, which fails
+# with an OpenCV that is built without them (e.g., opencv-python-headless)
+def has_windows():
+  import cv2
+  try:
+    cv2.destroyAllWindows()
+    return True
+  except cv2.error:
+    return False
+
+needs_windows = pytest.mark.skipif(not has_windows(), reason='OpenCV is built without windows')
+
+# Run a plugin (with the given configuration) for the duration of a test,
+# returning its base url
+def run_plugin(request, plugin, **settings):
+  env = {
+    'FLASK_PORT': str(PORT),
+    'LOGO_IMAGE': os.path.join(REPO_DIR, 'plugins', plugin, 'logo.png'),
+    'DARKNET_LIB': os.path.join(bench.STUBS_DIR, 'libdarknet.so'),
+    'PYTHONPATH': bench.STUBS_DIR,
+    'OUTPUT_CACHE_SIZE': '0',
+  }
+  env.update(settings)
+  process = bench.start('plugin', bench.plugin_command(plugin), env, bench.STUBS_DIR, tempfile.mkdtemp(prefix='achatina-test-'))
+  # (workers started after the server was, inherit its socket, so wait for
+  # them to notice that the plugin has gone too)
+  def stop():
+    process.terminate()
+    process.wait()
+    deadline = time.time() + 10
+    while True:
+      try:
+        socket.create_server(('', PORT)).close()
+        return
+      except OSError:
+        assert time.time() < deadline, 'the plugin did not release its port'
+        time.sleep(0.25)
+  request.addfinalizer(stop)
+  url = 'http://127.0.0.1:%d' % PORT
+  deadline = time.time() + 60
+  while True:
+    assert None == process.poll(), 'the plugin exited during start up'
+    try:
+      requests.get(url + '/detect', timeout=5)
+      return (url, process)
+    except requests.ConnectionError:
+      assert time.time() < deadline, 'timed out waiting for the plugin'
+      time.sleep(0.25)
+
+# Serve each of the given frames (binaries) from a mock camera of its own for
+# the duration of a test, returning their urls
+def run_cameras(request, frames):
+  urls = []
+  for (k, frame) in enumerate(frames):
+    path = os.path.join(tempfile.mkdtemp(prefix='achatina-test-'), 'frame.jpg')
+    with open(path, 'wb') as f:
+      f.write(frame)
+    port = PORT + 1 + k
+    camera = bench.start('restcam', [sys.executable, os.path.join(REPO_DIR, 'bench', 'restcam.py'), str(port), '0', path], {}, bench.STUBS_DIR, os.path.dirname(path))
+    def stop(camera=camera):
+      camera.terminate()
+      camera.wait()
+    request.addfinalizer(stop)
+    urls.append('http://127.0.0.1:%d/' % port)
+  for url in urls:
+    bench.wait_for(url, [])
+  return urls
+
+# Load a plugin's code as a module (in this process, with the stub detectors)
+def load_plugin(plugin, script):
+  os.environ['LOGO_IMAGE'] = os.path.join(REPO_DIR, 'plugins', plugin, 'logo.png')
+  os.environ['DARKNET_LIB'] = os.path.join(bench.STUBS_DIR, 'libdarknet.so')
+  if bench.STUBS_DIR not in sys.path:
+    sys.path.insert(0, bench.STUBS_DIR)
+  spec = importlib.util.spec_from_file_location(os.path.splitext(script)[0], os.path.join(REPO_DIR, 'plugins', plugin, script))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+# The cpu-only plugin's code, with the stub network loaded
+@pytest.fixture(scope='module')
+def darknet():
+  module = load_plugin('cpu-only', 'darknet.py')
+  cwd = os.getcwd()
+  os.chdir(bench.STUBS_DIR)
+  try:
+    module.net = module.load_net(b'stub.cfg', b'stub.weights', 0)
+    module.meta = module.load_meta(b'stub.data')
+  finally:
+    os.chdir(cwd)
+  return module
+
+# The openvino plugin's code, with the stub inferencing engine
+@pytest.fixture(scope='module')
+def openvino():
+  return load_plugin('openvino', 'openvinoyolo.py')
+
+def post_frame(url, body, timeout=30):
+  return requests.post(url + '/detect?kind=json', data=body, headers={'Content-Type': 'image/jpeg'}, timeout=timeout)
+
+# The worker processes of a plugin, i.e., the children of any of its threads
+# (Linux only)
+def children(process):
+  tasks = '/proc/%d/task' % process.pid
+  if not os.path.exists(os.path.join(tasks, str(process.pid), 'children')):
+    pytest.skip('the child processes can not be found on this system')
+  pids = []
+  for task in os.listdir(tasks):
+    with open(os.path.join(tasks, task, 'children')) as f:
+      pids += [int(pid) for pid in f.read().split()]
+  return pids
+
+# A request whose worker dies fails (rather than hanging), and the worker is
+# replaced, so later requests succeed
+@needs_stub
+def test_darknet_survives_dead_workers(request):
+  (url, process) = run_plugin(request, 'cpu-only', WORKERS='2', STUB_LATENCY_MS='1500')
+  with open(FRAME, 'rb') as f:
+    frame = f.read()
+  responses = []
+  requester = threading.Thread(target=lambda: responses.append(post_frame(url, frame)), daemon=True)
+  requester.start()
+  requester.join(1.0)
+  workers = children(process)
+  assert 2 == len(workers)
+  for pid in workers:
+    os.kill(pid, signal.SIGKILL)
+  requester.join(15)
+  assert not requester.is_alive()
+  assert 500 == responses[0].status_code
+  assert 'error' in responses[0].json()
+  time.sleep(2.0)
+  for i in range(3):
+    assert 200 == post_frame(url, frame).status_code
+  assert 2 == len(children(process))
+
+# A frame that is not an image, or a JPEG that is only headers (so its size is
+# known, but it can not be decoded), is refused with a 400
+@pytest.mark.parametrize('plugin', [pytest.param('cpu-only', marks=needs_stub), pytest.param('openvino', marks=needs_windows)])
+def test_undecodable_frames_are_refused(request, plugin):
+  (url, process) = run_plugin(request, plugin)
+  with open(FRAME, 'rb') as f:
+    frame = f.read()
+  for body in [b'garbage', frame[:frame.find(b'\xff\xda')]]:
+    for kind in ['json', 'jpg']:
+      r = requests.post(url + '/detect?kind=' + kind, data=body, headers={'Content-Type': 'image/jpeg'}, timeout=30)
+      assert 400 == r.status_code
+      assert 'error' in r.json()
+  assert 200 == post_frame(url, frame).status_code
+
+# Frames run through the batched network (in batches of up to BATCH_SIZE,
+# each image's output moved to the front of the region layer's in turn)
+# give the same detections as they do when they are run alone
+@needs_stub
+def test_darknet_batches_match_single_frames(request):
+  (url, process) = run_plugin(request, 'cpu-only', BATCH_SIZE='4', STUB_LATENCY_MS='0')
+  from PIL import Image
+  frames = []
+  for k in range(6):
+    f = io.BytesIO()
+    Image.new('RGB', (640, 480), (40 * k, 255 - 40 * k, 90)).save(f, 'JPEG')
+    frames.append(f.getvalue())
+  cameras = run_cameras(request, frames)
+  r = requests.get(url + '/detect/batch', params={'kind': 'json', 'url': cameras}, timeout=30)
+  assert 200 == r.status_code
+  batched = [result['detect']['entities'] for result in r.json()['results']]
+  single = [requests.get(url + '/detect', params={'kind': 'json', 'url': camera}, timeout=30).json()['detect']['entities'] for camera in cameras]
+  assert single == batched
+  assert len(set([repr(entities) for entities in single])) > 1
+
+# One frame in a batch that can not be decoded (or pulled from its camera)
+# gets an error of its own, and the rest of the batch still gets results
+@pytest.mark.parametrize('plugin', [pytest.param('cpu-only', marks=needs_stub), pytest.param('openvino', marks=needs_windows)])
+def test_batch_reports_bad_frames_alone(request, plugin):
+  (url, process) = run_plugin(request, plugin, BATCH_SIZE='4', STUB_LATENCY_MS='0')
+  with open(FRAME, 'rb') as f:
+    frame = f.read()
+  cameras = run_cameras(request, [frame, b'garbage', frame]) + ['http://127.0.0.1:1/']
+  r = requests.get(url + '/detect/batch', params={'kind': 'json', 'url': cameras}, timeout=30)
+  assert 200 == r.status_code
+  results = r.json()['results']
+  assert 4 == len(results)
+  assert 'detect' in results[0]
+  assert {'error': 'unable to decode the image'} == results[1]
+  assert 'detect' in results[2]
+  assert {'error': 'unable to get image from camera'} == results[3]
+  assert 2 == results[0]['detect']['batch-size']
+
+# The plugin Makefiles pass every setting through, set or not, so an empty
+# one must get its default
+@needs_stub
+def test_darknet_takes_empty_settings_as_defaults(request):
+  names = ['BATCH_SIZE', 'WORKERS', 'WORKER_QUEUE_SIZE', 'WORKER_START', 'WORKER_TIMEOUT', 'FRAME_CACHE_SIZE', 'OUTPUT_CACHE_THRESH', 'PREFETCH_MAX_AGE', 'TILE_SIZE', 'TILE_OVERLAP', 'TILE_MAX']
+  (url, process) = run_plugin(request, 'cpu-only', **dict([(name, '') for name in names]))
+  with open(FRAME, 'rb') as f:
+    assert 200 == post_frame(url, f.read()).status_code
+
+#
+# Detection selection. The plugins collect all of the candidate boxes from
+# the network and then apply the thresholds and the suppression themselves
+# (see select_detections), which must give the same results as darknet's
+# own do_nms_obj() (and the loop that collected its results), written out
+# here as a reference.
+#
+
+def box_overlap(x1, w1, x2, w2):
+  left = max(x1 - w1 / 2, x2 - w2 / 2)
+  right = min(x1 + w1 / 2, x2 + w2 / 2)
+  return right - left
+
+def box_iou(a, b):
+  w = box_overlap(a[0], a[2], b[0], b[2])
+  h = box_overlap(a[1], a[3], b[1], b[3])
+  intersection = 0 if w < 0 or h < 0 else w * h
+  return intersection / (a[2] * a[3] + b[2] * b[3] - intersection)
+
+# The detections for boxes of (box, objectness, {class: prob}), as darknet
+# finds them: only the boxes whose objectness is over thresh (as from a yolo
+# layer), then do_nms_obj() (with a stable sort, where darknet's qsort leaves
+# boxes of equal objectness in any order), then every class probability that
+# is left over thresh, highest first
+def reference_detections(boxes, names, thresh, nms):
+  dets = [[box, objectness, dict([(k, p) for (k, p) in probs.items() if p > thresh])] for (box, objectness, probs) in boxes if objectness > thresh]
+  if nms:
+    dets.sort(key=lambda d: -d[1])
+    for i in range(len(dets)):
+      if 0 == dets[i][1]:
+        continue
+      for j in range(i + 1, len(dets)):
+        if 0 != dets[j][1] and box_iou(dets[i][0], dets[j][0]) > nms:
+          dets[j][1] = 0
+          dets[j][2] = {}
+  res = []
+  for (box, objectness, probs) in dets:
+    for k in sorted(probs):
+      res.append((names[k], probs[k], box))
+  return sorted(res, key=lambda r: -r[1])
+
+# Boxes (as fractions of the frame) for STUB_BOXES, and as the stub reports
+# them for a w x h frame (in float32, as darknet does)
+def stub_boxes(boxes, w, h):
+  import numpy as np
+  f32 = lambda v: float(np.float32(v))
+  spec = ';'.join([','.join(['%r' % v for v in box + (objectness,)] + ['%d=%r' % (k, p) for (k, p) in sorted(probs.items())]) for (box, objectness, probs) in boxes])
+  scaled = [((f32(np.float32(box[0]) * w), f32(np.float32(box[1]) * h), f32(np.float32(box[2]) * w), f32(np.float32(box[3]) * h)), f32(objectness), dict([(k, f32(p)) for (k, p) in probs.items()])) for (box, objectness, probs) in boxes]
+  return (spec, scaled)
+
+SELECTION_CASES = {
+  # A box overlapping a better one is suppressed (for all of its classes),
+  # and one elsewhere is not, and one with too little objectness is dropped
+  'overlapping': ([
+    ((0.3, 0.3, 0.2, 0.2), 0.9, {0: 0.9}),
+    ((0.32, 0.31, 0.2, 0.2), 0.95, {0: 0.6, 1: 0.8}),
+    ((0.8, 0.75, 0.1, 0.1), 0.7, {2: 0.65, 3: 0.55}),
+    ((0.5, 0.5, 0.3, 0.3), 0.3, {4: 0.9})], 0.45),
+  # Boxes that only touch do not overlap, however low nms is
+  'touching': ([
+    ((0.25, 0.5, 0.125, 0.25), 0.9, {0: 0.9}),
+    ((0.375, 0.5, 0.125, 0.25), 0.8, {0: 0.8}),
+    ((0.375, 0.75, 0.125, 0.25), 0.7, {1: 0.7})], 0.01),
+  # Of overlapping boxes of equal objectness, the first one is kept
+  'equal objectness': ([
+    ((0.6, 0.4, 0.2, 0.3), 0.8, {5: 0.7}),
+    ((0.61, 0.41, 0.2, 0.3), 0.8, {6: 0.75}),
+    ((0.2, 0.8, 0.1, 0.1), 0.8, {7: 0.6})], 0.45),
+  # No suppression at all with nms 0
+  'nms 0': ([
+    ((0.3, 0.3, 0.2, 0.2), 0.9, {0: 0.9}),
+    ((0.3, 0.3, 0.2, 0.2), 0.8, {0: 0.85}),
+    ((0.31, 0.3, 0.2, 0.2), 0.7, {1: 0.6})], 0),
+}
+
+@needs_stub
+@pytest.mark.parametrize('case', sorted(SELECTION_CASES))
+def test_darknet_selection_matches_darknet(darknet, monkeypatch, case):
+  (boxes, nms) = SELECTION_CASES[case]
+  (w, h) = (640, 480)
+  (spec, scaled) = stub_boxes(boxes, w, h)
+  monkeypatch.setenv('STUB_BOXES', spec)
+  names = [darknet.meta.names[k] for k in range(darknet.meta.classes)]
+  for thresh in [0.5, 0.62]:
+    expected = reference_detections(scaled, names, thresh, nms)
+    assert 0 < len(expected)
+    # (candidates collected at a lower threshold, e.g., for the output
+    # cache, select the same detections)
+    for floor in [thresh, 0.1]:
+      candidates = darknet.get_candidates(darknet.net, darknet.meta, w, h, floor, 0.5)
+      assert expected == darknet.select_detections(darknet.meta, candidates, thresh, nms)
+
+# A frame asked about again, with other thresholds, is answered from the
+# output cache without running the network, with the same result as running
+# it again would give (for darknet, unless the threshold is below the one the
+# cached outputs were collected with)
+@pytest.mark.parametrize(('plugin', 'first', 'second'), [
+  pytest.param('cpu-only', {'thresh': '50', 'nms': '45'}, {'thresh': '70', 'nms': '30'}, marks=needs_stub),
+  pytest.param('openvino', {'thresh': '70', 'nms': '40'}, {'thresh': '80', 'nms': '20'}, marks=needs_windows)])
+def test_output_cache_serves_other_thresholds(request, plugin, first, second):
+  latency = 1.0
+  (url, process) = run_plugin(request, plugin, OUTPUT_CACHE_SIZE='4', OUTPUT_CACHE_THRESH='10', STUB_LATENCY_MS=str(int(latency * 1000)), STUB_DETECTIONS='12')
+  with open(FRAME, 'rb') as f:
+    frame = f.read()
+  def detect(body, params):
+    start = time.time()
+    r = requests.post(url + '/detect', params=dict(params, kind='json'), data=body, headers={'Content-Type': 'image/jpeg'}, timeout=30)
+    assert 200 == r.status_code
+    return (r.json()['detect'], time.time() - start)
+
+  (result, seconds) = detect(frame, first)
+  assert 'cached' not in result
+  (cached, seconds) = detect(frame, second)
+  assert cached.get('cached')
+  assert seconds < latency
+  assert cached['entities'] != result['entities']
+
+  # (the same image, but not the same bytes, is not found in the cache)
+  (fresh, seconds) = detect(frame + b'\0', second)
+  assert 'cached' not in fresh
+  assert seconds >= latency
+  assert fresh['entities'] == cached['entities']
+
+  if 'openvino' != plugin:
+    (below, seconds) = detect(frame, {'thresh': '5', 'nms': '45'})
+    assert 'cached' not in below
+    assert seconds >= latency
+
+#
+# Tiling (see frame_tiles in the plugins)
+#
+
+# Tiles are spread evenly from one end to the other, overlapping by at least
+# the given fraction
+def test_tile_origins(darknet):
+  assert [0] == darknet.tile_origins(416, 416, 0.2)
+  assert [0] == darknet.tile_origins(300, 416, 0.2)
+  for (length, t, overlap) in [(1000, 416, 0.2), (1920, 416, 0.2), (1080, 416, 0.5), (417, 416, 0.0), (4000, 640, 0.1)]:
+    origins = darknet.tile_origins(length, t, overlap)
+    assert 0 == origins[0]
+    assert length - t == origins[-1]
+    steps = [b - a for (a, b) in zip(origins, origins[1:])]
+    assert max(steps) - min(steps) <= 1
+    assert max(steps) <= t * (1.0 - overlap)
+
+# More tiles than TILE_MAX are never used (the tiles are made larger), and
+# the tiles always cover the whole frame
+def test_frame_tiles_respect_tile_max(darknet, monkeypatch):
+  monkeypatch.setattr(darknet, 'TILE_SIZE', 416)
+  monkeypatch.setattr(darknet, 'TILE_OVERLAP', 20.0)
+  monkeypatch.setattr(darknet, 'TILE_MAX', 0)
+  assert [] == darknet.frame_tiles(1920, 1080)
+  monkeypatch.setattr(darknet, 'TILE_MAX', 4)
+  assert [] == darknet.frame_tiles(400, 300)
+  for tile_max in [2, 4, 6, 24]:
+    monkeypatch.setattr(darknet, 'TILE_MAX', tile_max)
+    tiles = darknet.frame_tiles(1920, 1080)
+    assert 1 < len(tiles) <= tile_max
+    assert 1 == len(set([(w, h) for (x, y, w, h) in tiles]))
+    assert 0 == min([x for (x, y, w, h) in tiles]) == min([y for (x, y, w, h) in tiles])
+    assert 1920 == max([x + w for (x, y, w, h) in tiles])
+    assert 1080 == max([y + h for (x, y, w, h) in tiles])
+  assert 416 == darknet.frame_tiles(1920, 1080)[0][2]
+  monkeypatch.setattr(darknet, 'TILE_MAX', 4)
+  assert darknet.frame_tiles(1920, 1080)[0][2] > 416
+  # (an edge that is shorter than a tile is covered by one, cut short)
+  assert [(0, 0, 416, 300), (584, 0, 416, 300)] == darknet.frame_tiles(1000, 300)[0::2]
+
+# Detection candidates (as from get_candidates)
+def candidates(boxes, objectness, probs, classes):
+  import numpy as np
+  return (np.array(boxes, dtype=np.float32).reshape(-1, 4), np.array(objectness, dtype=np.float32), np.array(probs, dtype=np.float32).reshape(-1, classes))
+
+# The boxes found in a tile are moved to where the tile is in the frame, and
+# an object that is seen in two overlapping tiles (and maybe the whole frame)
+# is reported once
+def test_tile_boxes_move_into_the_frame(darknet):
+  classes = darknet.meta.classes
+  person = [0.0] * classes
+  person[0] = 0.9
+  car = [0.0] * classes
+  car[2] = 0.8
+  inputs = [(None, (1000, 600), (0, 0)), (None, (416, 416), (0, 0)), (None, (416, 416), (584, 184))]
+  found = [
+    candidates([], [], [], classes),
+    candidates([(400, 300, 40, 80), (100, 100, 20, 20)], [0.9, 0.8], [person, car], classes),
+    candidates([(400 - 584 + 2, 300 - 184, 40, 80)], [0.85], [person], classes)]
+  (boxes, objectness, probs) = darknet.merge_candidates(inputs, found)
+  assert [[400, 300, 40, 80], [100, 100, 20, 20], [402, 300, 40, 80]] == boxes.tolist()
+  detections = darknet.select_detections(darknet.meta, (boxes, objectness, probs), 0.5, 0.45)
+  assert [(darknet.meta.names[0], 400.0, 300.0), (darknet.meta.names[2], 100.0, 100.0)] == [(name, b[0], b[1]) for (name, confidence, b) in detections]
+
+# The openvino plugin moves the objects found in a tile the same way
+def test_openvino_tile_objects_move_into_the_frame(openvino):
+  # (found at 100, 50 of the network's 416 x 416, in a 832 x 832 tile at
+  # 600, 200 of a 1920 x 1080 frame)
+  obj = openvino.Detected(100, 50, 20, 40, 0, 0.9, 2.0, 2.0)
+  frame_scale = (1920 / 416.0, 1080 / 416.0)
+  obj.move(600, 200, frame_scale)
+  assert (800.0, 300.0) == (round(obj.cx * frame_scale[0], 6), round(obj.cy * frame_scale[1], 6))
+  assert (80.0, 40.0) == (round(obj.w * frame_scale[0], 6), round(obj.h * frame_scale[1], 6))
+  assert (760, 280, 840, 320) == (obj.xmin, obj.ymin, obj.xmax, obj.ymax)
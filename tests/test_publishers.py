@@ -0,0 +1,210 @@
+#
+# Tests for the publishers in achatina.py, against the benchmark's stand-ins
+# for the MQTT and Kafka brokers (bench/broker.py)
+#
+
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+from conftest import REPO_DIR
+
+sys.path.insert(0, os.path.join(REPO_DIR, 'bench'))
+import broker
+
+import achatina
+
+needs_paho = pytest.mark.skipif(None == achatina.mqtt, reason='paho-mqtt is not installed')
+
+# A broker connection whose acks can be held back (to fill the publisher's
+# window), and dropped (as if the broker went away)
+class HeldConnection:
+
+  def __init__(self, conn, is_ack):
+    self.conn = conn
+    self.is_ack = is_ack
+    self.lock = threading.Lock()
+    self.held = None
+
+  def recv(self, n):
+    return self.conn.recv(n)
+
+  def sendall(self, data):
+    with self.lock:
+      if None != self.held and self.is_ack(data):
+        self.held.append(data)
+      else:
+        self.conn.sendall(data)
+
+  def hold(self):
+    with self.lock:
+      self.held = []
+
+  def release(self):
+    with self.lock:
+      for data in self.held:
+        self.conn.sendall(data)
+      self.held = None
+
+  def drop(self):
+    self.conn.shutdown(socket.SHUT_RDWR)
+
+# Mixed into the stand-ins to keep hold of their connections
+class HeldConnections:
+
+  def serve(self, conn):
+    held = HeldConnection(conn, self.is_ack)
+    self.connections.append(held)
+    super().serve(held)
+
+  def connection(self):
+    wait_for(lambda: len(self.connections) > 0)
+    return self.connections[-1]
+
+class MqttBroker(HeldConnections, broker.MqttBroker):
+
+  def __init__(self, port, recorder):
+    broker.MqttBroker.__init__(self, port, recorder)
+    self.connections = []
+
+  # (PUBACK and PUBREC)
+  def is_ack(self, data):
+    return (data[0] >> 4) in (4, 5)
+
+class KafkaBroker(HeldConnections, broker.KafkaBroker):
+
+  def __init__(self, port, recorder):
+    broker.KafkaBroker.__init__(self, port, recorder)
+    self.connections = []
+
+  def is_ack(self, data):
+    return b'\x00' == data
+
+def wait_for(condition, timeout=10.0):
+  give_up = time.time() + timeout
+  while not condition():
+    assert time.time() < give_up
+    time.sleep(0.02)
+
+def free_port():
+  s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  s.bind(('127.0.0.1', 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+# A Kafka publisher on the benchmark's transport
+def kafka_publisher(monkeypatch, port, on_failure=None):
+  monkeypatch.setattr(achatina, 'KAFKA_TRANSPORT', 'benchkafka:BenchKafkaTransport')
+  transport = achatina.make_kafka_transport('127.0.0.1:%d' % port, '', 0, 0, 'none')
+  return achatina.KafkaPublisher(transport, on_failure=on_failure)
+
+@pytest.fixture
+def mqtt_publisher():
+  publishers = []
+  def start(port, **settings):
+    publishers.append(achatina.MqttPublisher('127.0.0.1', port, **settings))
+    return publishers[-1]
+  yield start
+  for publisher in publishers:
+    publisher.close()
+
+# Messages arrive, and are counted as published as the client finishes with
+# them (once sent for QoS 0, once acknowledged for QoS 1 and 2)
+@needs_paho
+@pytest.mark.parametrize('qos', [0, 1, 2])
+def test_mqtt_messages_arrive(mqtt_publisher, qos):
+  recorder = broker.Recorder(None)
+  mqtt = MqttBroker(0, recorder).start()
+  publisher = mqtt_publisher(mqtt.port, qos=qos)
+  wait_for(lambda: publisher.connected)
+  for k in range(10):
+    assert publisher.publish('topic', b'x' * k)
+  wait_for(lambda: 10 == len(recorder.messages) and 10 == publisher.published)
+  assert [('topic', k) for k in range(10)] == [(topic, size) for (now, topic, size) in recorder.messages]
+  assert 0 == publisher.refused
+
+# At most max_inflight QoS 1 messages are unacknowledged at once, and at most
+# max_queued are held in all, the rest are refused
+@needs_paho
+def test_mqtt_inflight_and_queued_limits(mqtt_publisher):
+  recorder = broker.Recorder(None)
+  mqtt = MqttBroker(0, recorder).start()
+  publisher = mqtt_publisher(mqtt.port, qos=1, max_inflight=2, max_queued=5)
+  wait_for(lambda: publisher.connected)
+  mqtt.connection().hold()
+  accepted = [publisher.publish('topic', b'%d' % k) for k in range(7)]
+  assert [True] * 5 + [False] * 2 == accepted
+  assert 2 == publisher.refused
+  wait_for(lambda: 2 == len(recorder.messages))
+  time.sleep(0.3)
+  assert 2 == len(recorder.messages)
+  assert 0 == publisher.published
+
+  # As the acks come back, the rest of the held messages are sent
+  mqtt.connection().release()
+  wait_for(lambda: 5 == publisher.published)
+  assert 5 == len(recorder.messages)
+  assert publisher.publish('topic', b'7')
+  wait_for(lambda: 6 == publisher.published)
+
+# QoS 1 messages published while the broker is away (or before it is there
+# at all) are kept, and delivered once the client has reconnected
+@needs_paho
+def test_mqtt_reconnects(mqtt_publisher):
+  port = free_port()
+  publisher = mqtt_publisher(port, qos=1)
+  assert publisher.publish('topic', b'early')
+  assert 0 == publisher.refused
+  recorder = broker.Recorder(None)
+  mqtt = MqttBroker(port, recorder).start()
+  wait_for(lambda: publisher.connected and 1 == publisher.published)
+
+  mqtt.connection().drop()
+  wait_for(lambda: not publisher.connected)
+  assert publisher.publish('topic', b'while away')
+  wait_for(lambda: publisher.connected and 2 == publisher.published)
+  assert 2 == len(mqtt.connections)
+  assert [('topic', 5), ('topic', 10)] == [(topic, size) for (now, topic, size) in recorder.messages]
+  assert 0 == publisher.refused
+
+# Messages (with or without a key) arrive, and each delivery is counted
+def test_kafka_messages_arrive(monkeypatch):
+  recorder = broker.Recorder(None)
+  kafka = KafkaBroker(0, recorder).start()
+  publisher = kafka_publisher(monkeypatch, kafka.port)
+  for k in range(10):
+    assert publisher.publish('topic', b'x' * k, [None, b'key'][k % 2])
+  publisher.close()
+  assert [('topic', k) for k in range(10)] == [(topic, size) for (now, topic, size) in recorder.messages]
+  assert (10, 10, 0) == (publisher.sent, publisher.delivered, publisher.failed)
+  assert publisher.healthy()
+
+# Deliveries count only once acknowledged. If the broker goes away first,
+# each message is counted as failed and handed to on_failure (to be spooled),
+# and the publisher is unhealthy until RETRY_AFTER has passed.
+def test_kafka_failed_deliveries(monkeypatch, tmp_path):
+  spool = achatina.Spool(str(tmp_path), 1 << 20, 60.0, 1 << 20)
+  recorder = broker.Recorder(None)
+  kafka = KafkaBroker(0, recorder).start()
+  publisher = kafka_publisher(monkeypatch, kafka.port, on_failure=spool.append)
+  assert publisher.publish('topic', b'first')
+  wait_for(lambda: 1 == publisher.delivered)
+  kafka.connection().hold()
+  for k in range(3):
+    assert publisher.publish('topic', b'%d' % k, b'key')
+  wait_for(lambda: 4 == len(recorder.messages))
+  assert (4, 1, 0) == (publisher.sent, publisher.delivered, publisher.failed)
+  assert publisher.healthy()
+
+  monkeypatch.setattr(achatina.KafkaPublisher, 'RETRY_AFTER', 0.5)
+  kafka.connection().drop()
+  wait_for(lambda: 3 == publisher.failed)
+  assert 1 == publisher.delivered
+  assert not publisher.healthy()
+  assert [('kafka', 'topic', b'key', b'%d' % k) for k in range(3)] == [message for (position, message) in spool._read_batch(10)]
+  wait_for(publisher.healthy)